@@ -1,4 +1,31 @@
 from collections import defaultdict
+import hashlib
+from lxml import etree
+
+from emitter import Emitter
+import ir
+from rules import EMPTY
+
+
+# unit of the anonymous types shared by the types
+SHARED_TYPES = 'anon_types'
+
+
+def walk(steps):
+    """Run the steps of several renderers, walking the fields of each node once for all of them.
+
+    steps are generators, one per renderer, yielding (node, visit) when the
+    renderer needs the fields of node rendered; visit(field) returns the
+    steps rendering a field. A node requested by several renderers at once
+    is walked once, calling the visit of each of them on each field."""
+    requests = [next(s, None) for s in steps]
+    while any([r is not None for r in requests]):
+        node = [r for r in requests if r is not None][0][0]
+        walking = [i for i, r in enumerate(requests) if r is not None and r[0] is node]
+        for item in node.fields:
+            walk([requests[i][1](item) for i in walking])
+        for i in walking:
+            requests[i] = next(steps[i], None)
 
 
 class AbstractRenderer:
@@ -13,14 +40,15 @@ class AbstractRenderer:
         self.anon_xml = None
         self.anon_id = 0
         # rules for special elements
-        self.exceptions_rename = []
-        self.exceptions_ignore = []
-        self.exceptions_index = []
-        self.exceptions_enum = []
+        self.rules = EMPTY
         # ignore fields with no attribute 'export' ?
         self.ignore_no_export = True
         # generate comment for ignored fields ?
         self.comment_ignored = False
+        # output, shared with the copies rendering nested types
+        self.out = Emitter()
+        # shared anonymous types, by name, or None to define them locally
+        self.shared = None
 
     def set_ignore_no_export(self, b):
         self.ignore_no_export = b
@@ -30,13 +58,20 @@ class AbstractRenderer:
         self.comment_ignored = b
         return self
 
+    def set_rules(self, rules):
+        self.rules = rules
+        return self
+
+    def set_shared(self, shared):
+        self.shared = shared
+        return self
+
     def copy(self, target):
-        target.exceptions_ignore = self.exceptions_ignore
-        target.exceptions_rename = self.exceptions_rename
-        target.exceptions_index = self.exceptions_index
-        target.exceptions_enum = self.exceptions_enum
+        target.rules = self.rules
         target.ignore_no_export = self.ignore_no_export
         target.comment_ignored = self.comment_ignored
+        target.out = self.out
+        target.shared = self.shared
 
     TYPES = defaultdict(lambda: None, {
         k:v for k,v in {
@@ -68,40 +103,41 @@ class AbstractRenderer:
         return typ in AbstractRenderer.TYPES.keys()
 
     def add_exception_rename(self, xpath, new_name):
-        self.exceptions_rename.append((xpath, new_name))
+        self.rules = self.rules.with_rule('rename', xpath, new_name)
         return self
 
     def add_exception_ignore(self, xpath):
-        self.exceptions_ignore.append(xpath)
+        self.rules = self.rules.with_rule('ignore', xpath)
         return self
 
     def add_exception_index(self, tname, field):
-        self.exceptions_index.append((tname, field))
+        self.rules = self.rules.with_rule('index', tname, field)
         return self
 
     def add_exception_enum(self, tname):
-        self.exceptions_enum.append(tname)
+        self.rules = self.rules.with_rule('enum', tname)
         return self
 
+    def lower(self, xml):
+        # render the nodes of elements, with the exceptions of this renderer
+        if isinstance(xml, etree._Element):
+            return ir.lower(xml, self.ns, self.rules, self.ignore_no_export)
+        return xml
+
     def ident(self, xml, extra_ident=0):
-        ident = xml.get(f'{self.ns}level') or 1
-        return '  ' * (int(ident) + extra_ident)
+        return '  ' * (xml.level + extra_ident)
 
     def get_name(self, xml):
-        dfname = xml.get('name')
-        pbname = None
-        for k,v in iter(self.exceptions_rename):
-            found = xml.getroottree().xpath(k, namespaces={'ld': self.ns[1:-1]})
-            if found and found[0] is xml:
-                # rename protobuf name
-                pbname = v
-        if not dfname:
-            dfname = xml.get(f'{self.ns}anon-name')
-        if not dfname:
+        if not xml.dfname:
+            xml.dfname = xml.name or xml.anon_name
+        if not xml.dfname:
             if self.anon_xml != xml:
                 self.anon_id += 1
                 self.anon_xml = xml
-            dfname = 'anon_' + str(self.anon_id)
+            xml.dfname = 'anon_' + str(self.anon_id)
+        dfname = xml.dfname
+        # rename protobuf name
+        pbname = xml.pbname
         if not pbname:
             pbname = dfname
         # protobuf field names are lowercase, except enum items
@@ -110,23 +146,59 @@ class AbstractRenderer:
         return pbname, dfname
 
     def get_typedef_name(self, xml, name):
-        tname = xml.get(f'{self.ns}typedef-name')
+        tname = xml.typedef_name
         if not tname:
             tname = self.get_type_name(xml, name)
         return tname
 
     def get_type_name(self, xml, name=None):
-        tname = xml.get('type-name')
+        tname = xml.type_name
         if not tname:
             if not name:
                 name = AbstractRenderer.get_name(self, xml)[0]
             tname = 'T_' + name
         return tname
 
+    def _shape(self, xml):
+        if xml.shape is None:
+            # other types would be imported by the shared types
+            refs = [t for t in [xml.type_name, xml.pointer_type] if t and not self.is_primitive_type(t)]
+            shape = not (refs or xml.inherits_from or xml.export_as
+                         or xml.is_union or xml.anon_compound or xml.meta == 'global')
+            if xml.meta in ['primitive', 'number', 'bytes'] and not self.is_primitive_type(xml.subtype) \
+               and xml.subtype != 'flag-bit':
+                shape = False
+            items = [self._shape(item) for item in xml.items]
+            shape = shape and all(items) and hashlib.sha1(repr((
+                xml.tag, xml.meta, xml.subtype, xml.name, xml.anon_name, xml.pbname,
+                xml.comment, xml.count, xml.value, xml.skipped, items
+            )).encode()).hexdigest()
+            xml.shape = shape
+        return xml.shape
+
+    def get_shared_name(self, xml):
+        """Return the name of the shared definition of an anonymous type, or None to define it locally.
+
+        Types made of the same elements share a definition, named after them;
+        types referring to other types are not shared."""
+        if self.shared is None or xml.meta not in [None, 'compound'] or not self._shape(xml):
+            return None
+        # the name of the type and of its field are not part of the definition
+        comment = xml.comment if xml.subtype == 'bitfield' else None
+        name = 'T_' + hashlib.sha1(repr((
+            xml.meta, xml.subtype, comment, [self._shape(item) for item in xml.items]
+        )).encode()).hexdigest()[:12]
+        self.shared.setdefault(name, xml)
+        return name
+
+    def walk_fields(self, xml, visit):
+        """Steps having the fields of xml rendered by visit, which returns the steps of a field."""
+        yield xml, visit
+
     def append_comment(self, xml, line=''):
         if line:
             line += ' '
-        comment = xml.get('comment')
+        comment = xml.comment
         if comment:
             return line + '/* ' + comment + ' */\n'
         return line + '\n'
@@ -138,76 +210,65 @@ class AbstractRenderer:
         if not ctx:
             ctx = self.create_context()
         if not tname:
-            tname = xml.get('type-name')
-        out = self._render_struct_header(xml, tname, ctx)
-        value = 1
-        parent = xml.get('inherits-from')
+            tname = xml.type_name
+        self._render_struct_header(xml, tname, ctx)
+        value = [1]
+        parent = xml.inherits_from
         if parent:
-            out += self._render_struct_parent(xml, parent, ctx)
-            value += 1        
-        for item in xml.findall(f'{self.ns}field'):
-            field, value = self._render_struct_field(item, value, ctx)
-            out += field
-        out += self._render_struct_footer(xml, ctx)
-        return out
+            self._render_struct_parent(xml, parent, ctx)
+            value[0] += 1
+        def visit(item):
+            value[0] = yield from self._render_struct_field(item, value[0], ctx)
+        yield from self.walk_fields(xml, visit)
+        self._render_struct_footer(xml, ctx)
 
 
     # main renderer
 
     def render_type_impl(self, xml):
-        meta = xml.get(f'{self.ns}meta')
+        meta = xml.meta
         if meta == 'bitfield-type':
             return self.render_type_bitfield(xml)
         elif meta == 'enum-type':
             return self.render_type_enum(xml)
         elif meta == 'class-type':
-            return self.render_type_struct(xml)
+            return (yield from self.render_type_struct(xml))
         elif meta == 'struct-type':
-            return self.render_type_struct(xml)
+            return (yield from self.render_type_struct(xml))
         raise Exception('not supported: '+xml.tag+': meta='+str(meta))
 
+    def render_type(self, xml):
+        mark = self.out.mark()
+        walk([self.emit_type(self.lower(xml))])
+        return self.out.pop(mark)
+
     def render_field_impl(self, xml, ctx):
-        ignore = False
-        name = xml.get('name')
-        export = xml.get('export')
-        export_as = xml.get('export-as')
-        if export_as:
+        name = xml.name
+        if xml.export_as:
             # convert type
             return self.render_field_conversion(xml, ctx)
-        elif export==None and self.ignore_no_export:
-            ignore = True
-        elif (name and name.startswith('unk_')) or (export and export == 'false'):
-            ignore = True
-
-        # if (name and name.startswith('unk_')) or export!='true':
-        else:
-            for k in self.exceptions_ignore:
-                found = xml.getroottree().xpath(k, namespaces={
-                    'ld': self.ns[1:-1],
-                    're': 'http://exslt.org/regular-expressions'
-                })
-                if found and xml in found:
-                    ignore = True
-                    break
-        if ignore:
+        if xml.skipped:
             # ignore this field
             if self.comment_ignored:
-                return self.ident(xml) + '/* ignored field %s */\n' % (name or 'anon')
-            else:
-                return ''
-        else:
-            # export all sub-elements
-            for sub in xml.iter():
-                sub.set('export', 'true')
-        meta = xml.get(f'{self.ns}meta')
+                self.out.write(self.ident(xml) + '/* ignored field %s */\n' % (name or 'anon'))
+            return
+        meta = xml.meta
         if not meta or meta == 'compound':
-            return self.render_field_compound(xml, ctx)
+            return (yield from self.render_field_compound(xml, ctx))
         if meta == 'primitive' or meta == 'number' or meta == 'bytes':
             return self.render_field_simple(xml, ctx)
         elif meta == 'global':
             return self.render_field_global(xml, ctx)
         elif meta == 'container' or meta == 'static-array':
-            return self.render_field_container(xml, ctx)
+            return (yield from self.render_field_container(xml, ctx))
         elif meta == 'pointer':
-            return self.render_field_pointer(xml, ctx)
+            return (yield from self.render_field_pointer(xml, ctx))
         raise Exception('not supported: '+xml.tag+': meta='+str(meta))
+
+    def emit_field(self, xml, ctx):
+        yield from self.render_field_impl(xml, ctx)
+
+    def render_field(self, xml, ctx=None):
+        mark = self.out.mark()
+        walk([self.emit_field(self.lower(xml), ctx or self.create_context())])
+        return self.out.pop(mark)
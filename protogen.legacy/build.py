@@ -0,0 +1,120 @@
+#!/usr/bin/env python3
+#
+# Merge export files, select types and generate code in a single process:
+# $ ./protogen.py build ../dfhack/library/xml ../protogen/xml --roots historical_figure --cmake protogen.cmake
+#
+
+import sys
+import os
+import glob
+import re
+import argparse
+from lxml import etree
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'protogen'))
+import merge
+
+import protogen
+import lowering
+import profiling
+import tracing
+from fileio import write_if_changed
+from lowering import lower_structure
+
+
+def structure_files(xml_dir, export_dir):
+    """Return (structure file, export file) of the structures having exported types."""
+    result = []
+    for f in sorted(glob.glob(os.path.join(xml_dir, 'df.*.xml'))):
+        sname = re.match(r'df\.(.*)\.xml', os.path.basename(f)).group(1)
+        export_file = os.path.join(export_dir, sname + '.export')
+        if os.path.exists(export_file):
+            result.append((f, export_file))
+    return result
+
+
+def merge_structure(f, export_file, xml_out):
+    """Mark the exported types and fields of a structure file.
+
+    Save the merged structure to xml_out and return its path, its xml and
+    the number of warnings."""
+    with open(export_file, 'r') as fd:
+        exports = merge.read_exports(fd)
+    xml = etree.parse(f)
+    warnings = merge.parse_structure(exports, xml.getroot())
+    merged = os.path.join(xml_out, os.path.basename(f))
+    write_if_changed(merged, etree.tostring(xml.getroot(), pretty_print=True))
+    return merged, xml, warnings
+
+
+def build(args, results, changed=None):
+    """Merge the structures, select the types and render them.
+
+    Only the structures whose files are in changed, or that are not in
+    results, are merged again. Return the exit code."""
+    fnames = []
+    lowered = {}
+    structures = []
+    for f, export_file in structure_files(args.input, args.exports):
+        merged = os.path.join(args.xml_out, os.path.basename(f))
+        structures.extend([f, export_file])
+        fnames.append(merged)
+        if changed is not None and merged in results and not set([f, export_file]) & changed:
+            continue
+        if not args.quiet:
+            sys.stdout.write('merging %s\n' % (export_file))
+        with profiling.phase('merge', sites=True), profiling.structure(f), tracing.span('merge ' + os.path.basename(f), 'file', file=f):
+            merged, xml, warnings = merge_structure(f, export_file, args.xml_out)
+        if warnings:
+            sys.stderr.write(protogen.COLOR_FAIL + 'failed to merge %s\n' % (export_file) + protogen.COLOR_ENDC)
+            return 1
+        results.pop(merged, None)
+        lowered[merged] = lower_structure(merged, args.transform, args.cache, xml)
+
+    # select types and render
+    rc, _ = protogen.generate(fnames, args, lowered, results, structures)
+    return rc
+
+
+def main(argv=None):
+
+    # parse args
+    parser = argparse.ArgumentParser(prog='protogen.py build',
+                                     description='Merge export files into dfhack structures, '
+                                     'then generate protobuf and conversion code for the given types.')
+    parser.add_argument('input', metavar='XMLDIR', type=str,
+                        help='directory of dfhack structure files')
+    parser.add_argument('exports', metavar='EXPORTDIR', type=str,
+                        help='directory of export files, named <structure>.export')
+    parser.add_argument('--xml_out', metavar='DIR', type=str,
+                        default='./protogen/xml',
+                        help='output directory for merged structure files (default=./protogen/xml)')
+    protogen.add_render_arguments(parser)
+    args = parser.parse_args(argv)
+    if args.stream:
+        parser.error('--stream is not supported by build')
+    if args.dump_xml or args.dump_gzip:
+        parser.error('--dump-xml and --dump-gzip are not supported by build')
+    if args.share_anon and (args.incremental or args.watch):
+        parser.error('--share-anon needs all the types rendered, not --incremental or --watch')
+    os.makedirs(args.xml_out, exist_ok=True)
+    if args.watch:
+        args.incremental = True
+        lowering.keep_documents()
+
+    protogen.start_profile(args)
+    results = {}
+    rc = build(args, results)
+    if args.watch:
+        def regenerate(changed):
+            if changed & set(protogen.settings_files(args)):
+                results.clear()
+            build(args, results, changed)
+        protogen.watch_inputs([os.path.join(args.input, 'df.*.xml'), os.path.join(args.exports, '*.export')],
+                              args, regenerate)
+    protogen.report_profile(args)
+    sys.exit(rc)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,92 @@
+#!/usr/bin/env python3
+#
+# Run a generator script through the server started with "protogen.py serve",
+# or directly if no server is listening:
+# $ ./client.py --socket /tmp/protogen.sock --start protogen --quiet df.history.xml
+#
+
+# keep imports light: this runs once per build command
+import sys
+import os
+import json
+import base64
+import socket
+import subprocess
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+# scripts, by tool name
+SCRIPTS = {
+    'protogen': os.path.join(HERE, 'protogen.py'),
+    'list': os.path.join(HERE, 'list.py'),
+    'merge': os.path.join(HERE, '..', 'protogen', 'merge.py'),
+    'dag': os.path.join(HERE, '..', 'protogen', 'dag.py'),
+    'dependencies': os.path.join(HERE, '..', 'protogen', 'dependencies.py'),
+}
+
+# environment variables of the scripts, sent to the server
+ENVIRON = ['PROTOGEN_TRACE']
+
+USAGE = 'usage: client.py [--socket PATH] [--start] {%s} ARGS...\n' % ('|'.join(SCRIPTS))
+
+
+def request(path, tool, argv):
+    """Run a tool in the server listening to path.
+
+    Return the response, or None if no server is listening or it is restarting."""
+    if not hasattr(socket, 'AF_UNIX'):
+        return None
+    try:
+        with socket.socket(socket.AF_UNIX) as sock:
+            sock.connect(path)
+            sock.sendall(json.dumps({
+                'tool': tool, 'argv': argv, 'cwd': os.getcwd(),
+                'env': dict([(name, os.environ.get(name)) for name in ENVIRON]),
+            }).encode() + b'\n')
+            with sock.makefile('rb') as fil:
+                line = fil.readline()
+    except (FileNotFoundError, ConnectionRefusedError):
+        return None
+    response = json.loads(line.decode()) if line else {'restart': True}
+    return None if response.get('restart') else response
+
+
+def start_server(path):
+    subprocess.Popen([sys.executable, SCRIPTS['protogen'], 'serve', '--socket', path],
+                     stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL,
+                     stderr=subprocess.DEVNULL, start_new_session=True)
+
+
+def main(argv=None):
+    argv = list(sys.argv[1:] if argv is None else argv)
+    path = './protogen.sock'
+    start = False
+    while argv and argv[0].startswith('--'):
+        opt = argv.pop(0)
+        if opt == '--socket' and argv:
+            path = argv.pop(0)
+        elif opt.startswith('--socket='):
+            path = opt[len('--socket='):]
+        elif opt == '--start':
+            start = True
+        else:
+            sys.stderr.write(USAGE)
+            return 2
+    if not argv or argv[0] not in SCRIPTS:
+        sys.stderr.write(USAGE)
+        return 2
+    tool = argv.pop(0)
+
+    response = request(path, tool, argv)
+    if response is None:
+        # no server: run the script here, and start one for the next commands
+        if start and hasattr(socket, 'AF_UNIX'):
+            start_server(path)
+        return subprocess.call([sys.executable, SCRIPTS[tool]] + argv)
+    sys.stdout.buffer.write(base64.b64decode(response['stdout']))
+    sys.stderr.buffer.write(base64.b64decode(response['stderr']))
+    return response['rc']
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,68 @@
+import re
+
+from fileio import write_if_changed
+from type_graph import closure
+
+PROTO_FIELD = re.compile(r'^\s*(?:(?:optional|required|repeated)\s+)?[\w.]+\s+\w+\s*=\s*\d+', re.M)
+PROTO_MESSAGE = re.compile(r'^\s*message\s', re.M)
+# lambdas of anonymous compounds
+CPP_LAMBDA = re.compile(r'=\s*\[\]\(')
+CPP_LOOP = re.compile(r'\b(?:for|while)\s*\(')
+
+# rough weights, in lines of c++ compiled, of the code generated by protoc
+# for a field and for a message, and of a header included by a .pb.h
+COST_FIELD = 30
+COST_MESSAGE = 150
+COST_INCLUDE = 200
+COST_LAMBDA = 20
+
+COLUMNS = ['cost', 'fields', 'messages', 'cpp lines', 'lambdas', 'loops', 'fan-out']
+
+
+def _read(fname):
+    try:
+        with open(fname) as fil:
+            return fil.read()
+    except FileNotFoundError:
+        return ''
+
+
+def type_size(files):
+    """Return the size and complexity metrics of the generated files of a type."""
+    proto = ''.join([_read(f) for f in files if f.endswith('.proto')])
+    cpp = ''.join([_read(f) for f in files if f.endswith('.cpp')])
+    messages = len(PROTO_MESSAGE.findall(proto))
+    return {
+        'fields': len(PROTO_FIELD.findall(proto)),
+        'messages': max(messages - 1, 0),
+        'cpp lines': cpp.count('\n'),
+        'lambdas': len(CPP_LAMBDA.findall(cpp)),
+        'loops': len(CPP_LOOP.findall(cpp)),
+    }
+
+
+def size_report(types):
+    """Return (type name, metrics) of the rendered types, by decreasing compile cost.
+
+    Besides the metrics of type_size, the fan-out is the number of types
+    whose headers are included, directly or not, by the generated code."""
+    graph = dict([(t['type'], t['depends'] or []) for t in types])
+    result = []
+    for t in types:
+        if not t['files']:
+            continue
+        metrics = type_size(t['files'])
+        metrics['fan-out'] = len(closure(graph, [t['type']])) - 1
+        metrics['cost'] = (metrics['cpp lines'] + COST_FIELD * metrics['fields']
+                           + COST_MESSAGE * (metrics['messages'] + 1)
+                           + COST_LAMBDA * metrics['lambdas'] + COST_INCLUDE * metrics['fan-out'])
+        result.append((t['type'], metrics))
+    return sorted(result, key=lambda r: (-r[1]['cost'], r[0]))
+
+
+def write_size_report(fname, types):
+    """Write the size and complexity of the code of each type, by decreasing compile cost."""
+    out = '%-40s' % ('type') + ''.join(['%10s' % (c) for c in COLUMNS]) + '\n'
+    for tname, metrics in size_report(types):
+        out += '%-40s' % (tname) + ''.join(['%10d' % (metrics[c]) for c in COLUMNS]) + '\n'
+    return write_if_changed(fname, out)
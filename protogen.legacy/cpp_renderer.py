@@ -1,8 +1,9 @@
 import sys
 import traceback
+import textwrap
 import copy
 
-from abstract_renderer import AbstractRenderer
+from abstract_renderer import AbstractRenderer, SHARED_TYPES, walk
 
 
 class Context:
@@ -50,6 +51,12 @@ class CppRenderer(AbstractRenderer):
     def create_context(self):
         return Context()
 
+    def get_shared_name(self, xml):
+        tname = AbstractRenderer.get_shared_name(self, xml)
+        if tname:
+            self.dfproto_imports.add(SHARED_TYPES)
+        return tname
+
     def copy(self):
         mycopy = CppRenderer(self.ns, self.proto_ns, self.cpp_ns)
         AbstractRenderer.copy(self, mycopy)
@@ -63,11 +70,11 @@ class CppRenderer(AbstractRenderer):
 
     def render_type_enum(self, xml, tname=None):
         if not tname:
-            tname = xml.get('type-name')
+            tname = xml.type_name
             out  = self.ident(xml) + 'void %s::describe_%s(%s::%s* proto, df::%s* dfhack) {\n' % ( self.cpp_ns, tname, self.proto_ns, tname, tname )
         out += '  *proto = static_cast<dfproto::%s>(*dfhack);\n' % (tname)
         out += '}\n'
-        return out;
+        self.out.write(out)
 
     def _convert_enum(self, tname, names, array=False, is_ptr=False, anon=False):
         if is_ptr:
@@ -91,11 +98,11 @@ class CppRenderer(AbstractRenderer):
         # record enum descriptor for use later as a discriminator for an union
         self.last_enum_descr = xml
         names = self.get_name(xml)
-        tname = xml.get('type-name')
+        tname = xml.type_name
         if not tname:
             # local enum
             tname = self.outer_proto_tname() + '_' + self.get_typedef_name(xml, names[0])
-        return self.ident(xml) + self._convert_enum(tname, names)
+        self.out.write(self.ident(xml) + self._convert_enum(tname, names))
 
     def _convert_anon_enum(self, xml, name=None):
         if not name:
@@ -116,11 +123,11 @@ class CppRenderer(AbstractRenderer):
 
     def render_type_bitfield(self, xml, tname=None):
         if not tname:
-            tname = xml.get('type-name')
+            tname = xml.type_name
             out  = self.ident(xml) + 'void %s::describe_%s(%s::%s* proto, df::%s* dfhack) {\n' % ( self.cpp_ns, tname, self.proto_ns, tname, tname )
         out += '  proto->set_flags(dfhack->whole);\n'
         out += '}\n'
-        return out;
+        self.out.write(out)
 
     def _convert_bitfield(self, tname, names, array=False):
         return 'describe_%s(proto->%s_%s(), &dfhack->%s%s);\n' % (
@@ -131,7 +138,7 @@ class CppRenderer(AbstractRenderer):
     def render_field_bitfield(self, xml):
         names = self.get_name(xml)
         tname = self.get_typedef_name(xml)
-        return self.ident(xml) + self._convert_bitfield(tname, names)
+        self.out.write(self.ident(xml) + self._convert_bitfield(tname, names))
 
     def _convert_anon_bitfield(self, xml, name=None):
         if not name:
@@ -188,13 +195,13 @@ class CppRenderer(AbstractRenderer):
     
     def render_field_simple(self, xml, ctx):
         names = self.get_name(xml)
-        return self.ident(xml, ctx.ident) + self._convert_simple(names)
+        self.out.write(self.ident(xml, ctx.ident) + self._convert_simple(names))
     
     def render_field_global(self, xml, ctx):
         if not ctx.names:
             ctx.names = self.get_name(xml)
-        tname = xml.get('type-name')
-        subtype = xml.get(f'{self.ns}subtype')
+        tname = xml.type_name
+        subtype = xml.subtype
         if subtype == 'enum':
             self.imports.add(tname)
             self.dfproto_imports.add(tname)
@@ -203,9 +210,9 @@ class CppRenderer(AbstractRenderer):
             self.imports.add(tname)
         self.dfproto_imports.add(tname)
         self.imports.add(tname)
-        return self.ident(xml, ctx.ident) + self._convert_field_compound(
+        self.out.write(self.ident(xml, ctx.ident) + self._convert_field_compound(
             tname, ctx.names, deref=ctx.deref
-        )
+        ))
 
 
     # pointers and containers
@@ -213,79 +220,84 @@ class CppRenderer(AbstractRenderer):
     def render_field_pointer(self, xml, ctx):
         if not ctx.names:
             ctx.names = self.get_name(xml)
-        tname = xml.get('type-name')
+        tname = xml.type_name
         if self.is_primitive_type(tname):
-            return self._convert_simple(ctx.names, deref=True)
-        for k,v in iter(self.exceptions_index):
-            if k == tname:
-                # convert to an id
-                self.dfproto_imports.add(tname)
-                return self._convert_simple( (ctx.names[0]+'_'+v, ctx.names[1]+'->'+v) )
-        if len(xml):
-            meta = xml[0].get(f'{self.ns}meta')
+            self.out.write(self._convert_simple(ctx.names, deref=True))
+        elif tname in self.rules.index:
+            # convert to an id
+            v = self.rules.index[tname]
+            self.dfproto_imports.add(tname)
+            self.out.write(self._convert_simple( (ctx.names[0]+'_'+v, ctx.names[1]+'->'+v) ))
+        elif len(xml.items):
+            meta = xml.items[0].meta
             if meta=='static-array' or meta=='container':
                 # pointer to container
-                out = 'if (dfhack->%s != NULL) ' % (ctx.names[1])
-            else:
-                out = ''            
-            return out + self.render_field(xml[0], ctx.set_deref(True).dec_ident())
-        return self.ident(xml) + '/* ignored pointer to unknown type */\n'
+                self.out.write('if (dfhack->%s != NULL) ' % (ctx.names[1]))
+            yield from self.emit_field(xml.items[0], ctx.set_deref(True).dec_ident())
+        else:
+            self.out.write(self.ident(xml) + '/* ignored pointer to unknown type */\n')
 
     def render_field_container(self, xml, ctx):
         if ctx.names:
             names = ctx.names
         else:
             names = self.get_name(xml)
-        if len(xml) == 0:
-            return self.ident(xml) + '/* ignored empty container %s */\n' % (names[0])
+        if len(xml.items) == 0:
+            return self.out.write(self.ident(xml) + '/* ignored empty container %s */\n' % (names[0]))
 
-        subtype = xml.get(f'{self.ns}subtype')
+        subtype = xml.subtype
         if subtype == 'df-flagarray':
-            return self.ident(xml) + '/* ignored flagarray container %s */\n' % (names[0])
+            return self.out.write(self.ident(xml) + '/* ignored flagarray container %s */\n' % (names[0]))
         if subtype == 'stl-bit-vector':
-            return self.ident(xml) + '/* ignored stl-bit-vector container %s */\n' % (names[0])
+            return self.out.write(self.ident(xml) + '/* ignored stl-bit-vector container %s */\n' % (names[0]))
         if subtype == 'df-linked-list':
             return self.render_field_global(xml, ctx)
         
         deref = False
-        out = ''
+        out = self.out
         item_str = None
-        tname = xml.get('pointer-type')
+        tname = xml.pointer_type
         if tname:            
             if tname == 'bytes':
-                return self.ident(xml) + '/* ignored container of pointers to bytes %s */\n' % (names[0])
+                return out.write(self.ident(xml) + '/* ignored container of pointers to bytes %s */\n' % (names[0]))
             elif self.is_primitive_type(tname):
                 deref = True
             else:
                 self.imports.add(tname)
                 self.dfproto_imports.add(tname)
-                for k,v in iter(self.exceptions_index):
-                    if k == tname:
-                        # FIXME: handle ctx.deref
-                        item_str = 'proto->add_%s_%s(%sdfhack->%s[i]->%s);' % (
-                            names[0], v, '*' if deref else '', names[1], v
-                        )
+                if tname in self.rules.index:
+                    # FIXME: handle ctx.deref
+                    v = self.rules.index[tname]
+                    item_str = 'proto->add_%s_%s(%sdfhack->%s[i]->%s);' % (
+                        names[0], v, '*' if deref else '', names[1], v
+                    )
                 if not item_str:
                     item_str = self._convert_field_compound(
                         tname, names, array=True
                     )
         else:
-            meta = xml[0].get(f'{self.ns}meta')
-            subtype = xml[0].get(f'{self.ns}subtype')
-            tname = xml[0].get('type-name')
+            meta = xml.items[0].meta
+            subtype = xml.items[0].subtype
+            tname = xml.items[0].type_name
             if subtype == 'bitfield':
-                out += self._convert_anon_bitfield(xml[0], names[0])
-                tname = tname or 'T_'+names[0]
+                shared = self.get_shared_name(xml.items[0])
+                if not shared:
+                    out.write(self._convert_anon_bitfield(xml.items[0], names[0]))
+                tname = shared or tname or 'T_'+names[0]
                 item_str = self._convert_bitfield(tname, names, array=True)
-            elif subtype == 'enum' or tname and tname.endswith('_type') or tname in self.exceptions_enum:
+            elif subtype == 'enum' or tname and tname.endswith('_type') or tname in self.rules.enum:
                 if tname:
                     self.imports.add(tname)
                     self.dfproto_imports.add(tname)
                     ltname = tname
                 else:
-                    tname = 'T_' + names[0]
-                    ltname = '%s_%s' % (self.outer_proto_tname(), tname)
-                    out += self._convert_anon_enum(xml[0], names[0])
+                    tname = self.get_shared_name(xml.items[0])
+                    if tname:
+                        ltname = tname
+                    else:
+                        tname = 'T_' + names[0]
+                        ltname = '%s_%s' % (self.outer_proto_tname(), tname)
+                        out.write(self._convert_anon_enum(xml.items[0], names[0]))
                 item_str  = '  dfproto::%s value;\n' % (ltname)
                 item_str += '  describe_%s(&value, &dfhack->%s[i]);\n' % (tname, names[0])
                 item_str += '  proto->add_%s(value);\n' % (names[0])
@@ -293,23 +305,29 @@ class CppRenderer(AbstractRenderer):
                 item_str = self._convert_simple(names, array=True, is_ptr=ctx.deref)
             else:
                 if meta == 'pointer':
-                    if len(xml[0]) == 0:
-                        return self.ident(xml) + '/* ignored empty container %s */\n' % (names[0])
-                    out += self._convert_anon_compound(xml[0][0], names[0])
+                    if len(xml.items[0].items) == 0:
+                        return out.write(self.ident(xml) + '/* ignored empty container %s */\n' % (names[0]))
+                    tname = self.get_shared_name(xml.items[0].items[0])
+                    if not tname:
+                        tname = 'T_'+names[0]
+                        yield from self._convert_anon_compound(xml.items[0].items[0], names[0])
                     item_str = self._convert_field_compound(
-                        'T_'+names[0], names, array=True
+                        tname, names, array=True
                     )                    
                 elif meta == 'compound':
-                    out += self._convert_anon_compound(xml[0], names[0])
+                    tname = self.get_shared_name(xml.items[0])
+                    if not tname:
+                        tname = 'T_'+names[0]
+                        yield from self._convert_anon_compound(xml.items[0], names[0])
                     item_str = self._convert_field_compound(
-                        'T_'+names[0], names, array=True, deref=False
+                        tname, names, array=True, deref=False
                     )
                 elif meta=='container' or meta=='static-array':
-                    return '/* ignored container of %ss %s */\n' % (meta, names[0])
+                    return out.write('/* ignored container of %ss %s */\n' % (meta, names[0]))
                 else:
-                    tname = xml[0].get('type-name')
+                    tname = xml.items[0].type_name
                     if self.is_primitive_type(tname):
-                        return self.render_field(xml[0], Context(names[0]))
+                        return (yield from self.emit_field(xml.items[0], Context(names[0])))
                     self.imports.add(tname)
                     self.dfproto_imports.add(tname)
                     item_str = self._convert_field_compound(
@@ -320,33 +338,33 @@ class CppRenderer(AbstractRenderer):
             item_str = self._convert_simple(
                 names, deref, array=True, is_ptr=ctx.deref
             )
-        count = xml.get('count')
+        count = xml.count
         if not count:
             count = 'dfhack->%s%ssize()' % (names[1], '->' if ctx.deref else '.')
-        out += self.ident(xml) + 'for (size_t i=0; i<%s; i++) {\n' % (count)
-        out += self.ident(xml) + '  %s' % (item_str)
-        out += self.ident(xml) + '}\n'
-        return out
+        out.write(self.ident(xml) + 'for (size_t i=0; i<%s; i++) {\n' % (count))
+        out.write(self.ident(xml) + '  %s' % (item_str))
+        out.write(self.ident(xml) + '}\n')
     
     
     # structs
 
     def _render_struct_header(self, xml, tname, ctx):
-        return self.ident(xml) + 'void %s::describe_%s(%s::%s* proto, df::%s* dfhack) {\n' % ( self.cpp_ns, tname, self.proto_ns, tname, tname )
+        self.out.write(self.ident(xml) + 'void %s::describe_%s(%s::%s* proto, df::%s* dfhack) {\n' % ( self.cpp_ns, tname, self.proto_ns, tname, tname ))
     
     def _render_struct_footer(self, xml, ctx):
-        return '}\n'
+        self.out.write('}\n')
     
     def _render_struct_parent(self, xml, parent, ctx):
         self.dfproto_imports.add(parent)
-        return self.ident(xml) + '  describe_%s(proto->mutable_parent(), dfhack);\n' % ( parent )
+        self.out.write(self.ident(xml) + '  describe_%s(proto->mutable_parent(), dfhack);\n' % ( parent ))
 
     def _render_struct_field(self, item, value, ctx):
-        field = self.render_field(item, Context(value, ident=ctx.ident))
-        if field.lstrip().startswith('/*'):
-            field = ''
+        mark = self.out.mark()
+        yield from self.emit_field(item, Context(value, ident=ctx.ident))
+        if self.out.startswith(mark, '/*'):
+            self.out.cut(mark)
             value += 1
-        return field, value
+        return value
     
     def _convert_anon_compound(self, xml, name=None):
         if not name:
@@ -355,45 +373,44 @@ class CppRenderer(AbstractRenderer):
         rdr = self.copy()
         rdr.outer_types.append(tname)
         # lambda
-        out  = self.ident(xml) + 'auto describe_%s = [](dfproto::%s* proto, df::%s* dfhack) {\n' % (
+        self.out.write(self.ident(xml) + 'auto describe_%s = [](dfproto::%s* proto, df::%s* dfhack) {\n' % (
             tname, rdr.outer_proto_tname(), rdr.outer_dfhack_tname()
-        )
-        for item in xml.findall(f'{self.ns}field'):
-            out += rdr.render_field(item)
-        out += self.ident(xml) + '};\n'
-        return out
+        ))
+        yield from self.walk_fields(xml, lambda item: rdr.emit_field(item, Context()))
+        self.out.write(self.ident(xml) + '};\n')
 
     def render_field_compound(self, xml, ctx):
-        subtype = xml.get(f'{self.ns}subtype')
+        subtype = xml.subtype
         # if subtype == 'enum':
         #     return self.render_field_enum(xml)
         # if subtype == 'bitfield':
         #     return self.render_field_bitfield(xml)
         
-        anon = xml.get(f'{self.ns}anon-compound')
-        union = xml.get('is-union')
-        if union == 'true':
+        if xml.is_union:
             return self.render_field_union(xml)
 
         if not ctx.names:
             ctx.names = self.get_name(xml)
-        tname = self.get_typedef_name(xml, ctx.names[0])
+        shared = self.get_shared_name(xml)
+        tname = shared or self.get_typedef_name(xml, ctx.names[0])
         if subtype == 'enum':
-            out = self.copy()._convert_anon_enum(xml, ctx.names[0])
-            out += self.ident(xml) + self._convert_enum(
-                tname, ctx.names, anon=True
-            )
+            if not shared:
+                self.out.write(self.copy()._convert_anon_enum(xml, ctx.names[0]))
+            self.out.write(self.ident(xml) + self._convert_enum(
+                tname, ctx.names, anon=not shared
+            ))
         elif subtype == 'bitfield':
-            out = self.copy()._convert_anon_bitfield(xml, ctx.names[0])
-            out += self.ident(xml) + self._convert_bitfield(
+            if not shared:
+                self.out.write(self.copy()._convert_anon_bitfield(xml, ctx.names[0]))
+            self.out.write(self.ident(xml) + self._convert_bitfield(
                 tname, ctx.names
-            )
+            ))
         else:
-            out  = self.copy()._convert_anon_compound(xml, ctx.names[0])
-            out += self.ident(xml) + self._convert_field_compound(
+            if not shared:
+                yield from self.copy()._convert_anon_compound(xml, ctx.names[0])
+            self.out.write(self.ident(xml) + self._convert_field_compound(
                 tname, ctx.names, ctx.deref
-            )
-        return out
+            ))
     
 
     # unions
@@ -401,11 +418,11 @@ class CppRenderer(AbstractRenderer):
     def render_field_union(self, xml):
         names = self.get_name(xml)
         if self.last_enum_descr == None:
-            return '/* failed to find a discriminator for union %s */\n' % (self.get_typedef_name(xml, names[0]))
-        tname = self.last_enum_descr.get('type-name')
+            return self.out.write('/* failed to find a discriminator for union %s */\n' % (self.get_typedef_name(xml, names[0])))
+        tname = self.last_enum_descr.type_name
         ename = self.get_name(self.last_enum_descr)[1]
         out  = '  switch (dfhack->%s) {\n' % (ename)
-        for item in xml.findall(f'{self.ns}field'):
+        for item in xml.fields:
             iname = self.get_name(item)
             out += '    case ::df::enums::%s::%s:\n' % (tname, iname[1])
             out += '      proto->set_%s(dfhack->%s.%s);\n' % (iname[0], names[1], iname[1])
@@ -413,7 +430,7 @@ class CppRenderer(AbstractRenderer):
         out += '    default:\n'
         out += '      proto->clear_%s();\n' % (names[0])
         out += '  }\n'
-        return out
+        self.out.write(out)
 
 
     # conversion of type
@@ -421,28 +438,42 @@ class CppRenderer(AbstractRenderer):
     def render_field_conversion(self, xml, ctx=None):
         names = self.get_name(xml)
         tname = self.get_typedef_name(xml, names[0])
-        new_tname = xml.get('export-as')
+        new_tname = xml.export_as
         assert new_tname
         self.dfproto_imports.add('conversion')
-        return self.ident(xml) + 'convert_%s_to_%s(&dfhack->%s, proto->mutable_%s());\n' % (
+        self.out.write(self.ident(xml) + 'convert_%s_to_%s(&dfhack->%s, proto->mutable_%s());\n' % (
             tname, new_tname, names[0], names[0]
-        )
+        ))
     
 
     # main renderer
 
-    def render_field(self, xml, ctx=None):
-        if not ctx:
-            ctx = Context()
-        return self.render_field_impl(xml, ctx)
-
-    def render_type(self, xml):
-        self.outer_types.append(xml.get('type-name'))
-        return self.render_type_impl(xml)
+    def emit_type(self, xml):
+        self.outer_types.append(xml.type_name)
+        yield from self.render_type_impl(xml)
     
     def render_prototype(self, xml):
-        tname = xml.get('type-name')
+        tname = self.lower(xml).type_name
         return 'void describe_%s(%s::%s* proto, df::%s* dfhack);' % (
             tname, self.proto_ns, tname, tname
         )
     
+
+    def render_shared_prototype(self, tname):
+        return 'template <typename T> void describe_%s(dfproto::%s* proto, T* dfhack);' % (
+            tname, tname
+        )
+
+    def render_shared_type(self, xml, tname):
+        """Return the template converting a shared anonymous type, whatever its dfhack type."""
+        out = self.render_shared_prototype(tname)[:-1] + ' {\n'
+        if xml.subtype == 'enum':
+            out += '  *proto = static_cast<dfproto::%s>(*dfhack);\n' % (tname)
+        elif xml.subtype == 'bitfield':
+            out += '  proto->set_flags(dfhack->whole);\n'
+        else:
+            self.outer_types.append(tname)
+            mark = self.out.mark()
+            walk([self.walk_fields(xml, lambda item: self.emit_field(item, Context()))])
+            out += textwrap.indent(textwrap.dedent(self.out.pop(mark)), '  ')
+        return out + '}\n'
@@ -0,0 +1,278 @@
+#!/usr/bin/env python3
+#
+# Keep the generator scripts loaded between runs:
+# $ ./protogen.py serve --socket /tmp/protogen.sock &
+# $ ./client.py --socket /tmp/protogen.sock protogen --quiet df.history.xml
+#
+
+import sys
+import os
+import io
+import json
+import time
+import glob
+import base64
+import select
+import signal
+import socket
+import argparse
+import importlib
+import traceback
+import contextlib
+import socketserver
+
+try:
+    import fcntl
+except ImportError:
+    # no locking: clients should not start servers at once
+    fcntl = None
+
+import lowering
+import tracing
+
+# scripts a client may run, by name
+TOOLS = ['protogen', 'list', 'merge', 'dag', 'dependencies']
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+for path in [HERE, os.path.join(HERE, '..', 'protogen')]:
+    if path not in sys.path:
+        sys.path.append(path)
+
+# time to wait for the request of a new connection before serving it cold
+PEEK_TIMEOUT = 0.5
+
+
+def mtime(fname):
+    try:
+        return os.stat(fname).st_mtime_ns
+    except OSError:
+        return None
+
+
+def source_times():
+    """Modification times of the loaded modules of the generator."""
+    dirs = [HERE, os.path.abspath(os.path.join(HERE, '..', 'protogen'))]
+    times = {}
+    for mod in list(sys.modules.values()):
+        fname = getattr(mod, '__file__', None)
+        if fname and os.path.dirname(os.path.abspath(fname)) in dirs:
+            times[fname] = mtime(fname)
+    return times
+
+
+def run_tool(tool, argv, cwd, env=None):
+    """Run the main function of a script as if it were started from cwd.
+
+    env holds the environment variables of the client, None for the unset
+    ones. Return the exit code, stdout and stderr of the script."""
+    out = io.TextIOWrapper(io.BytesIO(), encoding='utf-8', write_through=True)
+    err = io.TextIOWrapper(io.BytesIO(), encoding='utf-8', write_through=True)
+    env = env or {}
+    saved = sys.argv, os.getcwd(), dict([(k, os.environ.get(k)) for k in env])
+    rc = 0
+    try:
+        os.chdir(cwd)
+        set_environ(env)
+        mod = importlib.import_module(tool)
+        sys.argv = [mod.__file__] + argv
+        with contextlib.redirect_stdout(out), contextlib.redirect_stderr(err):
+            try:
+                mod.main()
+            except SystemExit as e:
+                if e.code is None or isinstance(e.code, int):
+                    rc = e.code or 0
+                else:
+                    err.write('%s\n' % (e.code))
+                    rc = 1
+            except Exception:
+                traceback.print_exc()
+                rc = 1
+            # the trace file is an option of this run only
+            tracing.disable()
+    finally:
+        sys.argv = saved[0]
+        os.chdir(saved[1])
+        set_environ(saved[2])
+    return rc, out.buffer.getvalue(), err.buffer.getvalue()
+
+
+def peek_request(sock, timeout=PEEK_TIMEOUT):
+    """Return the request waiting on sock, leaving it to be read by the handler.
+
+    Return None if the whole request does not come within timeout."""
+    deadline = time.time() + timeout
+    data = b''
+    while b'\n' not in data:
+        left = deadline - time.time()
+        if left <= 0 or not select.select([sock], [], [], left)[0]:
+            return None
+        peeked = sock.recv(1 << 20, socket.MSG_PEEK)
+        if not peeked:
+            return None
+        if peeked == data:
+            # the rest of the line is still on its way
+            time.sleep(0.01)
+        data = peeked
+    try:
+        return json.loads(data.split(b'\n')[0].decode())
+    except ValueError:
+        return None
+
+
+def preload(tool, argv, cwd):
+    """Load the structures, stylesheets and graphs a request of tool will use.
+
+    The state is kept by this process, so that the children forked to serve
+    this and the later requests inherit it. Errors are left to the children
+    to report."""
+    saved = os.getcwd()
+    try:
+        os.chdir(cwd)
+        with contextlib.redirect_stdout(io.StringIO()), contextlib.redirect_stderr(io.StringIO()):
+            if tool == 'protogen' and argv[:1] not in [['build'], ['serve']]:
+                protogen = importlib.import_module('protogen')
+                args = protogen.make_parser().parse_args(argv)
+                for xslt in args.transform:
+                    lowering.compile_stylesheet(xslt)
+                if not args.stream:
+                    for f in sorted(glob.glob(protogen.input_pattern(args.input))):
+                        lowering.lower_structure(f, args.transform, args.cache)
+            elif tool == 'dag':
+                dag = importlib.import_module('dag')
+                for f in dag.make_parser().parse_args(argv).inputs:
+                    dag.read_edges(f)
+    except (Exception, SystemExit):
+        pass
+    finally:
+        os.chdir(saved)
+
+
+def set_environ(env):
+    for name, value in env.items():
+        if value is None:
+            os.environ.pop(name, None)
+        else:
+            os.environ[name] = value
+
+
+class GeneratorHandler(socketserver.StreamRequestHandler):
+    """Run one request: a json line with the tool, its arguments and the working directory."""
+
+    def handle(self):
+        request = json.loads(self.rfile.readline().decode())
+        if self.server.stopping:
+            # scripts have changed: let the client run them
+            self.reply({'restart': True})
+            return
+        if request.get('tool') not in TOOLS:
+            self.reply({'rc': 2, 'stdout': '', 'stderr': base64.b64encode(
+                ('unknown tool %s\n' % (request.get('tool'))).encode()
+            ).decode()})
+            return
+        rc, out, err = run_tool(request['tool'], request['argv'], request['cwd'], request.get('env'))
+        self.reply({
+            'rc': rc,
+            'stdout': base64.b64encode(out).decode(),
+            'stderr': base64.b64encode(err).decode(),
+        })
+
+    def reply(self, response):
+        self.wfile.write(json.dumps(response).encode() + b'\n')
+
+
+class GeneratorServer(socketserver.ForkingMixIn, socketserver.UnixStreamServer):
+    """Serve each request in a child process, so that runs share the loaded
+    scripts but not the working directory, the arguments or the output, and
+    run concurrently.
+
+    The server process keeps the lowered structures, the compiled stylesheets
+    and the dependency graphs of the requests, loaded before forking the
+    child serving each request."""
+
+    def __init__(self, path, idle_timeout, stylesheets=()):
+        super().__init__(path, GeneratorHandler)
+        self.idle_timeout = idle_timeout
+        self.last_request = time.time()
+        self.stopping = False
+        self.timeout = 1
+        for tool in TOOLS:
+            try:
+                importlib.import_module(tool)
+            except ImportError:
+                # e.g. dependencies.py without its generated parser
+                pass
+        lowering.keep_documents()
+        for xslt in stylesheets:
+            lowering.compile_stylesheet(xslt)
+        self.sources = source_times()
+
+    def process_request(self, request, client_address):
+        self.last_request = time.time()
+        if any([mtime(f) != t for f, t in self.sources.items()]):
+            # scripts have changed: stop after telling the client
+            self.stopping = True
+        if not self.stopping:
+            req = peek_request(request)
+            if isinstance(req, dict) and req.get('tool') in TOOLS:
+                preload(req['tool'], req.get('argv', []), req.get('cwd', '.'))
+        super().process_request(request, client_address)
+
+    def serve(self):
+        while not self.stopping:
+            self.handle_request()
+            self.collect_children()
+            if self.idle_timeout and not self.active_children \
+               and time.time() - self.last_request > self.idle_timeout:
+                break
+
+
+def main(argv=None):
+
+    # parse args
+    parser = argparse.ArgumentParser(prog='protogen.py serve',
+                                     description='Run the generator scripts for client.py, keeping '
+                                     'them loaded between runs.')
+    parser.add_argument('--socket', metavar='PATH', type=str,
+                        default='./protogen.sock',
+                        help='unix socket to listen to (default=./protogen.sock)')
+    parser.add_argument('--idle-timeout', metavar='SECONDS', type=int,
+                        default=600, help='stop after this time without requests, 0 for never (default=600)')
+    parser.add_argument('--transform', metavar='XSLT', type=str, action='append',
+                        default=[],
+                        help='compile this transform at startup (default=<none>)')
+    args = parser.parse_args(argv)
+
+    # held while the server runs, so that only one server starts for a socket
+    lock = open(args.socket + '.lock', 'a')
+    if fcntl:
+        try:
+            fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            sys.stderr.write('a server is already starting or listening to %s\n' % (args.socket))
+            sys.exit(1)
+    if os.path.exists(args.socket):
+        try:
+            with socket.socket(socket.AF_UNIX) as sock:
+                sock.connect(args.socket)
+            sys.stderr.write('a server is already listening to %s\n' % (args.socket))
+            sys.exit(1)
+        except ConnectionRefusedError:
+            # left by a server that did not stop cleanly
+            os.remove(args.socket)
+    # stop cleanly when terminated
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    try:
+        server = GeneratorServer(args.socket, args.idle_timeout, args.transform)
+        try:
+            server.serve()
+        finally:
+            server.server_close()
+            if os.path.exists(args.socket):
+                os.remove(args.socket)
+    finally:
+        os.remove(lock.name)
+        lock.close()
+
+
+if __name__ == "__main__":
+    main()
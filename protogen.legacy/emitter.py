@@ -0,0 +1,59 @@
+class Emitter:
+    """Output of a renderer, kept as a list of chunks and joined once.
+
+    Renderers, and the copies they make for nested types, write their output
+    in order into the same emitter. A position returned by mark gives access
+    to the output written since, without joining all of it."""
+
+    def __init__(self):
+        self.chunks = []
+
+    def write(self, *chunks):
+        self.chunks.extend(chunks)
+
+    def mark(self):
+        return len(self.chunks)
+
+    def reserve(self):
+        """Write an empty chunk and return its position, to fill it later."""
+        self.chunks.append('')
+        return len(self.chunks) - 1
+
+    def fill(self, pos, chunk):
+        self.chunks[pos] = chunk
+
+    def startswith(self, mark, prefix):
+        """Tell if the output since mark, stripped, starts with prefix.
+
+        prefix is looked for in the first chunk that is not blank."""
+        for i in range(mark, len(self.chunks)):
+            chunk = self.chunks[i].lstrip()
+            if chunk:
+                return chunk.startswith(prefix)
+        return False
+
+    def endswith(self, mark, suffix):
+        """Tell if the output since mark, stripped, ends with suffix.
+
+        suffix is looked for in the last chunk that is not blank."""
+        for i in range(len(self.chunks)-1, mark-1, -1):
+            chunk = self.chunks[i].rstrip()
+            if chunk:
+                return chunk.endswith(suffix)
+        return False
+
+    def is_empty(self, mark):
+        for i in range(mark, len(self.chunks)):
+            if self.chunks[i]:
+                return False
+        return True
+
+    def cut(self, mark):
+        """Remove and return the chunks written since mark."""
+        chunks = self.chunks[mark:]
+        del self.chunks[mark:]
+        return chunks
+
+    def pop(self, mark):
+        """Remove and return the output written since mark."""
+        return ''.join(self.cut(mark))
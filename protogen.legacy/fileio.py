@@ -0,0 +1,65 @@
+import os
+import gzip
+import threading
+import tempfile
+
+
+# current umask, applied to temporary files which are created 0600
+_UMASK = os.umask(0)
+os.umask(_UMASK)
+
+
+def write_if_changed(fname, content):
+    """Atomically replace fname with content, unless it already has this content.
+
+    Return True if the file was written, False if it was left untouched."""
+    if isinstance(content, str):
+        content = content.encode('utf-8')
+    try:
+        with open(fname, 'rb') as fil:
+            if fil.read() == content:
+                return False
+    except FileNotFoundError:
+        pass
+    dirname, basename = os.path.split(fname)
+    fd, tmpname = tempfile.mkstemp(prefix='.'+basename+'.', suffix='.tmp', dir=dirname or '.')
+    try:
+        with os.fdopen(fd, 'wb') as fil:
+            fil.write(content)
+        os.chmod(tmpname, 0o666 & ~_UMASK)
+        os.replace(tmpname, fname)
+    except BaseException:
+        os.remove(tmpname)
+        raise
+    return True
+
+
+class BackgroundWriter(threading.Thread):
+    """Write content to fname, gzipped if compress, in a separate thread.
+
+    content is bytes, or a function returning them, called in the thread.
+    join() re-raises the error of the write, if any."""
+
+    def __init__(self, fname, content, compress=False):
+        threading.Thread.__init__(self, name='write '+fname)
+        self.fname = fname
+        self.content = content
+        self.compress = compress
+        self.error = None
+        self.start()
+
+    def run(self):
+        try:
+            if callable(self.content):
+                self.content = self.content()
+            opener = gzip.open if self.compress else open
+            with opener(self.fname, 'wb') as fil:
+                fil.write(self.content)
+        except Exception as e:
+            self.error = e
+        self.content = None
+
+    def join(self, timeout=None):
+        threading.Thread.join(self, timeout)
+        if self.error:
+            raise self.error
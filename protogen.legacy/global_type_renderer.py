@@ -1,5 +1,22 @@
+from lxml import etree
+
+from abstract_renderer import SHARED_TYPES, walk
 from proto_renderer import ProtoRenderer
 from cpp_renderer import CppRenderer
+from fileio import write_if_changed
+import ir
+from rules import EMPTY, RuleCache, load_rules
+import profiling
+
+
+# matches of the rules in the last document rendered, shared by the renderers
+# given no cache of their own: the document is kept until another one is
+# rendered, callers that want it released set their own cache
+_rule_cache = RuleCache()
+
+
+def is_exported_type(item):
+    return item.get('export') == 'true' and 'global-type' in item.tag
 
 
 class GlobalTypeRenderer:
@@ -8,14 +25,21 @@ class GlobalTypeRenderer:
         self.ns = ns
         self.proto_ns = proto_ns
         self.version = 2
-        self.exceptions_rename = []
-        self.exceptions_ignore = []
-        self.exceptions_index = []
-        self.exceptions_enum = []
-        self.exceptions_depends = []
+        self.rules = EMPTY
         self.ignore_no_export = True
         self.comment_ignored = False
         self.xml = xml
+        # node of the type, shared by the renderers, and the rules and
+        # option its skipped fields were decided with
+        self.node = None
+        self.node_key = None
+        # matches of the rules in the document of the type, shared with the
+        # renderers of the other types of the document
+        self.rule_cache = _rule_cache
+        # anonymous types shared with other types, by name, with set_share_anon
+        self.shared = None
+        # generated files left untouched by the last call to render_to_files
+        self.unchanged = []
         assert self.xml.tag == '{%s}global-type' % (self.ns)
 
     def set_proto_version(self, ver):
@@ -23,22 +47,16 @@ class GlobalTypeRenderer:
         return self
 
     def set_exceptions_file(self, fname):
-        with open(fname, 'r') as fil:
-            for line in fil:
-                tokens = line.strip().split(' ')
-                if not tokens or tokens[0].startswith('#'):
-                    continue
-                if tokens[0] == 'rename':
-                    self.exceptions_rename.append(tokens)
-                elif tokens[0] == 'index':
-                    self.exceptions_index.append(tokens)
-                elif tokens[0] == 'ignore':
-                    self.exceptions_ignore.append(tokens)
-                elif tokens[0] == 'enum':
-                    self.exceptions_enum.append(tokens)
-                elif tokens[0] == 'depends':
-                    self.exceptions_depends.append((tokens[1], tokens[2]))
+        return self.set_rules(load_rules(fname))
+
+    def set_rules(self, rules):
+        self.rules = rules
+        return self
     
+    def set_rule_cache(self, cache):
+        self.rule_cache = cache
+        return self
+
     def set_ignore_no_export(self, b):
         self.ignore_no_export = b
         return self
@@ -46,6 +64,10 @@ class GlobalTypeRenderer:
     def set_comment_ignored(self, b):
         self.comment_ignored = b
         return self
+
+    def set_share_anon(self, b):
+        self.shared = {} if b else None
+        return self
     
     def get_type_name(self):
         tname = self.xml.get('type-name')
@@ -59,53 +81,65 @@ class GlobalTypeRenderer:
 
     def get_instance_vector(self):
         return self.xml.get('instance-vector')        
+
+    def get_node(self):
+        key = (self.rules, self.ignore_no_export)
+        if self.node is None or self.node_key != key:
+            self.node = ir.lower(self.xml, self.ns, self.rules, self.ignore_no_export, self.rule_cache)
+            self.node_key = key
+        return self.node
     
 
     # main renderer
 
-    def render_proto(self):
+    def _proto_renderer(self):
         rdr = ProtoRenderer(self.ns, self.proto_ns).set_version(self.version)
         rdr.set_comment_ignored(self.comment_ignored).set_ignore_no_export(self.ignore_no_export)
-        for tokens in self.exceptions_rename:
-            rdr.add_exception_rename(tokens[1], tokens[2])
-        for tokens in self.exceptions_ignore:
-            rdr.add_exception_ignore(tokens[1])
-        for tokens in self.exceptions_index:
-            rdr.add_exception_index(tokens[1], tokens[2])
-        typout = rdr.render_type(self.xml)
+        return rdr.set_rules(self.rules).set_shared(self.shared)
+
+    def _cpp_renderer(self):
+        rdr = CppRenderer(self.ns, self.proto_ns, 'DFProto')
+        rdr.set_comment_ignored(self.comment_ignored).set_ignore_no_export(self.ignore_no_export)
+        return rdr.set_rules(self.rules).set_shared(self.shared)
+
+    def _render_types(self, renderers):
+        """Render the type with each of the renderers, in a single walk of its node.
+
+        Return the output of each renderer."""
+        node = self.get_node()
+        walk([rdr.emit_type(node) for rdr in renderers])
+        return [rdr.out.pop(0) for rdr in renderers]
+
+    def render_proto(self):
+        rdr = self._proto_renderer()
+        return self._proto_file(rdr, *self._render_types([rdr]))
+
+    def _proto_file(self, rdr, typout):
         out  = '/* THIS FILE WAS GENERATED. DO NOT EDIT. */\n'
         out += 'syntax = "proto%d";\n' % (self.version)
         out += 'option optimize_for = LITE_RUNTIME;\n'
-        for imp in rdr.imports:
+        for imp in sorted(rdr.imports):
             if imp != self.get_type_name():
                 out += 'import \"%s.proto\";\n' % (imp)
         out += '\n' + typout
         return out
 
     def render_cpp(self):
-        rdr = CppRenderer(self.ns, self.proto_ns, 'DFProto')
-        rdr.set_comment_ignored(self.comment_ignored).set_ignore_no_export(self.ignore_no_export)
-        for tokens in self.exceptions_rename:
-            rdr.add_exception_rename(tokens[1], tokens[2])
-        for tokens in self.exceptions_index:
-            rdr.add_exception_index(tokens[1], tokens[2])
-        for tokens in self.exceptions_ignore:
-            rdr.add_exception_ignore(tokens[1])
-        for tokens in self.exceptions_enum:
-            rdr.add_exception_enum(tokens[1])
-        typout = rdr.render_type(self.xml)
+        rdr = self._cpp_renderer()
+        return self._cpp_file(rdr, *self._render_types([rdr]))
+
+    def _cpp_file(self, rdr, typout):
         out  = '/* THIS FILE WAS GENERATED. DO NOT EDIT. */\n'
         # this type may have hidden dependencies
-        for k,v in self.exceptions_depends:
-            if k == self.get_type_name():
-                out += '#include \"%s.h\"\n' % (v)
+        for v in self.rules.depends.get(self.get_type_name(), ()):
+            out += '#include \"%s.h\"\n' % (v)
         out += '#include \"%s.h\"\n' % (self.get_type_name())
         # protobuf and dfhack dependencies
-        for imp in rdr.imports:
+        for imp in sorted(rdr.imports):
             out += '#include \"df/%s.h\"\n' % (imp)
             out += '#include \"%s.pb.h\"\n' % (imp)
         # conversion code for other types
-        for imp in rdr.dfproto_imports:
+        for imp in sorted(rdr.dfproto_imports):
             out += '#include \"%s.h\"\n' % (imp)
         out += '\n' + typout
         return out
@@ -119,30 +153,110 @@ class GlobalTypeRenderer:
         out += '#include \"df/%s.h\"\n' % (self.get_type_name())
         out += '#include \"%s.pb.h\"\n' % (self.get_type_name())
         out += '\nnamespace DFProto {\n'
-        out += '  %s\n' % (rdr.render_prototype(self.xml))
+        out += '  %s\n' % (rdr.render_prototype(self.get_node()))
         out += '}\n'
         return out
 
-    def render_to_files(self, proto_out, cpp_out, h_out):
-        for k in self.exceptions_ignore:
-            found = self.xml.getroottree().xpath(k[1], namespaces={
-                'ld': self.ns,
-                're': 'http://exslt.org/regular-expressions'
-            })
-            if found and self.xml in found:
-                # ignore this type
-                return None
-
-        # generate code 
-        proto_name = self.get_type_name() + '.proto'
-        with open(proto_out + '/' + proto_name, 'w') as fil:
-            fil.write(self.render_proto())
+    def render_shared(self):
+        """Return the definitions of the anonymous types shared with other types, by name.
+
+        A definition is the proto message or enum, and the prototype and the
+        body of the c++ template converting it. Call after rendering the type."""
+        defs = {}
+        while self.shared and len(defs) < len(self.shared):
+            # shared types may contain other shared types
+            for tname, node in list(self.shared.items()):
+                if tname in defs:
+                    continue
+                proto = self._proto_renderer()
+                cpp = self._cpp_renderer()
+                defs[tname] = (proto.render_shared_type(node, tname),
+                               cpp.render_shared_prototype(tname), cpp.render_shared_type(node, tname))
+                assert not (proto.imports | cpp.imports | cpp.dfproto_imports) - set([SHARED_TYPES])
+        return defs
+
+    def is_ignored(self):
+        return self.get_node().ignored
+
+    def render(self):
+        """Yield the name and content of each generated file, as they are rendered.
+
+        The .proto and the .cpp are rendered together, in one walk of the
+        type. Nothing is yielded if the type is ignored."""
+        if self.is_ignored():
+            return
+        tname = self.get_type_name()
+        renderers = [self._proto_renderer()]
         if self.get_meta_type() in ['struct-type', 'class-type', 'enum-type', 'bitfield-type']:
-            cpp_name = self.get_type_name() + '.cpp'
-            with open(cpp_out + '/' + cpp_name, 'w') as fil:
-                fil.write(self.render_cpp())
-            h_name = self.get_type_name() + '.h'
-            with open(h_out + '/' + h_name, 'w') as fil:
-                fil.write(self.render_h())
-            return (proto_name, cpp_name, h_name)
-        return [proto_name]
+            renderers.append(self._cpp_renderer())
+        with profiling.step(tname, 'walk'):
+            outs = self._render_types(renderers)
+        yield tname + '.proto', self._proto_file(renderers[0], outs[0])
+        if len(renderers) > 1:
+            yield tname + '.cpp', self._cpp_file(renderers[1], outs[1])
+            with profiling.step(tname, 'h'):
+                content = self.render_h()
+            yield tname + '.h', content
+
+    def render_to_files(self, proto_out, cpp_out, h_out):
+        self.unchanged = []
+        if self.is_ignored():
+            return None
+        outdirs = {'.proto': proto_out, '.cpp': cpp_out, '.h': h_out}
+        fnames = []
+        for fname, content in self.render():
+            with profiling.step(self.get_type_name(), 'write'):
+                self._write_file(outdirs[fname[fname.rindex('.'):]], fname, content)
+            fnames.append(fname)
+        return fnames
+
+    def _write_file(self, outdir, fname, content):
+        if not write_if_changed(outdir + '/' + fname, content):
+            self.unchanged.append(fname)
+
+
+def render_shared_types(defs, version=2, proto_ns='dfproto'):
+    """Return the name and content of the proto file and of the c++ header of the shared anonymous types.
+
+    defs are the definitions returned by GlobalTypeRenderer.render_shared,
+    by name."""
+    proto  = '/* THIS FILE WAS GENERATED. DO NOT EDIT. */\n'
+    proto += 'syntax = "proto%d";\n' % (version)
+    proto += 'option optimize_for = LITE_RUNTIME;\n'
+    proto += '\npackage %s;\n' % (proto_ns)
+    h  = '/* THIS FILE WAS GENERATED. DO NOT EDIT. */\n'
+    h += '#include "%s.pb.h"\n' % (SHARED_TYPES)
+    h += '\nnamespace DFProto {\n'
+    for tname in sorted(defs):
+        h += '  %s\n' % (defs[tname][1])
+    for tname in sorted(defs):
+        proto += defs[tname][0]
+        h += '\n' + defs[tname][2]
+    h += '}\n'
+    return [(SHARED_TYPES + '.proto', proto), (SHARED_TYPES + '.h', h)]
+
+
+def render_artifacts(xml, exceptions=None, version=2, debug=False, types=None):
+    """Yield (type name, kind, content) for the files of the exported global types of a lowered structure.
+
+    kind is 'proto', 'cpp' or 'h'. Types are rendered one at a time, as the
+    results are consumed; nothing is written to disk. With types, only the
+    types with these names are rendered."""
+    root = xml.getroot() if hasattr(xml, 'getroot') else xml
+    # the rules are evaluated once per document, for all its types
+    cache = RuleCache()
+    for item in root:
+        if not isinstance(item.tag, str) or not is_exported_type(item):
+            continue
+        tname = item.get('type-name') or item.get('name')
+        if types is not None and tname not in types:
+            continue
+        rdr = GlobalTypeRenderer(item, etree.QName(item).namespace)
+        rdr.set_rule_cache(cache)
+        rdr.set_proto_version(version)
+        if debug:
+            rdr.set_comment_ignored(True)
+        if exceptions:
+            rdr.set_exceptions_file(exceptions)
+        for fname, content in rdr.render():
+            yield rdr.get_type_name(), fname[fname.rindex('.')+1:], content
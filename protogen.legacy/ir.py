@@ -0,0 +1,101 @@
+from lxml import etree
+
+from rules import EMPTY
+
+
+class Node:
+    """An element of a lowered global type, with its attributes and exceptions resolved.
+
+    Nodes only keep what the renderers use, can be pickled, and are built
+    once for both the proto and the cpp renderers. Whether a field is
+    exported is decided here, top-down: renderers do not change it."""
+
+    __slots__ = ('tag', 'meta', 'subtype', 'name', 'anon_name', 'type_name', 'typedef_name',
+                 'pointer_type', 'inherits_from', 'level', 'comment', 'count', 'value',
+                 'is_union', 'anon_compound', 'export', 'export_as', 'pbname', 'ignored',
+                 'dfname', 'skipped', 'shape', 'items', 'fields', 'enum_items')
+
+    def __init__(self, xml, ns, matches, ignore_no_export=True, exported=False):
+        attrs = xml.attrib
+        self.tag = etree.QName(xml).localname
+        self.meta = attrs.get('{%s}meta' % (ns))
+        self.subtype = attrs.get('{%s}subtype' % (ns))
+        self.name = attrs.get('name')
+        self.anon_name = attrs.get('{%s}anon-name' % (ns))
+        self.type_name = attrs.get('type-name')
+        self.typedef_name = attrs.get('{%s}typedef-name' % (ns))
+        self.pointer_type = attrs.get('pointer-type')
+        self.inherits_from = attrs.get('inherits-from')
+        level = attrs.get('{%s}level' % (ns))
+        self.level = int(level) if level else 1
+        self.comment = attrs.get('comment')
+        self.count = attrs.get('count')
+        self.value = attrs.get('value')
+        self.is_union = attrs.get('is-union') == 'true'
+        self.anon_compound = attrs.get('{%s}anon-compound' % (ns)) == 'true'
+        # 'true' for all the elements of an exported field
+        self.export = 'true' if exported else attrs.get('export')
+        self.export_as = attrs.get('export-as')
+        # exceptions: protobuf name, if renamed, and ignored element
+        self.pbname = matches.renamed.get(xml)
+        self.ignored = xml in matches.ignored
+        # set by the first renderer visiting the element, and reused by the
+        # others: dfhack name, including the number of anonymous elements
+        self.dfname = None
+        # digest of the elements of an anonymous type, set by the renderers
+        # sharing its definition, False if it refers to other types
+        self.shape = None
+        # field left out of the generated files
+        self.skipped = self.is_skipped(ignore_no_export)
+        # child elements, all of them and by kind
+        self.items = [Node(e, ns, matches, ignore_no_export, self.exports_items(exported))
+                      for e in xml if isinstance(e.tag, str)]
+        self.fields = [i for i in self.items if i.tag == 'field']
+        self.enum_items = [i for i in self.items if i.tag == 'enum-item']
+
+    def is_skipped(self, ignore_no_export):
+        name = self.name
+        export = self.export
+        if export==None and ignore_no_export:
+            return True
+        elif (name and name.startswith('unk_')) or (export and export == 'false'):
+            return True
+        # if (name and name.startswith('unk_')) or export!='true':
+        return self.ignored
+
+    def exports_items(self, exported):
+        # all the elements of a rendered field are exported with it
+        return exported or not (self.skipped or self.export_as)
+
+    def iter(self):
+        """Yield this element and all its descendants."""
+        yield self
+        for item in self.items:
+            yield from item.iter()
+
+
+class Type(Node):
+    """A global type of a lowered structure."""
+
+    __slots__ = ('instance_vector',)
+
+    def __init__(self, xml, ns, matches, ignore_no_export=True):
+        Node.__init__(self, xml, ns, matches, ignore_no_export)
+        self.instance_vector = xml.get('instance-vector')
+
+    def exports_items(self, exported):
+        # fields of a type are exported on their own
+        return False
+
+
+def lower(xml, ns, rules=EMPTY, ignore_no_export=True, cache=None):
+    """Return the node of an element of a lowered structure and of its descendants.
+
+    ns is the namespace of the ld prefix, rules the exceptions to resolve.
+    With ignore_no_export, fields with no export attribute are skipped.
+    With a RuleCache, the rules are evaluated once per document."""
+    ns = ns.strip('{}')
+    matches = cache.matches(rules, xml, ns) if cache else rules.matches(xml, ns)
+    if xml.tag == '{%s}global-type' % (ns):
+        return Type(xml, ns, matches, ignore_no_export)
+    return Node(xml, ns, matches, ignore_no_export)
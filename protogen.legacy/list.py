@@ -36,8 +36,12 @@ def main():
 
     # collect types and convert to filenames
     rc = 0
-    xml = etree.parse(infile)
-    for item in xml.getroot():
+    depth = 0
+    for event, item in etree.iterparse(infile, events=('start', 'end')):
+        # stream top-level elements and free each one once listed
+        depth += 1 if event == 'start' else -1
+        if event == 'start' or depth != 1:
+            continue
         try:
             tname = item.get('type-name')
             if item.tag not in ['struct-type', 'class-type', 'enum-type', 'bitfield-type', 'df-linked-list-type']:
@@ -57,6 +61,10 @@ def main():
             sys.stderr.write('error parsing type %s at line %d: %s\n' % (tname, item.sourceline if item.sourceline else 0, e))
             traceback.print_tb(tb)
             sys.exit(1)
+        finally:
+            item.clear()
+            while item.getprevious() is not None:
+                del item.getparent()[0]
 
 
 if __name__ == "__main__":
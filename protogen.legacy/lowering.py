@@ -0,0 +1,200 @@
+import os
+import re
+import copy
+import glob
+import hashlib
+import collections
+from lxml import etree
+
+from fileio import write_if_changed
+import profiling
+import tracing
+
+XSL_NS = 'http://www.w3.org/1999/XSL/Transform'
+
+# attributes of the xslt elements holding an xpath expression
+XPATH_ATTRIBUTES = ['select', 'test', 'use', 'value']
+# expressions in the attribute value templates of other attributes
+AVT = re.compile(r'\{([^{}]*)\}')
+# xpath constructs that may select other top-level definitions than the one
+# being transformed: absolute paths, keys, ids, and the axes to the nodes
+# that are neither ancestors nor descendants
+CROSS_XPATH = re.compile(r'(?:^|[\s(\[,|=<>])/|\b(?:key|id)\s*\(|\b(?:preceding|following)(?:-sibling)?::')
+
+# compiled stylesheets, by path and modification time
+_stylesheets = {}
+
+# lowered documents kept by a long running process, by path: (key, xml),
+# the most recently used last
+_documents = None
+# maximum number of kept documents
+_documents_limit = None
+
+
+def keep_documents(enabled=True, limit=64):
+    """Keep lowered documents in memory and return them to later calls.
+
+    The kept documents are shared, callers must not modify them.
+    Only the limit most recently used documents are kept."""
+    global _documents, _documents_limit
+    _documents = collections.OrderedDict() if enabled else None
+    _documents_limit = limit
+
+
+def compile_stylesheet(fname):
+    """Return the compiled XSLT of fname, compiled once per process."""
+    key = (os.path.abspath(fname), os.stat(fname).st_mtime_ns)
+    if key not in _stylesheets:
+        with profiling.phase('compile ' + os.path.basename(fname)):
+            _stylesheets[key] = etree.XSLT(etree.parse(fname))
+    return _stylesheets[key]
+
+
+def _stylesheet_files(fname, seen):
+    # yield the path and content of a stylesheet and of the stylesheets it imports or includes
+    fname = os.path.abspath(fname)
+    if fname in seen:
+        return
+    seen.add(fname)
+    with open(fname, 'rb') as fil:
+        content = fil.read()
+    yield fname, content
+    for elt in etree.fromstring(content).iter('{%s}import' % XSL_NS, '{%s}include' % XSL_NS):
+        href = elt.get('href')
+        if href and '://' not in href:
+            yield from _stylesheet_files(os.path.join(os.path.dirname(fname), href), seen)
+
+
+def lowering_key(fname, stylesheets):
+    """Digest of a structure file and of the stylesheets applied to it."""
+    h = hashlib.sha256()
+    h.update(etree.__version__.encode())
+    with open(fname, 'rb') as fil:
+        h.update(fil.read())
+    seen = set()
+    for xslt in stylesheets:
+        h.update(b'\0')
+        for _, content in _stylesheet_files(xslt, seen):
+            h.update(content)
+    return h.hexdigest()
+
+
+def cross_definition_lookups(stylesheets):
+    """Return the expressions of the stylesheets that may select other top-level definitions.
+
+    stream_structure transforms each definition alone, so that these
+    expressions would not find what they find in the whole structure file.
+    Match patterns are not checked: they only test the nodes they apply to."""
+    found = []
+    seen = set()
+    for xslt in stylesheets:
+        for fname, content in _stylesheet_files(xslt, seen):
+            for elt in etree.fromstring(content).iter(etree.Element):
+                xsl = etree.QName(elt).namespace == XSL_NS
+                for name, value in elt.attrib.items():
+                    exprs = [value] if xsl and name in XPATH_ATTRIBUTES else AVT.findall(value)
+                    for expr in exprs:
+                        if CROSS_XPATH.search(expr):
+                            found.append('%s:%d: %s' % (os.path.basename(fname), elt.sourceline, expr))
+    return found
+
+
+def lower_structure(fname, stylesheets, cache_dir=None, xml=None):
+    """Parse a structure file and apply the stylesheets to it.
+
+    xml is the already parsed content of fname, if any.
+    With a cache directory, the serialized result is saved there and reused
+    as long as the structure file and the stylesheets are unchanged.
+    With keep_documents(), the result is also kept in memory."""
+    with profiling.structure(fname):
+        if _documents is None or xml is not None:
+            return _lower_structure(fname, stylesheets, cache_dir, xml)
+        return _keep_document(fname, stylesheets, cache_dir)
+
+
+def _keep_document(fname, stylesheets, cache_dir):
+    path = os.path.abspath(fname)
+    key = lowering_key(fname, stylesheets)
+    if _documents.get(path, (None,))[0] != key:
+        _documents[path] = (key, _lower_structure(fname, stylesheets, cache_dir))
+    _documents.move_to_end(path)
+    while len(_documents) > _documents_limit:
+        _documents.popitem(last=False)
+    return _documents[path][1]
+
+
+def _lower_structure(fname, stylesheets, cache_dir=None, xml=None):
+    if not cache_dir or not stylesheets:
+        if xml is None:
+            with profiling.phase('parse', sites=True), tracing.span('parse', 'stage', file=fname):
+                xml = etree.parse(fname)
+        for xslt in stylesheets:
+            transform = compile_stylesheet(xslt)
+            with profiling.phase('transform ' + os.path.basename(xslt), sites=True), \
+                 tracing.span('transform ' + os.path.basename(xslt), 'stage', file=fname):
+                xml = transform(xml)
+        return xml
+
+    prefix = os.path.join(cache_dir, os.path.basename(fname))
+    cached = '%s.%s.xml' % (prefix, lowering_key(fname, stylesheets))
+    if os.path.exists(cached):
+        with profiling.phase('parse cache', sites=True), tracing.span('parse cache', 'stage', file=fname):
+            return etree.parse(cached, etree.XMLParser(huge_tree=True))
+    xml = _lower_structure(fname, stylesheets, xml=xml)
+    os.makedirs(cache_dir, exist_ok=True)
+    with profiling.phase('write cache'):
+        write_if_changed(cached, etree.tostring(xml))
+    # drop results for previous versions of the file
+    for old in glob.glob(glob.escape(prefix) + '.*.xml'):
+        if old != cached and len(old) == len(cached):
+            try:
+                os.remove(old)
+            except FileNotFoundError:
+                pass
+    return xml
+
+
+def type_document(root, item):
+    """Return a copy of item in a new document under a copy of root.
+
+    Exceptions xpaths evaluate on this document as on the full structure."""
+    doc = etree.Element(root.tag, attrib=root.attrib, nsmap=root.nsmap)
+    doc.append(copy.deepcopy(item))
+    return doc
+
+
+def stream_structure(fname, stylesheets, cache_dir=None):
+    """Yield the top-level definitions of a structure file, lowered one at a time.
+
+    Each definition is transformed in its own document and its source is
+    freed once the caller is done with it, so that memory use does not grow
+    with the size of the structure file. The result is the same as with
+    lower_structure only if the stylesheets have no cross_definition_lookups."""
+    if cache_dir and stylesheets:
+        cached = os.path.join(cache_dir, '%s.%s.xml' % (
+            os.path.basename(fname), lowering_key(fname, stylesheets)
+        ))
+        if os.path.exists(cached):
+            fname, stylesheets = cached, []
+    transforms = [compile_stylesheet(xslt) for xslt in stylesheets]
+    root = None
+    depth = 0
+    for event, elt in etree.iterparse(fname, events=('start', 'end'), huge_tree=True):
+        if event == 'start':
+            if root is None:
+                root = elt
+            depth += 1
+            continue
+        depth -= 1
+        if depth != 1:
+            continue
+        doc = type_document(root, elt)
+        for xslt, transform in zip(stylesheets, transforms):
+            with profiling.phase('transform ' + os.path.basename(xslt)):
+                doc = transform(doc).getroot()
+        for item in doc:
+            yield item
+        # free this definition and the ones before
+        elt.clear()
+        while elt.getprevious() is not None:
+            del root[0]
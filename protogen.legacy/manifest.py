@@ -0,0 +1,160 @@
+import os
+import json
+import hashlib
+from lxml import etree
+
+import abstract_renderer
+import proto_renderer
+import cpp_renderer
+import global_type_renderer
+import rules
+import ir
+import emitter
+from rules import load_rules, compile_xpath, xpath_type
+from fileio import write_if_changed
+
+
+def generator_version():
+    """Digest of the sources of the renderers, which define the generated code."""
+    h = hashlib.sha256()
+    for mod in [abstract_renderer, proto_renderer, cpp_renderer, global_type_renderer, rules, ir, emitter]:
+        with open(mod.__file__, 'rb') as fil:
+            h.update(fil.read())
+    return h.hexdigest()
+
+
+class TypeHasher:
+    """Compute the digest of global types of lowered documents.
+
+    The digest covers the xml subtree of the type, the exceptions rules that may
+    apply to it, the rendering options and the generator version."""
+
+    def __init__(self, exceptions=None, options=''):
+        self.rules = load_rules(exceptions).rules if exceptions else ()
+        self.common = hashlib.sha256()
+        self.common.update(generator_version().encode())
+        self.common.update(options.encode())
+        self.depends = {}
+        for tokens in self.rules:
+            line = ' '.join(tokens).encode()
+            if tokens[0] == 'depends':
+                self.depends.setdefault(tokens[1], []).append(line)
+            elif tokens[0] in ['index', 'enum']:
+                # types referring to these may be anywhere
+                self.common.update(line)
+            elif xpath_type(tokens[1]) is None:
+                # rename and ignore rules of no given type may apply to any type
+                self.common.update(line)
+        # rules matching elements of a type, by global type element of the last document
+        self.root = None
+        self.type_rules = {}
+
+    def _match_rules(self, root, ns):
+        self.root = root
+        self.type_rules = {}
+        for tokens in self.rules:
+            if tokens[0] not in ['rename', 'ignore'] or xpath_type(tokens[1]) is None:
+                continue
+            # rule applies to the types containing its matches
+            line = ' '.join(tokens).encode()
+            found = compile_xpath(tokens[1], ns)(root.getroottree())
+            for elt in found if isinstance(found, list) else []:
+                if not isinstance(elt, etree._Element):
+                    continue
+                while elt.getparent() is not None and elt.getparent() is not root:
+                    elt = elt.getparent()
+                rules = self.type_rules.setdefault(elt, [])
+                if line not in rules:
+                    rules.append(line)
+
+    def digest(self, item):
+        root = item.getroottree().getroot()
+        if root is not self.root:
+            self._match_rules(root, etree.QName(item).namespace)
+        h = self.common.copy()
+        h.update(etree.tostring(item, with_tail=False))
+        for line in self.type_rules.get(item, []):
+            h.update(line)
+        tname = item.get('type-name') or item.get('name')
+        for line in self.depends.get(tname, []):
+            h.update(line)
+        return h.hexdigest()
+
+
+class Manifest:
+    """Digests and generated files of the types of a structure, saved as json."""
+
+    def __init__(self, fname):
+        self.fname = fname
+        self.types = {}
+        if os.path.exists(fname):
+            try:
+                with open(fname, 'r') as fil:
+                    self.types = json.load(fil)['types']
+            except (ValueError, KeyError):
+                # corrupted manifest: regenerate everything
+                self.types = {}
+
+    def lookup(self, tname, digest):
+        """Return the entry of a type if it is up to date and its files still exist."""
+        entry = self.types.get(tname)
+        if not entry or entry['digest'] != digest:
+            return None
+        if not all([os.path.exists(f) for f in entry['files'] or []]):
+            return None
+        return entry
+
+    def update(self, tname, digest, files, vector):
+        self.types[tname] = {
+            'digest': digest,
+            'files': files,
+            'instance-vector': vector,
+        }
+
+    def remove(self, tname):
+        self.types.pop(tname, None)
+
+    def save(self):
+        return write_if_changed(self.fname, json.dumps(
+            {'types': self.types}, indent=1, sort_keys=True
+        ) + '\n')
+
+
+def _manifest_record(t):
+    record = dict(t, structure=os.path.abspath(t['structure']),
+                  files=[os.path.abspath(f) for f in t['files']])
+    if 'shared' in record:
+        # names of the shared anonymous types
+        record['shared'] = sorted(record['shared'])
+    return record
+
+
+def write_build_manifest(fname, structures, types, outputs):
+    """Write the json manifest of a run.
+
+    It lists the input structures, the generated files, instance vector and
+    dependencies of each type, and the other generated files."""
+    return write_if_changed(fname, json.dumps({
+        'structures': [os.path.abspath(f) for f in structures],
+        'types': dict([(t['type'], _manifest_record(t)) for t in types]),
+        'files': [os.path.abspath(f) for f in outputs],
+    }, indent=1, sort_keys=True) + '\n')
+
+
+def cmake_list(name, values):
+    return 'set(%s\n%s)\n' % (name, ''.join(['  "%s"\n' % (v) for v in values]))
+
+
+def write_cmake(fname, structures, types, outputs):
+    """Write a CMake include listing the inputs and the generated files of a run."""
+    by_ext = {}
+    for t in types:
+        for f in t['files']:
+            by_ext.setdefault(os.path.splitext(f)[1], set()).add(os.path.abspath(f))
+    return write_if_changed(fname, '# THIS FILE WAS GENERATED. DO NOT EDIT.\n'
+                            + cmake_list('PROTOGEN_STRUCTURES', [os.path.abspath(f) for f in structures])
+                            + cmake_list('PROTOGEN_TYPES', sorted(set([t['type'] for t in types if t['files']])))
+                            + cmake_list('PROTOGEN_PROTO_FILES', sorted(by_ext.get('.proto', [])))
+                            + cmake_list('PROTOGEN_SOURCE_FILES', sorted(by_ext.get('.cpp', [])))
+                            + cmake_list('PROTOGEN_HEADER_FILES', sorted(by_ext.get('.h', [])))
+                            + cmake_list('PROTOGEN_OUTPUTS', [os.path.abspath(f) for f in outputs]))
@@ -0,0 +1,227 @@
+import os
+import sys
+import time
+import cProfile
+import contextlib
+import tracemalloc
+
+try:
+    import resource
+except ImportError:
+    # no rss high-water mark on windows
+    resource = None
+
+# profile of this process, when profiling is enabled
+current = None
+
+
+def max_rss():
+    """Return the high-water mark of the resident memory of this process, in bytes."""
+    if not resource:
+        return 0
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss if sys.platform == 'darwin' else rss * 1024
+
+
+def _merge_peaks(table, other):
+    for key, (peak, rss) in other.items():
+        entry = table.setdefault(key, [0, 0])
+        entry[0] = max(entry[0], peak)
+        entry[1] = max(entry[1], rss)
+
+
+class Profile:
+    """Wall time of the phases of a run, and of the rendering steps of each type.
+
+    Phases may be nested: e.g. exceptions xpaths are evaluated while
+    rendering, and their time is also part of the rendering time.
+
+    With memory, also the peak of the python allocations traced by
+    tracemalloc and the growth of the rss high-water mark of the phases,
+    structure files and types. The rss also accounts for the trees of
+    libxml2, which tracemalloc does not see."""
+
+    def __init__(self, memory=False):
+        # calls and seconds, by phase name
+        self.phases = {}
+        # seconds by step name, by type name
+        self.types = {}
+        self.stats = None
+        # peak traced bytes and rss growth in bytes, by phase name, by
+        # structure file and by type name
+        self.memory = {} if memory else None
+        self.files = {}
+        self.type_memory = {}
+        # bytes allocated and still held at the end of a phase, by call site, by phase name
+        self.sites = {}
+        # rss high-water mark of the largest process
+        self.rss = 0
+        # [traced bytes at start, peak traced bytes] of the measures in progress
+        self._frames = []
+
+    def add_phase(self, name, seconds, calls=1):
+        phase = self.phases.setdefault(name, [0, 0.0])
+        phase[0] += calls
+        phase[1] += seconds
+
+    def add_step(self, tname, name, seconds):
+        steps = self.types.setdefault(tname, {})
+        steps[name] = steps.get(name, 0.0) + seconds
+        self.add_phase('render ' + name, seconds)
+
+    def add_sites(self, name, stats, top=10):
+        sites = self.sites.setdefault(name, {})
+        for stat in stats[:top]:
+            if stat.size_diff > 0:
+                site = '%s:%d' % (stat.traceback[0].filename, stat.traceback[0].lineno)
+                sites[site] = max(sites.get(site, 0), stat.size_diff)
+
+    @contextlib.contextmanager
+    def measure(self, table, key, sites=False):
+        """Record the peak memory of the body in table[key], with memory.
+
+        With sites, also record the call sites that allocated the most."""
+        if self.memory is None:
+            yield
+            return
+        before = tracemalloc.take_snapshot().filter_traces(_SNAPSHOT_FILTERS) if sites else None
+        # the peak of the enclosing measures, before it is reset for this one
+        peak = tracemalloc.get_traced_memory()[1]
+        for frame in self._frames:
+            frame[1] = max(frame[1], peak)
+        tracemalloc.reset_peak()
+        size = tracemalloc.get_traced_memory()[0]
+        frame = [size, size]
+        self._frames.append(frame)
+        rss = max_rss()
+        try:
+            yield
+        finally:
+            self._frames.pop()
+            frame[1] = max(frame[1], tracemalloc.get_traced_memory()[1])
+            for outer in self._frames:
+                outer[1] = max(outer[1], frame[1])
+            entry = table.setdefault(key, [0, 0])
+            entry[0] = max(entry[0], frame[1] - frame[0])
+            entry[1] = max(entry[1], max_rss() - rss)
+            if before is not None:
+                after = tracemalloc.take_snapshot().filter_traces(_SNAPSHOT_FILTERS)
+                self.add_sites(key, after.compare_to(before, 'lineno'))
+
+    @contextlib.contextmanager
+    def phase(self, name, sites=False):
+        start = time.perf_counter()
+        try:
+            with self.measure(self.memory, name, sites):
+                yield
+        finally:
+            self.add_phase(name, time.perf_counter() - start)
+
+    @contextlib.contextmanager
+    def step(self, tname, name):
+        start = time.perf_counter()
+        try:
+            with self.measure(self.memory, 'render ' + name), self.measure(self.type_memory, tname):
+                yield
+        finally:
+            self.add_step(tname, name, time.perf_counter() - start)
+
+    def merge(self, other):
+        """Add the times of a profile from a worker process."""
+        for name, (calls, seconds) in other.phases.items():
+            self.add_phase(name, seconds, calls)
+        for tname, steps in other.types.items():
+            for name, seconds in steps.items():
+                self.types.setdefault(tname, {})
+                self.types[tname][name] = self.types[tname].get(name, 0.0) + seconds
+        if self.memory is not None and other.memory is not None:
+            _merge_peaks(self.memory, other.memory)
+            _merge_peaks(self.files, other.files)
+            _merge_peaks(self.type_memory, other.type_memory)
+            for name, sites in other.sites.items():
+                for site, size in sites.items():
+                    self.sites.setdefault(name, {})
+                    self.sites[name][site] = max(self.sites[name].get(site, 0), size)
+        self.rss = max(self.rss, other.rss)
+
+    def report(self, out, top=10):
+        out.write('%-40s %8s %10s\n' % ('phase', 'calls', 'seconds'))
+        for name, (calls, seconds) in sorted(self.phases.items(), key=lambda p: -p[1][1]):
+            out.write('%-40s %8d %10.3f\n' % (name, calls, seconds))
+        steps = ['walk', 'h', 'write']
+        out.write('\n%-40s' % ('slowest types') + ''.join(['%8s' % (s) for s in steps + ['total']]) + '\n')
+        slowest = sorted(self.types.items(), key=lambda t: -sum(t[1].values()))[:top]
+        for tname, times in slowest:
+            out.write('%-40s' % (tname) + ''.join(['%8.3f' % (times.get(s, 0.0)) for s in steps])
+                      + '%8.3f\n' % (sum(times.values())))
+        if self.memory is not None:
+            self.report_memory(out, top)
+
+    def report_memory(self, out, top=10, sites=3):
+        def peaks(title, table):
+            out.write('\n%-40s %10s %10s\n' % (title, 'peak MiB', 'rss MiB'))
+            for key, (peak, rss) in sorted(table.items(), key=lambda e: -max(e[1]))[:top]:
+                out.write('%-40s %10.3f %10.3f\n' % (key, peak / MIB, rss / MIB))
+        peaks('phase', self.memory)
+        peaks('largest structure files', self.files)
+        peaks('largest types', self.type_memory)
+        out.write('\n%-40s %10s\n' % ('top call sites', 'MiB'))
+        for name in sorted(self.sites, key=lambda n: -self.memory.get(n, [0])[0]):
+            out.write('%s\n' % (name))
+            for site, size in sorted(self.sites[name].items(), key=lambda s: -s[1])[:sites]:
+                out.write('  %-38s %10.3f\n' % (site[-38:], size / MIB))
+        out.write('\nrss high-water mark of the largest process: %.2f MiB\n' % (self.rss / MIB))
+
+
+MIB = 1024 * 1024
+
+# leave the allocations of the profiler out of the call sites
+_SNAPSHOT_FILTERS = [
+    tracemalloc.Filter(False, tracemalloc.__file__),
+    tracemalloc.Filter(False, __file__),
+]
+
+
+def phase(name, sites=False):
+    """Time a phase of the run, if profiling is enabled.
+
+    With sites, also record the call sites allocating the most memory in
+    the phase, if memory profiling is enabled."""
+    return current.phase(name, sites) if current else contextlib.nullcontext()
+
+
+def step(tname, name):
+    """Time a rendering step of a type, if profiling is enabled."""
+    return current.step(tname, name) if current else contextlib.nullcontext()
+
+
+def structure(fname):
+    """Record the peak memory of processing a structure file, if memory profiling is enabled."""
+    return current.measure(current.files, os.path.basename(fname)) if current else contextlib.nullcontext()
+
+
+def enable(stats=False, memory=False):
+    """Start profiling this process, with cProfile if stats is true.
+
+    With memory, also trace the allocations with tracemalloc."""
+    global current
+    current = Profile(memory)
+    if memory and not tracemalloc.is_tracing():
+        tracemalloc.start()
+    if stats:
+        current.stats = cProfile.Profile()
+        current.stats.enable()
+    return current
+
+
+def disable():
+    """Stop profiling this process and return its profile."""
+    global current
+    profile, current = current, None
+    if profile and profile.stats:
+        profile.stats.disable()
+    if profile:
+        profile.rss = max(profile.rss, max_rss())
+    if profile and profile.memory is not None:
+        tracemalloc.stop()
+    return profile
@@ -1,8 +1,9 @@
 from collections import defaultdict
 import sys
 import traceback
+import textwrap
 
-from abstract_renderer import AbstractRenderer
+from abstract_renderer import AbstractRenderer, SHARED_TYPES, walk
 
 
 class Context:
@@ -63,6 +64,12 @@ class ProtoRenderer(AbstractRenderer):
         # return protobuf name
         return AbstractRenderer.get_name(self, xml)[0]
 
+    def get_shared_name(self, xml):
+        tname = AbstractRenderer.get_shared_name(self, xml)
+        if tname:
+            self.imports.add(SHARED_TYPES)
+        return tname
+
 
     # field item
         
@@ -87,15 +94,15 @@ class ProtoRenderer(AbstractRenderer):
 
     def render_type_enum(self, xml, tname=None, prefix=None, extra_ident=''):
         if not tname:            
-            tname = xml.get('type-name')
+            tname = xml.type_name
         assert tname
         out = self.ident(xml) + extra_ident + 'enum ' + tname + ' {\n'
         if prefix == None:
             prefix = tname + '_'
         value = 0
         postdecl = []
-        for item in xml.findall('enum-item'):
-            itemv = item.get('value')
+        for item in xml.enum_items:
+            itemv = item.value
             if itemv and int(itemv) < 0:
                 postdecl.append(self._render_enum_item(item, int(itemv), prefix))
             else:
@@ -108,31 +115,31 @@ class ProtoRenderer(AbstractRenderer):
         for line in postdecl:
             out += self.ident(xml) + extra_ident + '  ' + line
         out += self.ident(xml) + extra_ident + '}\n'
-        return out
+        self.out.write(out)
 
     def render_field_enum(self, xml, ctx):
         if not ctx.name:
             ctx.name = self.get_name(xml)
-        tname = xml.get('type-name')
+        tname = xml.type_name
         if tname:
             if not self.is_primitive_type(tname):
                 self.imports.add(tname)
-            out = ''
         else:
-            tname = self.get_typedef_name(xml, ctx.name)
-            out = self.render_type_enum(xml, tname, prefix=tname+'_', extra_ident='  ')
-        out += self._render_line(xml, tname, ctx) + '\n'
-        return out
+            tname = self.get_shared_name(xml)
+            if not tname:
+                tname = self.get_typedef_name(xml, ctx.name)
+                self.render_type_enum(xml, tname, prefix=tname+'_', extra_ident='  ')
+        self.out.write(self._render_line(xml, tname, ctx) + '\n')
 
     
     # bitfields
 
     def _render_masks(self, xml):
-        if len(xml) == 0:
+        if len(xml.items) == 0:
             return '\n'
         out = self.ident(xml) + '  enum mask {\n'
         value = 0
-        for item in xml.findall(f'{self.ns}field'):
+        for item in xml.fields:
             out += self.ident(item) + '  %s = 0x%x;' % (
                 self.get_name(item), value
             )
@@ -143,7 +150,7 @@ class ProtoRenderer(AbstractRenderer):
     
     def render_type_bitfield(self, xml, tname=None):
         if not tname:
-            tname = xml.get('type-name')
+            tname = xml.type_name
         assert tname
         ident = self.ident(xml)
         out  = ident + 'message ' + tname + ' {\n'
@@ -151,16 +158,19 @@ class ProtoRenderer(AbstractRenderer):
         out += ident + '  required fixed32 flags = 1;'
         out  = self.append_comment(xml, out)
         out += ident + '}\n'
-        return out
+        self.out.write(out)
     
     def render_field_bitfield(self, xml, ctx, tname=None):
         if not ctx.name:
             ctx.name = self.get_name(xml)
-        if not tname:
-            tname = self.get_typedef_name(xml, ctx.name)
-        out  = self.copy().render_type_bitfield(xml, tname)
-        out += self._render_line(xml, tname, ctx)
-        return out
+        shared = self.get_shared_name(xml)
+        if shared:
+            tname = shared
+        else:
+            if not tname:
+                tname = self.get_typedef_name(xml, ctx.name)
+            self.copy().render_type_bitfield(xml, tname)
+        self.out.write(self._render_line(xml, tname, ctx))
 
     
     # simple fields
@@ -175,25 +185,25 @@ class ProtoRenderer(AbstractRenderer):
         return tname
 
     def render_field_simple(self, xml, ctx):
-        tname = xml.get(f'{self.ns}subtype')
+        tname = xml.subtype
         if tname == 'enum' or tname == 'bitfield':
-            tname = xml.get('type-name')
+            tname = xml.type_name
             self.imports.add(tname)
         else:
             tname = self._convert_tname(tname)
-        return self._render_line(xml, tname, ctx)
+        self.out.write(self._render_line(xml, tname, ctx))
     
     def render_field_global(self, xml, ctx):
-        tname = xml.get('type-name')
+        tname = xml.type_name
         assert tname
         self.imports.add(tname)
-        return self._render_line(xml, tname, ctx)
+        self.out.write(self._render_line(xml, tname, ctx))
 
 
     # converted type
     
     def render_field_conversion(self, xml, ctx):
-        return self._render_line(xml, xml.get('export-as'), ctx)
+        self.out.write(self._render_line(xml, xml.export_as, ctx))
         
     
     # pointers and containers
@@ -204,158 +214,164 @@ class ProtoRenderer(AbstractRenderer):
         if not ctx.name:
             ctx.name = self.get_name(xml)
         ctx.dec_ident()            
-        tname = xml.get('type-name')
+        tname = xml.type_name
         if tname == None:
-            if len(xml):
-                return self.render_field(xml[0], ctx)
+            if len(xml.items):
+                yield from self.emit_field(xml.items[0], ctx)
             else:
-                return self.ident(xml) + '/* ignored pointer to unknown type */\n'
-        if self.is_primitive_type(tname):
+                self.out.write(self.ident(xml) + '/* ignored pointer to unknown type */\n')
+        elif self.is_primitive_type(tname):
             tname = self.convert_type(tname)
-            return self._render_line(xml, tname, ctx)
+            self.out.write(self._render_line(xml, tname, ctx))
         # replace type with an id ?
-        for k,v in iter(self.exceptions_index):
-            if k == tname:
-                key = '_'+v
-                return self._render_line(xml, 'int32', ctx.set_name(ctx.name+key))
-        return self.render_field(xml[0], ctx)
+        elif tname in self.rules.index:
+            key = '_'+self.rules.index[tname]
+            self.out.write(self._render_line(xml, 'int32', ctx.set_name(ctx.name+key)))
+        else:
+            yield from self.emit_field(xml.items[0], ctx)
 
     def render_field_container(self, xml, ctx):
         if not ctx.name:
             ctx.name = self.get_name(xml)
-        if xml.get(f'{self.ns}subtype') == 'df-linked-list':
+        if xml.subtype == 'df-linked-list':
             return self.render_field_global(xml, ctx)
-        tname = xml.get('pointer-type')
+        tname = xml.pointer_type
         if tname and not self.is_primitive_type(tname):
-            return self.render_field_pointer(xml[0], ctx.set_keyword('repeated'))            
+            return (yield from self.render_field_pointer(xml.items[0], ctx.set_keyword('repeated')))
         if not tname:
-            tname = xml.get('type-name')
+            tname = xml.type_name
         if tname == 'pointer':
             # convert to list of refs to avoid circular dependencies
             tname = 'int32'
-        if not tname and len(xml) > 0:
-            tname = xml[0].get('type-name') or 'T_'+ctx.name
-            subtype = xml[0].get(f'{self.ns}subtype')
-            meta = xml[0].get(f'{self.ns}meta')
+        if not tname and len(xml.items) > 0:
+            tname = xml.items[0].type_name or 'T_'+ctx.name
+            subtype = xml.items[0].subtype
+            meta = xml.items[0].meta
             if meta == 'pointer':
-                out = self.render_field_pointer(xml[0], ctx.set_keyword('repeated'))
+                yield from self.render_field_pointer(xml.items[0], ctx.set_keyword('repeated'))
             elif meta=='container' or meta=='static-array':
-                return '/* ignored container of containers %s */\n' % (ctx.name)
+                self.out.write('/* ignored container of containers %s */\n' % (ctx.name))
             elif subtype == 'bitfield':
                 # local anon bitfield
-                out = self.render_field_bitfield(xml[0], ctx.set_keyword('repeated'), tname)
+                self.render_field_bitfield(xml.items[0], ctx.set_keyword('repeated'), tname)
             elif subtype == 'enum':
-                out = self.render_field_enum(xml[0], ctx.set_keyword('repeated'))
+                self.render_field_enum(xml.items[0], ctx.set_keyword('repeated'))
             elif self.is_primitive_type(subtype):
                 tname = self.convert_type(subtype)
-                out = self._render_line(xml[0], tname, ctx.set_keyword('repeated'))
-            elif xml[0].get('type-name'):
-                tname = xml[0].get('type-name')
+                self.out.write(self._render_line(xml.items[0], tname, ctx.set_keyword('repeated')))
+            elif xml.items[0].type_name:
+                tname = xml.items[0].type_name
                 self.imports.add(tname)
-                out = self._render_line(xml[0], tname, ctx.set_keyword('repeated'))
+                self.out.write(self._render_line(xml.items[0], tname, ctx.set_keyword('repeated')))
             else:
                 # local anon compound
-                tname = 'T_'+ctx.name
-                out  = self.copy().render_type_struct(xml[0], tname, ctx)
-                out += self._render_line(xml[0], tname, ctx.set_keyword('repeated'))
-            return out
+                tname = self.get_shared_name(xml.items[0])
+                if not tname:
+                    tname = 'T_'+ctx.name
+                    yield from self.copy().render_type_struct(xml.items[0], tname, ctx)
+                self.out.write(self._render_line(xml.items[0], tname, ctx.set_keyword('repeated')))
         elif self.is_primitive_type(tname):
             tname = self._convert_tname(tname)
-            return self._render_line(xml, tname, ctx.set_keyword('repeated'))
-        elif len(xml):
-            return self.render_field(xml[0], ctx.set_keyword('repeated'))
-        # container of unknown type
-        return '  /* ignored container %s */\n' % (ctx.name)
+            self.out.write(self._render_line(xml, tname, ctx.set_keyword('repeated')))
+        elif len(xml.items):
+            yield from self.emit_field(xml.items[0], ctx.set_keyword('repeated'))
+        else:
+            # container of unknown type
+            self.out.write('  /* ignored container %s */\n' % (ctx.name))
         
     
     # structs
 
     def _render_struct_header(self, xml, tname, ctx):
-        out = self.ident(xml, ctx.ident) + 'message ' + tname + ' {\n'
-        return out
+        self.out.write(self.ident(xml, ctx.ident) + 'message ' + tname + ' {\n')
     
     def _render_struct_footer(self, xml, ctx):
-        out = self.ident(xml, ctx.ident) + '}\n'
-        return out
+        self.out.write(self.ident(xml, ctx.ident) + '}\n')
     
     def _render_struct_parent(self, xml, parent, ctx):
-        out  = self.ident(xml, ctx.ident+1) + '/* parent type */\n'
-        out += self._render_line(xml, parent, ctx.set_name('parent').inc_ident())
+        self.out.write(self.ident(xml, ctx.ident+1) + '/* parent type */\n')
+        self.out.write(self._render_line(xml, parent, ctx.set_name('parent').inc_ident()))
         self.imports.add(parent)
-        return out
 
     def _render_struct_field(self, item, value, ctx):
-        field = self.render_field(item, Context(value, ident=ctx.ident))
-        if item.get('is-union'):
-            value += len(item)
+        yield from self.emit_field(item, Context(value, ident=ctx.ident))
+        if item.is_union:
+            value += len(item.items)
         else:
             value += 1
-        return field, value
+        return value
 
     def render_field_compound(self, xml, ctx):
-        subtype = xml.get(f'{self.ns}subtype')
+        subtype = xml.subtype
         if subtype == 'enum':
             return self.render_field_enum(xml, ctx)
         if subtype == 'bitfield':
             return self.render_field_bitfield(xml, ctx)
         
-        anon = xml.get(f'{self.ns}anon-compound')
-        union = xml.get('is-union')
-        if union == 'true':
-            if anon == 'true':
-                return self.render_field_union(xml, 'anon', ctx.value)
-            return self.render_field_union(xml, self.get_name(xml), ctx.value)
-        if anon == 'true':
-            return self.render_type_struct(xml, 'T_anon', ctx)
+        if xml.is_union:
+            if xml.anon_compound:
+                return (yield from self.render_field_union(xml, 'anon', ctx.value))
+            return (yield from self.render_field_union(xml, self.get_name(xml), ctx.value))
+        if xml.anon_compound:
+            return (yield from self.render_type_struct(xml, 'T_anon', ctx))
 
         if not ctx.name:
             ctx.name = self.get_name(xml)
-        tname = self.get_typedef_name(xml, ctx.name)
-        out  = self.copy().render_type_struct(xml, tname)
-        out += self._render_line(xml, tname, ctx)
-        return out
+        tname = self.get_shared_name(xml)
+        if not tname:
+            tname = self.get_typedef_name(xml, ctx.name)
+            yield from self.copy().render_type_struct(xml, tname)
+        self.out.write(self._render_line(xml, tname, ctx))
     
 
     # unions
 
     def render_field_union(self, xml, tname, value=1):
-        fields = ''
-        predecl = []
-        for item in xml.findall(f'{self.ns}field'):
+        # nested types are declared before the oneof, in order
+        fields = []
+        for item in xml.fields:
             ctx = Context(value, keyword='')
-            meta = item.get(f'{self.ns}meta')
+            meta = item.meta
             if meta == 'compound':
                 itname = self.get_type_name(item)
-                predecl += self.copy().render_type_struct(item, tname=itname, ctx=ctx)
-                fields += self._render_line(item, itname, ctx)
+                yield from self.copy().render_type_struct(item, tname=itname, ctx=ctx)
+                fields.append(self._render_line(item, itname, ctx))
             else:
-                fields += self.render_field_simple(item, ctx)
+                mark = self.out.mark()
+                self.render_field_simple(item, ctx)
+                fields += self.out.cut(mark)
             value += 1
-        out = ''
-        for decl in predecl:
-            out += decl
-        out += self.ident(xml) + 'oneof ' + tname + ' {\n'
-        out += fields
-        out += self.ident(xml) + '}\n'
-        return out
+        self.out.write(self.ident(xml) + 'oneof ' + tname + ' {\n')
+        self.out.write(*fields)
+        self.out.write(self.ident(xml) + '}\n')
     
 
     # main renderer
 
-    def render_field(self, xml, ctx=None):
-        if not ctx:
-            ctx = Context()
-        field = self.render_field_impl(xml, ctx)
-        if len(field) and not field.rstrip().endswith('*/') and xml.get('comment'):
-            comment = self.ident(xml) + self.append_comment(xml)
-            return self.ident(xml, ctx.ident) + '%s%s' % (comment, field)
-        return field
+    def emit_field(self, xml, ctx):
+        # comment line of the field, written before it if it is rendered
+        comment = self.out.reserve()
+        yield from self.render_field_impl(xml, ctx)
+        if not self.out.is_empty(comment) and not self.out.endswith(comment, '*/') and xml.comment:
+            self.out.fill(comment, self.ident(xml, ctx.ident) + self.ident(xml) + self.append_comment(xml))
 
-    def render_type(self, xml):
+    def emit_type(self, xml):
         if self.proto_ns:
             out = 'package ' + self.proto_ns + ';\n'
         else:
             out = ''
-        if xml.get('comment'):
+        if xml.comment:
             out = self.append_comment(xml, out)
-        return out + self.render_type_impl(xml)
+        self.out.write(out)
+        yield from self.render_type_impl(xml)
+
+    def render_shared_type(self, xml, tname):
+        """Return the top-level definition of a shared anonymous type."""
+        mark = self.out.mark()
+        if xml.subtype == 'enum':
+            self.render_type_enum(xml, tname)
+        elif xml.subtype == 'bitfield':
+            self.render_type_bitfield(xml, tname)
+        else:
+            walk([self.render_type_struct(xml, tname)])
+        return textwrap.dedent(self.out.pop(mark))
@@ -10,14 +10,32 @@ import argparse
 import re
 import os
 import glob
+import io
+import collections
+import multiprocessing
 from lxml import etree
 
-from global_type_renderer import GlobalTypeRenderer
+from global_type_renderer import GlobalTypeRenderer, is_exported_type, render_shared_types
+from abstract_renderer import SHARED_TYPES
+from fileio import write_if_changed, BackgroundWriter
+from manifest import Manifest, TypeHasher, write_build_manifest, write_cmake
+from code_size import write_size_report
+from rules import load_rules, RuleCache
+import lowering
+import profiling
+import tracing
+from lowering import lower_structure, stream_structure, type_document
+from type_graph import type_graph, type_dependencies, closure
+from watch import Watcher
 
 COLOR_OKBLUE = '\033[94m'
 COLOR_FAIL = '\033[91m'
 COLOR_ENDC = '\033[0m'
 
+# types sent to each worker process ahead of the results, to bound the
+# serialized documents held at once
+PENDING_TYPES_PER_JOB = 2
+
 def snakeToCamelCase(string):
     string = string[0].upper() + string[1:]
     return re.sub(
@@ -32,12 +50,318 @@ def luaToCpp(string):
     string = string.replace('world_data.', 'world_data->')
     return string
 
-def main():
-    
-    # parse args
-    parser = argparse.ArgumentParser(description='Generate protobuf and conversion code from dfhack structures.')
-    parser.add_argument('input', metavar='DIR|FILE', type=str,
-                        help='input directory or xml file (default=.)')
+def output_path(fname, args):
+    outdir = {
+        '.proto': args.proto_out, '.cpp': args.cpp_out, '.h': args.h_out,
+    }[os.path.splitext(fname)[1]]
+    return outdir + '/' + fname
+
+
+class TypeJob:
+    """Rendering of a top-level definition of a structure file.
+
+    Jobs hold no reference to the xml, so that they can be sent to worker
+    processes and outlive the element in streaming mode."""
+
+    def __init__(self, item, selection=None):
+        self.tname = item.get('type-name') or item.get('name')
+        self.line = item.sourceline or 0
+        self.exported = is_exported_type(item) and (selection is None or self.tname in selection)
+        self.ns = etree.QName(item).namespace if self.exported else None
+        self.depends = sorted(type_dependencies(item)) if self.exported else None
+        # digest and manifest entry, with --incremental
+        self.digest = None
+        self.entry = None
+        # standalone document of the type, for worker processes
+        self.data = None
+        # results
+        self.fnames = None
+        self.unchanged = 0
+        self.vector = None
+        # definitions of the shared anonymous types, with --share-anon
+        self.shared = None
+        self.error = None
+        # times of the worker process, with --profile
+        self.profile = None
+
+    def needs_rendering(self):
+        return self.exported and not self.entry
+
+    def render(self, item, args, cache=None):
+        with tracing.span(self.tname, 'type'):
+            return self._render(item, args, cache)
+
+    def _render(self, item, args, cache):
+        try:
+            rdr = GlobalTypeRenderer(item, self.ns)
+            rdr.set_rule_cache(cache)
+            rdr.set_proto_version(args.version)
+            if args.debug:
+                rdr.set_comment_ignored(True)
+            if args.exceptions:
+                rdr.set_exceptions_file(args.exceptions)
+            rdr.set_share_anon(args.share_anon)
+            self.fnames = rdr.render_to_files(args.proto_out, args.cpp_out, args.h_out)
+            if args.share_anon:
+                self.shared = rdr.render_shared()
+            self.tname = rdr.get_type_name()
+            self.unchanged = len(rdr.unchanged)
+            self.vector = rdr.get_instance_vector()
+        except Exception as e:
+            self.error = (str(e), ''.join(traceback.format_tb(sys.exc_info()[2])))
+        return self
+
+def _render_type_job(job):
+    job, args = job
+    if job.data:
+        if args.profile:
+            profiling.enable(memory=args.profile_memory)
+        job.render(etree.fromstring(job.data)[0], args)
+        job.data = None
+        job.profile = profiling.disable()
+        tracing.flush()
+    return job
+
+def render_global_types(items, args, manifest=None, hasher=None):
+    """Yield a job for each of the top-level definitions, in order.
+
+    Exported types are rendered, unless they are up to date in the manifest."""
+    def jobs():
+        for item in items:
+            job = TypeJob(item, args.selection)
+            if job.exported and manifest:
+                with profiling.phase('digest'):
+                    job.digest = hasher.digest(item)
+                    job.entry = manifest.lookup(job.tname, job.digest)
+            yield item, job
+
+    if args.jobs == 1:
+        # the rules are evaluated once per document, for all its types
+        cache = RuleCache()
+        for item, job in jobs():
+            if job.needs_rendering():
+                job.render(item, args, cache)
+            yield job
+        return
+
+    def pack(item, job):
+        if job.needs_rendering():
+            job.data = etree.tostring(type_document(item.getroottree().getroot(), item))
+        return job, args
+    def result(pending):
+        job = pending.popleft().get()
+        if job.profile and profiling.current:
+            profiling.current.merge(job.profile)
+        return job
+    limit = PENDING_TYPES_PER_JOB * (args.jobs or os.cpu_count() or 1)
+    pending = collections.deque()
+    with multiprocessing.Pool(args.jobs or None) as pool:
+        for item, job in jobs():
+            pending.append(pool.apply_async(_render_type_job, (pack(item, job),)))
+            if len(pending) >= limit:
+                yield result(pending)
+        while pending:
+            yield result(pending)
+
+def process_file(f, args, out=None, err=None, xml=None):
+    """Parse, transform and render a structure file, or its already transformed xml.
+
+    Return the exit code, the instance vectors of the rendered types, the
+    numbers of generated files written and left unchanged, and a record of
+    the generated files, instance vector and dependencies of each type."""
+    with tracing.span('process ' + os.path.basename(f), 'file', file=f), profiling.structure(f):
+        return _process_file(f, args, out or sys.stdout, err or sys.stderr, xml)
+
+def _process_file(f, args, out, err, xml):
+    if not args.quiet:
+        out.write(COLOR_OKBLUE + 'processing %s...\n' % (f) + COLOR_ENDC)
+
+    # xml with all types of the structure
+    struct_name = re.compile('df.(.*).xml').match(os.path.basename(f)).group(1)
+    assert struct_name
+
+    dump = None
+    if args.stream:
+        items = stream_structure(f, args.transform, args.cache)
+    else:
+        if xml is None:
+            xml = lower_structure(f, args.transform, args.cache)
+        items = xml.getroot()
+        if args.dump_xml or args.dump_gzip:
+            # serialize and write while rendering: renderers do not modify the
+            # xml, and lxml releases the GIL while serializing
+            dump = BackgroundWriter(
+                args.proto_out+'/df.%s.out.xml%s' % (struct_name, '.gz' if args.dump_gzip else ''),
+                lambda: etree.tostring(xml), args.dump_gzip
+            )
+
+    # with --incremental, skip types whose digest is in the manifest
+    manifest = hasher = None
+    if args.incremental:
+        manifest = Manifest(args.proto_out+'/df.%s.manifest.json' % (struct_name))
+        hasher = TypeHasher(args.exceptions, options='%d %s' % (args.version, args.debug))
+
+    instance_vectors = []
+    types = []
+    written = unchanged = 0
+    rc = 0
+    results = render_global_types(items, args, manifest, hasher)
+    for job in results:
+        if not job.exported:
+            if not args.quiet and args.debug:
+                out.write('skipped type '+job.tname + '\n')
+            continue
+        if job.entry:
+            if job.entry['files']:
+                unchanged += len(job.entry['files'])
+            types.append(type_record(job.tname, f, job.entry['files'], job.entry['instance-vector'], job.depends))
+            if job.entry['instance-vector']:
+                instance_vectors.append((job.tname, job.entry['instance-vector']))
+            if not args.quiet and args.debug:
+                out.write('unchanged type %s\n' % (job.tname))
+            continue
+        if job.error:
+            err.write(COLOR_FAIL + 'error rendering type %s at line %d: %s\n' % (job.tname, job.line, job.error[0]) + COLOR_ENDC)
+            err.write(job.error[1])
+            if manifest:
+                manifest.remove(job.tname)
+            rc = 1
+            break
+        files = [output_path(f, args) for f in job.fnames] if job.fnames else None
+        if manifest:
+            manifest.update(job.tname, job.digest, files, job.vector)
+        if job.fnames:
+            written += len(job.fnames) - job.unchanged
+            unchanged += job.unchanged
+        types.append(type_record(job.tname, f, files, job.vector, job.depends, job.shared))
+        if job.vector:
+            instance_vectors.append((job.tname, job.vector))
+        if not args.quiet:
+            if job.fnames:
+                out.write('created %s\n' % (', '.join(job.fnames)))
+            else:
+                out.write('ignored type %s\n' % (job.tname))
+    results.close()
+    if manifest:
+        manifest.save()
+
+    if dump:
+        try:
+            with profiling.phase('dump write (wait)'):
+                dump.join()
+            if not args.quiet:
+                out.write('created %s\n' % (dump.fname))
+        except Exception as e:
+            err.write(COLOR_FAIL + 'error writing %s: %s\n' % (dump.fname, e) + COLOR_ENDC)
+            rc = 1
+    return rc, instance_vectors, (written, unchanged), types
+
+def type_record(tname, f, files, vector, depends, shared=None):
+    record = {
+        'type': tname,
+        'structure': f,
+        'files': files or [],
+        'instance-vector': vector,
+        'depends': depends,
+    }
+    if shared is not None:
+        record['shared'] = shared
+    return record
+
+def _lowered_tree(xml):
+    # transformed xml of a file, serialized when it comes from another process
+    if isinstance(xml, bytes):
+        return etree.ElementTree(etree.fromstring(xml, etree.XMLParser(huge_tree=True)))
+    return xml
+
+def _process_file_job(job):
+    f, args, data = job
+    out = io.StringIO()
+    err = io.StringIO()
+    if args.profile:
+        profiling.enable(memory=args.profile_memory)
+    try:
+        rc, vectors, counts, types = process_file(f, args, out, err, _lowered_tree(data))
+    except Exception as e:
+        err.write(COLOR_FAIL + 'error processing %s: %s\n' % (f, e) + COLOR_ENDC)
+        traceback.print_exc(file=err)
+        rc, vectors, counts, types = 1, [], (0, 0), []
+    tracing.flush()
+    return out.getvalue(), err.getvalue(), rc, vectors, counts, types, profiling.disable()
+
+def _type_graph_job(job):
+    f, args = job
+    data = None
+    if args.profile:
+        profiling.enable(memory=args.profile_memory)
+    with tracing.span('type graph ' + os.path.basename(f), 'file', file=f), profiling.structure(f):
+        if args.stream:
+            graph = type_graph(stream_structure(f, args.transform, args.cache))
+        else:
+            xml = lower_structure(f, args.transform, args.cache)
+            graph = type_graph(xml.getroot())
+            # kept for rendering, so that the file is not transformed again
+            data = etree.tostring(xml)
+    tracing.flush()
+    return graph, data, profiling.disable()
+
+def select_types(fnames, args, lowered=None):
+    """Return the types reachable from args.roots in the structure files.
+
+    Also return the transformed xml of the files, when it can be kept for
+    rendering, serialized if it was transformed by a worker process.
+    lowered holds the already transformed xml of some files."""
+    graphs = {}
+    lowered = dict(lowered or {})
+    todo = [f for f in fnames if f not in lowered]
+    if args.jobs == 1 or len(todo) < 2:
+        for f in todo:
+            if args.stream:
+                graphs[f] = type_graph(stream_structure(f, args.transform, args.cache))
+            else:
+                lowered[f] = lower_structure(f, args.transform, args.cache)
+    else:
+        with multiprocessing.Pool(min(args.jobs or os.cpu_count(), len(todo))) as pool:
+            for f, (g, data, profile) in zip(todo, pool.imap(_type_graph_job, [(f, args) for f in todo])):
+                if profile and profiling.current:
+                    profiling.current.merge(profile)
+                graphs[f] = g
+                if data:
+                    lowered[f] = data
+    graph = {}
+    for f in fnames:
+        if f not in graphs:
+            graphs[f] = type_graph(lowered[f].getroot())
+        graph.update(graphs[f])
+    return closure(graph, args.roots), lowered
+
+def process_files(fnames, args, lowered=None):
+    """Yield (stdout, stderr, exit code, instance vectors, file counts, type records) for each structure file, in order.
+
+    With several files and jobs, files are processed concurrently and the
+    types of each file are rendered serially. The already transformed xml
+    of a file is sent to its worker rather than transformed again."""
+    lowered = lowered or {}
+    if args.jobs == 1 or len(fnames) < 2:
+        for f in fnames:
+            rc, vectors, counts, types = process_file(f, args, xml=_lowered_tree(lowered.pop(f, None)))
+            yield '', '', rc, vectors, counts, types
+        return
+    file_args = argparse.Namespace(**vars(args))
+    file_args.jobs = 1
+    def pack(f):
+        xml = lowered.pop(f, None)
+        if xml is not None and not isinstance(xml, bytes):
+            xml = etree.tostring(xml)
+        return f, file_args, xml
+    with multiprocessing.Pool(min(args.jobs or os.cpu_count(), len(fnames))) as pool:
+        for result in pool.imap(_process_file_job, (pack(f) for f in fnames)):
+            if result[-1] and profiling.current:
+                profiling.current.merge(result[-1])
+            yield result[:-1]
+
+def add_render_arguments(parser):
+    """Add the options of code generation to parser."""
     parser.add_argument('--proto_out', metavar='PROTODIR', type=str,
                         default='./protogen',
                         help='output directory for protobuf files (default=./protogen)')
@@ -53,6 +377,17 @@ def main():
     parser.add_argument('--grpc', metavar='FILE', type=str,
                         default='./protogen/grpc.proto',
                         help='generate protobuf procedures for querying instances (default=./protogen/grpc.proto)')
+    parser.add_argument('--manifest', metavar='FILE', type=str,
+                        default=None,
+                        help='generate a json manifest of the generated files, with the instance vector '
+                        'and the dependencies of each type (default=<none>)')
+    parser.add_argument('--cmake', metavar='FILE', type=str,
+                        default=None,
+                        help='generate a CMake include listing the inputs and the generated files (default=<none>)')
+    parser.add_argument('--size-report', metavar='FILE', type=str,
+                        default=None,
+                        help='write the size and complexity of the generated code of each type, '
+                        'by decreasing estimated compile cost (default=<none>)')
     parser.add_argument('--version', '-v', metavar='2|3', type=int,
                         default='2', help='protobuf version (default=2)')
     parser.add_argument('--quiet', '-q', action='store_true',
@@ -65,14 +400,55 @@ def main():
     parser.add_argument('--transform', metavar='XSLT', type=str, action='append',
                         default=[],
                         help='apply this transform before processing xml (default=<none>)')
-    args = parser.parse_args()
+    parser.add_argument('--dump-xml', action='store_true',
+                        default=False, help='save transformed xml to PROTODIR/df.*.out.xml (default: False)')
+    parser.add_argument('--dump-gzip', action='store_true',
+                        default=False, help='save transformed xml to PROTODIR/df.*.out.xml.gz (default: False)')
+    parser.add_argument('--share-anon', action='store_true',
+                        default=False, help='define anonymous compounds, enums and bitfields once, by structure, '
+                        'in anon_types.proto and anon_types.h, when they refer to no other type (default: False)')
+    parser.add_argument('--stream', action='store_true',
+                        default=False, help='parse, transform and render types one at a time '
+                        'to bound memory use (default: False)')
+    parser.add_argument('--cache', metavar='CACHEDIR', type=str,
+                        default=None,
+                        help='reuse transformed xml saved in this directory (default=<none>)')
+    parser.add_argument('--incremental', action='store_true',
+                        default=False, help='only render types changed since the last run, '
+                        'according to a manifest saved in PROTODIR (default: False)')
+    parser.add_argument('--types', metavar='TYPE', type=str, nargs='+',
+                        default=None, help='only render these types (default: all exported types)')
+    parser.add_argument('--roots', metavar='TYPE', type=str, nargs='+',
+                        default=None, help='only render these types and the types they depend on, '
+                        'as found in the input structure files (default: all exported types)')
+    parser.add_argument('--watch', action='store_true',
+                        default=False, help='after generating, watch the inputs, the exceptions file and the '
+                        'transforms and regenerate what they affect, until interrupted; implies --incremental (default: False)')
+    parser.add_argument('--profile', action='store_true',
+                        default=False, help='print the time spent in each phase and the slowest types (default: False)')
+    parser.add_argument('--profile-stats', metavar='FILE', type=str,
+                        default=None, help='save cProfile statistics of the main process to FILE; '
+                        'implies --profile (default=<none>)')
+    parser.add_argument('--profile-memory', action='store_true',
+                        default=False, help='also print the peak memory of each phase, structure file and type, '
+                        'and the call sites allocating the most when parsing and transforming; implies --profile (default: False)')
+    parser.add_argument('--trace', metavar='FILE', type=str,
+                        default=os.environ.get('PROTOGEN_TRACE'),
+                        help='append spans of the stages, files and types to a trace-event file, '
+                        'for chrome://tracing or perfetto (default=$PROTOGEN_TRACE)')
+    parser.add_argument('--jobs', '-j', metavar='N', type=int,
+                        default=1, help='render types, or the files of a directory, with N processes, 0 for all cpus (default=1)')
 
-    # input dir
-    indir = args.input
-    assert os.path.exists(indir)
-    if os.path.isdir(indir) and not indir.endswith('/'):
-        indir += '/'
-    
+def generate(fnames, args, lowered=None, results=None, structures=None):
+    """Render the structure files and the files declaring their instance vectors.
+
+    Return the exit code and the records of the rendered types.
+    lowered holds the already transformed xml of some of the files.
+    results holds the instance vectors and type records of the files
+    rendered by a previous run, which are not rendered again; it is updated
+    with the files rendered by this run.
+    structures are the input files listed in the build manifest, fnames by
+    default."""
     # output dir
     for outdir in [args.proto_out, args.cpp_out, args.h_out]:
         if not os.path.exists(outdir):
@@ -81,94 +457,226 @@ def main():
                 sys.stdout.write('created %s\n' % (outdir))
 
     # collect types
-    transforms = [
-        etree.XSLT(etree.parse(f)) for f in args.transform
-    ]
-    if transforms and not args.quiet:
+    if args.transform and not args.quiet:
         sys.stdout.write(COLOR_OKBLUE + 'using %s\n' % (', '.join(args.transform)) + COLOR_ENDC)
+    results = {} if results is None else results
+    if args.exceptions:
+        # read once, and shared with the worker processes
+        load_rules(args.exceptions)
     instance_vectors = []
-    filt = indir
-    if os.path.isdir(indir):
-        filt = indir+'df.*.xml'
+    types = []
+    written = unchanged = 0
+    completed = 0
     rc = 0
-    for f in glob.glob(filt):
-        if not args.quiet:
-            sys.stdout.write(COLOR_OKBLUE + 'processing %s...\n' % (f) + COLOR_ENDC)
-
-        # xml with all types of the structure
-        struct_name = re.compile('df.(.*).xml').match(os.path.basename(f)).group(1)
-        outxml = open(args.proto_out+'/df.%s.out.xml' % (struct_name), 'wb')
-        assert struct_name, outxml
-        
-        xml = etree.parse(f)
-        for t in transforms:
-            xml = t(xml)
-        ns = re.match(r'{(.*)}', xml.getroot().tag).group(1)
-        xml.write(outxml)
-        for item in xml.getroot():
-            try:
-                export = item.get('export')
-                if export!='true' or 'global-type' not in item.tag:
-                    if not args.quiet and args.debug:
-                        sys.stdout.write('skipped type '+item.get('type-name') + '\n')
-                    continue
-                rdr = GlobalTypeRenderer(item, ns)
-                rdr.set_proto_version(args.version)
-                if args.debug:
-                    rdr.set_comment_ignored(True)
-                if args.exceptions:
-                    rdr.set_exceptions_file(args.exceptions)
-                fnames = rdr.render_to_files(args.proto_out, args.cpp_out, args.h_out)
-                vector = rdr.get_instance_vector()
-                if vector:
-                    instance_vectors.append((rdr.get_type_name(), vector))
-                if not args.quiet:
-                    if fnames:
-                        sys.stdout.write('created %s\n' % (', '.join(fnames)))
-                    else:
-                        sys.stdout.write('ignored type %s\n' % (rdr.get_type_name()))
-            except Exception as e:
-                _,_,tb = sys.exc_info()
-                sys.stderr.write(COLOR_FAIL + 'error rendering type %s at line %d: %s\n' % (rdr.get_type_name(), item.sourceline if item.sourceline else 0, e) + COLOR_ENDC)
-                traceback.print_tb(tb)
-                rc = 1
-                break
-
-        outxml.close()
+    previous = getattr(args, 'selection', None)
+    args.selection = set(args.types) if args.types else None
+    if args.roots:
+        with tracing.span('select types', 'stage'):
+            selection, lowered = select_types(fnames, args, lowered)
+        args.selection = selection | (args.selection or set())
         if not args.quiet:
-            sys.stdout.write('created %s\n' % (outxml.name))
+            sys.stdout.write('%d type(s) reachable from %s\n' % (len(selection), ', '.join(args.roots)))
+    if args.selection != previous:
+        results.clear()
+    todo = [f for f in fnames if f not in results]
+    for f, (out, err, rc, vectors, counts, type_records) in zip(todo, process_files(todo, args, lowered)):
+        sys.stdout.write(out)
+        sys.stderr.write(err)
+        written += counts[0]
+        unchanged += counts[1]
         if rc:
             break
+        results[f] = (vectors, type_records)
+    for f in fnames:
+        if f in results:
+            instance_vectors.extend(results[f][0])
+            types.extend(results[f][1])
+            completed += 1
 
+    if completed:
         # macros declaring RPC methods
         if args.methods:
-            with open(args.methods, 'w') as fp:
-                for v in instance_vectors:
-                    fp.write("""
+            out = ''
+            for v in instance_vectors:
+                out += """
 #ifndef DFPROTO_INCLUDED
 #include "%s.h"
 #endif
 METHOD_GET_LIST(%s, %s, %s)
                     """ % ( v[0], snakeToCamelCase(v[0]),
                             v[0], luaToCpp(v[1])
-                    ))
-            if not args.quiet:
-                sys.stdout.write('created %s\n' % (args.methods))
+                    )
+            if write_if_changed(args.methods, out):
+                written += 1
+                if not args.quiet:
+                    sys.stdout.write('created %s\n' % (args.methods))
+            else:
+                unchanged += 1
 
         # proto types for remote procedures
         if args.grpc:
-            with open(args.grpc, 'w') as fp:
-                for v in instance_vectors:
-                    fp.write("""
+            out = ''
+            for v in instance_vectors:
+                out += """
 import "%s.proto";
 message %sList {
     repeated dfproto.%s list = 1;
 }
                     """ % (v[0], snakeToCamelCase(v[0]), v[0])
-                    )
+            if write_if_changed(args.grpc, out):
+                written += 1
+                if not args.quiet:
+                    sys.stdout.write('created %s\n' % (args.grpc))
+            else:
+                unchanged += 1
+
+        # anonymous types shared by the rendered types
+        if args.share_anon:
+            shared = {}
+            for t in types:
+                shared.update(t.get('shared', {}))
+            for fname, content in render_shared_types(shared, args.version):
+                if write_if_changed(output_path(fname, args), content):
+                    written += 1
+                    if not args.quiet:
+                        sys.stdout.write('created %s\n' % (output_path(fname, args)))
+                else:
+                    unchanged += 1
+
+    # list of inputs and generated files, for the build system
+    if rc == 0:
+        structures = fnames if structures is None else structures
+        outputs = [f for f in [args.methods, args.grpc] if f]
+        if args.share_anon:
+            outputs += [output_path(SHARED_TYPES + ext, args) for ext in ['.proto', '.h']]
+        for fname, write in [(args.manifest, write_build_manifest), (args.cmake, write_cmake)]:
+            if not fname:
+                continue
+            if write(fname, structures, types, outputs):
+                written += 1
+                if not args.quiet:
+                    sys.stdout.write('created %s\n' % (fname))
+            else:
+                unchanged += 1
+        if args.size_report:
+            if write_size_report(args.size_report, types):
+                written += 1
+                if not args.quiet:
+                    sys.stdout.write('created %s\n' % (args.size_report))
+            else:
+                unchanged += 1
+
+    if not args.quiet:
+        sys.stdout.write('%d file(s) written, %d unchanged\n' % (written, unchanged))
+    return rc, types
+
+def start_profile(args):
+    """Enable profiling and tracing according to the options."""
+    if args.trace:
+        tracing.enable(args.trace)
+    if args.profile_stats or args.profile_memory:
+        args.profile = True
+    if args.profile:
+        profiling.enable(args.profile_stats, args.profile_memory)
+
+def report_profile(args):
+    """Print the times of the run and save the cProfile statistics."""
+    profile = profiling.disable()
+    if not profile:
+        return
+    sys.stdout.write('\n')
+    profile.report(sys.stdout)
+    if args.profile_stats:
+        profile.stats.dump_stats(args.profile_stats)
+        sys.stdout.write('created %s\n' % (args.profile_stats))
+
+def settings_files(args):
+    """Files whose changes may affect the types of all structure files."""
+    return ([args.exceptions] if args.exceptions else []) + args.transform
+
+def watch_inputs(patterns, args, regenerate):
+    """Call regenerate with the changed files each time some of the inputs or settings change.
+
+    Errors of regenerate, such as a file being saved, are reported and the
+    inputs are watched again. Return when interrupted."""
+    watcher = Watcher(patterns + settings_files(args))
+    try:
+        while True:
+            if not args.quiet:
+                sys.stdout.write(COLOR_OKBLUE + 'watching %s...\n' % (', '.join(watcher.patterns)) + COLOR_ENDC)
+                sys.stdout.flush()
+            changed = watcher.wait()
             if not args.quiet:
-                sys.stdout.write('created %s\n' % (args.grpc))
-        
+                sys.stdout.write('changed %s\n' % (', '.join(sorted(changed))))
+            try:
+                regenerate(changed)
+            except Exception as e:
+                sys.stderr.write(COLOR_FAIL + 'error regenerating %s: %s\n' % (', '.join(sorted(changed)), e) + COLOR_ENDC)
+                if args.debug:
+                    traceback.print_exc()
+                sys.stderr.flush()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        watcher.close()
+
+def make_parser():
+    parser = argparse.ArgumentParser(description='Generate protobuf and conversion code from dfhack structures.')
+    parser.add_argument('input', metavar='DIR|FILE', type=str,
+                        help='input directory or xml file (default=.)')
+    add_render_arguments(parser)
+    return parser
+
+def input_pattern(indir):
+    """Return the glob pattern of the structure files of an input directory or file."""
+    if os.path.isdir(indir) and not indir.endswith('/'):
+        indir += '/'
+    if os.path.isdir(indir):
+        return indir+'df.*.xml'
+    return indir
+
+def main(argv=None):
+    if argv is None:
+        argv = sys.argv[1:]
+    if argv[:1] == ['build']:
+        import build
+        return build.main(argv[1:])
+    if argv[:1] == ['serve']:
+        import daemon
+        return daemon.main(argv[1:])
+
+    # parse args
+    parser = make_parser()
+    args = parser.parse_args(argv)
+    if args.stream and (args.dump_xml or args.dump_gzip):
+        parser.error('--dump-xml and --dump-gzip need the whole transformed xml, not --stream')
+    lookups = lowering.cross_definition_lookups(args.transform) if args.stream else []
+    if lookups:
+        parser.error('--stream transforms each type alone, but these expressions may select other types:\n  '
+                     + '\n  '.join(lookups))
+    if args.share_anon and (args.incremental or args.watch):
+        parser.error('--share-anon needs all the types rendered, not --incremental or --watch')
+    if args.watch:
+        # only render the types of modified files and keep them in memory
+        args.incremental = True
+        if not args.stream:
+            lowering.keep_documents()
+
+    # input dir
+    assert os.path.exists(args.input)
+    filt = input_pattern(args.input)
+    start_profile(args)
+    results = {}
+    rc, _ = generate(sorted(glob.glob(filt)), args, results=results)
+    if args.watch:
+        def regenerate(changed):
+            if changed & set(settings_files(args)):
+                results.clear()
+            for f in changed:
+                results.pop(f, None)
+            generate(sorted(glob.glob(filt)), args, results=results)
+        watch_inputs([filt], args, regenerate)
+    report_profile(args)
     sys.exit(rc)
 
 
@@ -0,0 +1,172 @@
+import os
+import re
+from lxml import etree
+
+import profiling
+
+# xpaths selecting elements of a single global type
+TYPE_XPATH = re.compile(r'^ld:global-type\[@type-name="([^"]+)"\](?:/|$)')
+# xpath constructs that may leave the subtree of the type
+LEAVING_XPATH = re.compile(r'\||\.\.|ancestor|parent::|preceding|following|^/|id\(')
+
+KINDS = ['rename', 'ignore', 'index', 'enum', 'depends']
+
+XPATH_NS = {'re': 'http://exslt.org/regular-expressions'}
+
+# rule sets of the exceptions files read by this process, by path,
+# with the modification time and size they were read at
+_rule_sets = {}
+# compiled xpaths, by xpath and namespace
+_xpaths = {}
+
+
+def read_exceptions_file(fname):
+    """Yield the tokens of each rule of an exceptions file."""
+    with open(fname, 'r') as fil:
+        for line in fil:
+            tokens = line.strip().split(' ')
+            if not tokens or tokens[0].startswith('#'):
+                continue
+            yield tokens
+
+
+def xpath_type(xpath):
+    """Return the name of the only global type whose elements xpath may select, or None."""
+    match = TYPE_XPATH.match(xpath)
+    if not match or LEAVING_XPATH.search(xpath):
+        return None
+    return match.group(1)
+
+
+def compile_xpath(xpath, ns):
+    """Return the compiled xpath of a rule, with ld as prefix of the namespace ns."""
+    key = (xpath, ns)
+    if key not in _xpaths:
+        _xpaths[key] = etree.XPath(xpath, namespaces=dict(XPATH_NS, ld=ns))
+    return _xpaths[key]
+
+
+def _elements(found):
+    # elements selected by an xpath, which may return another type of value
+    if not isinstance(found, list):
+        return []
+    return [e for e in found if isinstance(e, etree._Element)]
+
+
+class DocumentMatches:
+    """Elements of a document selected by the rename and ignore rules.
+
+    Each rule is evaluated once for the whole document, after which looking
+    up the rules of an element takes constant time. Only the rules that
+    may apply to the global types of the document are evaluated."""
+
+    def __init__(self, rules, root, ns):
+        items = [root] if root.tag == '{%s}global-type' % (ns) else root
+        renames = set()
+        ignores = set()
+        for item in items:
+            if isinstance(item.tag, str):
+                renames.update(rules.renames(item.get('type-name') or ''))
+                ignores.update(rules.ignores(item.get('type-name') or ''))
+        tree = root.getroottree()
+        # new protobuf name, by element: a rule renames the first element
+        # it selects, and the last rule renaming an element wins
+        self.renamed = {}
+        # elements to ignore
+        self.ignored = set()
+        with profiling.phase('exceptions xpath'):
+            for xpath, name in [r for r in rules.renames() if r in renames]:
+                found = _elements(compile_xpath(xpath, ns)(tree))
+                if found:
+                    self.renamed[found[0]] = name
+            for xpath in [r for r in rules.ignores() if r in ignores]:
+                self.ignored.update(_elements(compile_xpath(xpath, ns)(tree)))
+
+
+class RuleSet:
+    """Exceptions rules, indexed by the global type they apply to.
+
+    A rule set is never modified: with_rule returns a new rule set, so that
+    a rule set can be shared by all the renderers of a process."""
+
+    def __init__(self, rules=()):
+        # tokens of the rules, in order
+        self.rules = tuple([tuple(r) for r in rules if r[0] in KINDS])
+        # id field of the types converted to ids, by type name
+        self.index = {}
+        for r in self.rules:
+            if r[0] == 'index':
+                self.index.setdefault(r[1], r[2])
+        self.enum = frozenset([r[1] for r in self.rules if r[0] == 'enum'])
+        # hidden dependencies, by type name
+        self.depends = {}
+        for r in self.rules:
+            if r[0] == 'depends':
+                self.depends[r[1]] = self.depends.get(r[1], ()) + (r[2],)
+        # rename and ignore rules, by the name of the type they apply to;
+        # rules of unknown types apply to all types and are kept in order
+        self._any = self._select(lambda tname: True)
+        self._types = {}
+        for tname in set([xpath_type(r[1]) for r in self.rules if r[0] in ['rename', 'ignore']]) - set([None]):
+            self._types[tname] = self._select(lambda t: t in [tname, None])
+        self._unknown = self._select(lambda tname: tname is None)
+
+    def _select(self, accept):
+        rules = [r for r in self.rules if r[0] in ['rename', 'ignore'] and accept(xpath_type(r[1]))]
+        return (tuple([(r[1], r[2]) for r in rules if r[0] == 'rename']),
+                tuple([r[1] for r in rules if r[0] == 'ignore']))
+
+    def with_rule(self, *tokens):
+        return RuleSet(self.rules + (tokens,))
+
+    def _for_type(self, tname):
+        if tname is None:
+            return self._any
+        return self._types.get(tname, self._unknown)
+
+    def renames(self, tname=None):
+        """Return (xpath, new name) of the rename rules that may apply to the elements of type tname.
+
+        With no type name, return all the rename rules."""
+        return self._for_type(tname)[0]
+
+    def ignores(self, tname=None):
+        """Return the xpaths of the ignore rules that may apply to the elements of type tname.
+
+        With no type name, return all the ignore rules."""
+        return self._for_type(tname)[1]
+
+    def matches(self, xml, ns):
+        """Return the matches of the rename and ignore rules in the document of xml."""
+        return DocumentMatches(self, xml.getroottree().getroot(), ns)
+
+
+class RuleCache:
+    """Matches of the rules in the last document seen, shared by the renderers of its types.
+
+    The cache belongs to the caller rendering the document, so that the
+    document is released with it. The rules are evaluated when a document
+    is seen for the first time, so they must not depend on changes made to
+    it while rendering."""
+
+    def __init__(self):
+        self._document = (None, None, None, None)
+
+    def matches(self, rules, xml, ns):
+        root = xml.getroottree().getroot()
+        if self._document[0] is not root or self._document[1] is not rules or self._document[2] != ns:
+            self._document = (root, rules, ns, rules.matches(root, ns))
+        return self._document[3]
+
+
+EMPTY = RuleSet()
+
+
+def load_rules(fname):
+    """Return the rule set of an exceptions file, read once per process."""
+    path = os.path.abspath(fname)
+    st = os.stat(path)
+    key = (st.st_mtime_ns, st.st_size)
+    if path not in _rule_sets or _rule_sets[path][0] != key:
+        _rule_sets[path] = (key, RuleSet(read_exceptions_file(path)))
+    return _rule_sets[path][1]
@@ -0,0 +1,47 @@
+#!/bin/python3
+
+import unittest
+import os
+import shutil
+import tempfile
+
+from build import structure_files, merge_structure
+
+
+class TestBuild(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.XML = """<data-definition>
+        <struct-type type-name="type_a">
+          <int32_t name="a"/>
+          <int32_t name="b"/>
+        </struct-type>
+        <struct-type type-name="type_b"/>
+        </data-definition>
+        """
+        for fname, content in [('df.a.xml', self.XML), ('df.b.xml', self.XML), ('a.export', 'type_a\n\ta\n')]:
+            with open(os.path.join(self.tmp, fname), 'w') as fil:
+                fil.write(content)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def test_structure_files(self):
+        self.assertEqual(structure_files(self.tmp, self.tmp), [
+            (os.path.join(self.tmp, 'df.a.xml'), os.path.join(self.tmp, 'a.export'))
+        ])
+
+    def test_merge_structure(self):
+        out = os.path.join(self.tmp, 'out')
+        os.mkdir(out)
+        merged, xml, warnings = merge_structure(os.path.join(self.tmp, 'df.a.xml'),
+                                                os.path.join(self.tmp, 'a.export'), out)
+        self.assertEqual(warnings, 0)
+        self.assertEqual(merged, os.path.join(out, 'df.a.xml'))
+        self.assertTrue(os.path.exists(merged))
+        root = xml.getroot()
+        self.assertEqual(root[0].get('export'), 'true')
+        self.assertEqual(root[0][0].get('export'), 'true')
+        self.assertEqual(root[0][1].get('export'), None)
+        self.assertEqual(root[1].get('export'), None)
@@ -0,0 +1,77 @@
+#!/bin/python3
+
+import unittest
+import os
+import shutil
+import tempfile
+
+from code_size import type_size, size_report, write_size_report
+
+
+class TestCodeSize(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.PROTO = """/* THIS FILE WAS GENERATED. DO NOT EDIT. */
+        syntax = "proto2";
+        option optimize_for = LITE_RUNTIME;
+        import "type_b.proto";
+
+        package dfproto;
+        message type_a {
+          message T_anon_1 {
+            required int32 a = 1;
+          }
+          enum T_flags {
+            flag = 0;
+          }
+          required T_anon_1 anon_1 = 1;
+          repeated type_b b = 2;
+          oneof any {
+            int32 c = 3;
+          }
+        }
+        """
+        self.CPP = """/* THIS FILE WAS GENERATED. DO NOT EDIT. */
+        #include "type_a.h"
+
+        void DFProto::describe_type_a(dfproto::type_a* proto, df::type_a* dfhack) {
+          auto describe_T_anon_1 = [](dfproto::type_a_T_anon_1* proto, df::type_a::T_anon_1* dfhack) {
+            proto->set_a(dfhack->a);
+          };
+          describe_T_anon_1(proto->mutable_anon_1(), &dfhack->anon_1);
+          for (size_t i=0; i<dfhack->b.size(); i++) {
+            describe_type_b(proto->add_b(), dfhack->b[i]);
+          }
+        }
+        """
+        self.files = []
+        for fname, content in [('type_a.proto', self.PROTO), ('type_a.cpp', self.CPP), ('type_b.proto', 'message type_b {\n}\n')]:
+            self.files.append(os.path.join(self.tmp, fname))
+            with open(self.files[-1], 'w') as fil:
+                fil.write(content)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def test_type_size(self):
+        self.assertEqual(type_size(self.files[:2]), {
+            'fields': 4, 'messages': 1, 'cpp lines': 12, 'lambdas': 1, 'loops': 1,
+        })
+
+    def test_size_report(self):
+        types = [
+            {'type': 'type_a', 'files': self.files[:2], 'depends': ['type_b']},
+            {'type': 'type_b', 'files': self.files[2:], 'depends': ['type_c']},
+            {'type': 'type_c', 'files': [], 'depends': []},
+        ]
+        report = size_report(types)
+        self.assertEqual([t for t, metrics in report], ['type_a', 'type_b'])
+        self.assertEqual(report[0][1]['fan-out'], 2)
+        self.assertEqual(report[1][1]['fan-out'], 1)
+        fname = os.path.join(self.tmp, 'size.txt')
+        self.assertTrue(write_size_report(fname, types))
+        with open(fname) as fil:
+            lines = fil.read().splitlines()
+        self.assertEqual(lines[0].split()[:3], ['type', 'cost', 'fields'])
+        self.assertEqual(lines[1].split()[0], 'type_a')
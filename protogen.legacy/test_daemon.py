@@ -0,0 +1,186 @@
+#!/bin/python3
+
+import unittest
+import os
+import sys
+import time
+import json
+import base64
+import socket
+import shutil
+import tempfile
+import threading
+import subprocess
+
+import lowering
+from daemon import run_tool, peek_request, preload
+
+
+class TestDaemon(unittest.TestCase):
+
+    def setUp(self):
+        self.XML = """<data-definition>
+        <struct-type type-name="type_a"/>
+        <enum-type type-name="type_b"/>
+        </data-definition>
+        """
+        self.delete_me = ['df.test.xml']
+        with open(self.delete_me[0], 'w') as fil:
+            fil.write(self.XML)
+
+    def tearDown(self):
+        for f in self.delete_me:
+            os.remove(f)
+
+    def test_run_tool(self):
+        rc, out, err = run_tool('list', [self.delete_me[0], 'out', '--separator', ' '], os.getcwd())
+        self.assertEqual(rc, 0)
+        self.assertEqual(out, b'out/type_a.proto out/type_b.proto ')
+        self.assertEqual(err, b'')
+
+    def test_run_tool_error(self):
+        cwd = os.getcwd()
+        rc, out, err = run_tool('list', ['--bogus'], '/')
+        self.assertEqual(rc, 2)
+        self.assertEqual(out, b'')
+        self.assertIn(b'usage:', err)
+        self.assertEqual(os.getcwd(), cwd)
+
+    def test_run_tool_trace(self):
+        tmp = tempfile.mkdtemp()
+        try:
+            with open(os.path.join(tmp, 'df.test.xml'), 'w') as fil:
+                fil.write('<ld:data-definition xmlns:ld="ns">'
+                          '<ld:global-type ld:meta="struct-type" ld:level="0" type-name="type_a" export="true"/>'
+                          '</ld:data-definition>')
+            argv = ['df.test.xml', '--quiet', '--proto_out', '.', '--cpp_out', '.', '--h_out', '.',
+                    '--methods', 'methods.inc', '--grpc', 'grpc.proto']
+            sizes = []
+            for opts, env in [(['--trace', 't1.json'], {}), ([], {}), ([], {'PROTOGEN_TRACE': 't2.json'}), ([], {})]:
+                rc, out, err = run_tool('protogen', argv + opts, tmp, env)
+                self.assertEqual((rc, err), (0, b''))
+                sizes.append([os.path.getsize(os.path.join(tmp, f)) if os.path.exists(os.path.join(tmp, f)) else 0
+                              for f in ['t1.json', 't2.json']])
+            # the trace file of a run is not used by the next runs
+            self.assertTrue(sizes[0][0] > 0)
+            self.assertEqual(sizes[1], sizes[0])
+            # the environment of the client selects the trace file of a run
+            self.assertEqual(sizes[2][0], sizes[0][0])
+            self.assertTrue(sizes[2][1] > 0)
+            self.assertEqual(sizes[3], sizes[2])
+        finally:
+            shutil.rmtree(tmp)
+
+    def test_peek_request(self):
+        server, client = socket.socketpair()
+        try:
+            line = json.dumps({'tool': 'list', 'argv': [], 'cwd': '/'}).encode() + b'\n'
+            client.sendall(line[:10])
+            threading.Timer(0.1, client.sendall, [line[10:]]).start()
+            self.assertEqual(peek_request(server, 5), {'tool': 'list', 'argv': [], 'cwd': '/'})
+            # the request is left to the handler
+            with server.makefile('rb') as fil:
+                self.assertEqual(fil.readline(), line)
+            self.assertIsNone(peek_request(server, 0.1))
+        finally:
+            server.close()
+            client.close()
+
+    def test_preload(self):
+        import dag
+        tmp = tempfile.mkdtemp()
+        keep_documents = lowering._documents, lowering._documents_limit
+        lowering.keep_documents()
+        try:
+            shutil.copy(self.delete_me[0], tmp)
+            with open(os.path.join(tmp, 'identity.xslt'), 'w') as fil:
+                fil.write("""<xsl:stylesheet version="1.0" xmlns:xsl="http://www.w3.org/1999/XSL/Transform">
+                <xsl:template match="@*|node()">
+                  <xsl:copy><xsl:apply-templates select="@*|node()"/></xsl:copy>
+                </xsl:template>
+                </xsl:stylesheet>""")
+            with open(os.path.join(tmp, 'test.dag'), 'w') as fil:
+                fil.write('type_a type_b\n')
+            preload('protogen', ['.', '--transform', 'identity.xslt', '--quiet'], tmp)
+            preload('dag', ['test.dag', '--ancestors', 'type_a'], tmp)
+            # errors are left to the child serving the request
+            preload('protogen', ['--bogus'], tmp)
+            self.assertIn(os.path.join(tmp, 'df.test.xml'), lowering._documents)
+            self.assertTrue([k for k in lowering._stylesheets if k[0] == os.path.join(tmp, 'identity.xslt')])
+            self.assertEqual(dag._edges[os.path.join(tmp, 'test.dag')][1], [('type_b', 'type_a')])
+            # the request reuses the kept document
+            kept = lowering._documents[os.path.join(tmp, 'df.test.xml')][1]
+            cwd = os.getcwd()
+            os.chdir(tmp)
+            try:
+                self.assertIs(lowering.lower_structure('df.test.xml', ['identity.xslt']), kept)
+            finally:
+                os.chdir(cwd)
+        finally:
+            lowering._documents, lowering._documents_limit = keep_documents
+            shutil.rmtree(tmp)
+
+    def test_concurrent_requests(self):
+        tmp = tempfile.mkdtemp()
+        path = os.path.join(tmp, 'protogen.sock')
+        server = subprocess.Popen([sys.executable, 'protogen.py', 'serve', '--socket', path, '--idle-timeout', '30'])
+        conns = []
+        try:
+            while not os.path.exists(path):
+                self.assertIsNone(server.poll())
+                time.sleep(0.05)
+            for d in ['a', 'b']:
+                os.mkdir(os.path.join(tmp, d))
+                shutil.copy(self.delete_me[0], os.path.join(tmp, d))
+                sock = socket.socket(socket.AF_UNIX)
+                sock.settimeout(10)
+                sock.connect(path)
+                conns.append(sock)
+            # the second request is served while the first one is still pending,
+            # each from the directory of its client
+            for sock, d in reversed(list(zip(conns, ['a', 'b']))):
+                sock.sendall(json.dumps({
+                    'tool': 'list', 'argv': [self.delete_me[0], 'out', '--separator', ' '],
+                    'cwd': os.path.join(tmp, d),
+                }).encode() + b'\n')
+                with sock.makefile('rb') as fil:
+                    response = json.loads(fil.readline().decode())
+                self.assertEqual(response['rc'], 0)
+                self.assertEqual(base64.b64decode(response['stdout']), b'out/type_a.proto out/type_b.proto ')
+        finally:
+            for sock in conns:
+                sock.close()
+            server.terminate()
+            server.wait()
+            shutil.rmtree(tmp)
+
+    def test_start_once(self):
+        tmp = tempfile.mkdtemp()
+        path = os.path.join(tmp, 'protogen.sock')
+        # clients starting servers at once
+        servers = [subprocess.Popen([sys.executable, 'protogen.py', 'serve', '--socket', path, '--idle-timeout', '30'],
+                                    stderr=subprocess.PIPE) for i in range(3)]
+        try:
+            while len([s for s in servers if s.poll() is None]) > 1 or not os.path.exists(path):
+                self.assertTrue([s for s in servers if s.returncode is None])
+                time.sleep(0.05)
+            self.assertEqual(sorted([s.returncode for s in servers], key=str), [1, 1, None])
+            with socket.socket(socket.AF_UNIX) as sock:
+                sock.connect(path)
+        finally:
+            for s in servers:
+                s.terminate()
+                s.communicate()
+            shutil.rmtree(tmp)
+
+    def test_idle_timeout(self):
+        tmp = tempfile.mkdtemp()
+        path = os.path.join(tmp, 'protogen.sock')
+        try:
+            server = subprocess.run([sys.executable, 'protogen.py', 'serve', '--socket', path, '--idle-timeout', '1'],
+                                    timeout=30)
+            self.assertEqual(server.returncode, 0)
+            # the socket and its lock are removed when the server stops
+            self.assertEqual(os.listdir(tmp), [])
+        finally:
+            shutil.rmtree(tmp)
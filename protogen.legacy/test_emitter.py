@@ -0,0 +1,36 @@
+#!/bin/python3
+
+import unittest
+from lxml import etree
+
+from emitter import Emitter
+from cpp_renderer import CppRenderer
+
+
+class TestEmitter(unittest.TestCase):
+
+    def test_marks(self):
+        out = Emitter()
+        out.write('message A {\n')
+        mark = out.mark()
+        comment = out.reserve()
+        self.assertTrue(out.is_empty(mark))
+        out.write('  ', '/* ignored */', '\n')
+        self.assertFalse(out.is_empty(mark))
+        self.assertTrue(out.startswith(mark, '/*'))
+        self.assertTrue(out.endswith(mark, '*/'))
+        out.fill(comment, '  /* comment */\n')
+        self.assertEqual(out.cut(mark), ['  /* comment */\n', '  ', '/* ignored */', '\n'])
+        self.assertFalse(out.startswith(mark, '/*'))
+        out.write('}\n')
+        self.assertEqual(out.pop(0), 'message A {\n}\n')
+        self.assertEqual(out.chunks, [])
+
+    def test_shared_by_copies(self):
+        rdr = CppRenderer('ns', 'dfproto', 'DFProto')
+        copy = rdr.copy()
+        self.assertIs(copy.out, rdr.out)
+        copy.out.write('/* pending */\n')
+        field = etree.fromstring('<ld:field xmlns:ld="ns" ld:meta="number" ld:subtype="int32_t" name="a" ld:level="1" export="true"/>')
+        self.assertEqual(rdr.render_field(field), '  proto->set_a(dfhack->a);\n')
+        self.assertEqual(rdr.out.chunks, ['/* pending */\n'])
@@ -0,0 +1,46 @@
+#!/bin/python3
+
+import unittest
+import os
+import gzip
+import shutil
+import tempfile
+
+from fileio import write_if_changed, BackgroundWriter
+
+
+class TestFileio(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.content = b'<data-definition>' + b'<struct-type type-name="type_a"/>' * 1000 + b'</data-definition>'
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def read(self, fname, opener=open):
+        with opener(os.path.join(self.tmp, fname), 'rb') as fil:
+            return fil.read()
+
+    def test_background_writer(self):
+        write_if_changed(os.path.join(self.tmp, 'sync.xml'), self.content)
+        writer = BackgroundWriter(os.path.join(self.tmp, 'async.xml'), self.content)
+        writer.join()
+        self.assertEqual(self.read('async.xml'), self.read('sync.xml'))
+        # content is released once written
+        self.assertIsNone(writer.content)
+
+    def test_background_writer_callable(self):
+        writer = BackgroundWriter(os.path.join(self.tmp, 'async.xml'), lambda: self.content)
+        writer.join()
+        self.assertEqual(self.read('async.xml'), self.content)
+        self.assertIsNone(writer.content)
+
+    def test_background_writer_gzip(self):
+        BackgroundWriter(os.path.join(self.tmp, 'async.xml.gz'), self.content, compress=True).join()
+        self.assertEqual(self.read('async.xml.gz', gzip.open), self.content)
+
+    def test_background_writer_error(self):
+        writer = BackgroundWriter(os.path.join(self.tmp, 'missing', 'async.xml'), self.content)
+        with self.assertRaises(FileNotFoundError):
+            writer.join()
@@ -1,10 +1,12 @@
 #!/bin/python3
 
 import unittest
+from unittest import mock
 import os
 from lxml import etree
 
-from global_type_renderer import GlobalTypeRenderer
+from rules import RuleSet
+from global_type_renderer import GlobalTypeRenderer, render_artifacts, render_shared_types
 
 
 class TestGlobalTypeRenderer(unittest.TestCase):
@@ -130,6 +132,23 @@ class TestGlobalTypeRenderer(unittest.TestCase):
         # check global vector
         self.assertEqual(self.sut.get_instance_vector(), '$global.world.world_data.reasons')
 
+    def test_render_to_files_unchanged(self):
+        fnames = self.sut.render_to_files('./', './', './')
+        self.delete_me += fnames
+        self.assertEqual(self.sut.unchanged, [])
+        mtimes = [os.stat(f).st_mtime_ns for f in fnames]
+        # same content: files are left untouched
+        self.assertEqual(self.sut.render_to_files('./', './', './'), fnames)
+        self.assertEqual(self.sut.unchanged, list(fnames))
+        self.assertEqual([os.stat(f).st_mtime_ns for f in fnames], mtimes)
+        # modified content: file is replaced
+        with open(fnames[0], 'w') as fil:
+            fil.write('modified')
+        self.sut.render_to_files('./', './', './')
+        self.assertEqual(self.sut.unchanged, list(fnames[1:]))
+        with open(fnames[0], 'r') as fil:
+            self.assertStructEqual(fil.read(), self.PROTO)
+
     def test_ignore_type(self):
         self.XML = """
         <ld:data-definition xmlns:ld="ns">
@@ -142,3 +161,142 @@ class TestGlobalTypeRenderer(unittest.TestCase):
         sut = GlobalTypeRenderer(root[0], 'ns')
         sut.set_exceptions_file(self.delete_me[0])
         self.assertFalse(sut.render_to_files('./', './', './'))
+
+    def test_sorted_imports(self):
+        self.XML = """
+        <ld:data-definition xmlns:ld="ns">
+        <ld:global-type ld:meta="struct-type" ld:level="0" type-name="sorted_imports">
+          <ld:field name="zz" type-name="zzz_type" ld:level="1" ld:meta="global"/>
+          <ld:field name="mm" type-name="mmm_type" ld:level="1" ld:meta="global"/>
+          <ld:field name="aa" type-name="aaa_type" ld:level="1" ld:meta="global"/>
+        </ld:global-type>
+        </ld:data-definition>
+        """
+        root = etree.fromstring(self.XML)
+        sut = GlobalTypeRenderer(root[0], 'ns').set_ignore_no_export(False)
+        out = sut.render_proto()
+        self.assertIn('import "aaa_type.proto";\nimport "mmm_type.proto";\nimport "zzz_type.proto";\n', out)
+        out = sut.render_cpp()
+        self.assertIn('#include "df/aaa_type.h"\n#include "aaa_type.pb.h"\n#include "df/mmm_type.h"\n', out)
+        self.assertIn('#include "aaa_type.h"\n#include "mmm_type.h"\n#include "zzz_type.h"\n', out)
+
+    def test_render(self):
+        out = list(self.sut.render())
+        self.assertEqual([f for f, _ in out], [
+            'history_event_reason_info.proto', 'history_event_reason_info.cpp', 'history_event_reason_info.h'
+        ])
+        self.assertStructEqual(out[0][1], self.PROTO)
+        self.assertStructEqual(out[1][1], self.CPP)
+        self.assertStructEqual(out[2][1], self.H)
+        self.assertFalse(os.path.exists(out[0][0]))
+
+    def test_render_walk(self):
+        self.XML = """
+        <ld:data-definition xmlns:ld="ns">
+        <ld:global-type ld:meta="struct-type" ld:level="0" type-name="type_a">
+          <ld:field ld:meta="compound" name="a" ld:level="1">
+            <ld:field ld:meta="number" ld:subtype="int32_t" name="x" ld:level="2"/>
+          </ld:field>
+          <ld:field ld:meta="container" ld:subtype="stl-vector" name="b" ld:level="1">
+            <ld:item ld:meta="compound" ld:level="2">
+              <ld:field ld:meta="number" ld:subtype="int32_t" name="x" ld:level="3"/>
+              <ld:field ld:meta="compound" name="c" ld:level="3">
+                <ld:field name="y" type-name="type_b" ld:level="4" ld:meta="global"/>
+              </ld:field>
+            </ld:item>
+          </ld:field>
+        </ld:global-type>
+        </ld:data-definition>
+        """
+        root = etree.fromstring(self.XML)
+        sut = GlobalTypeRenderer(root[0], 'ns').set_ignore_no_export(False)
+        ref = [sut.render_proto(), sut.render_cpp()]
+        # count the walks of the fields of each node
+        walks = []
+        class Fields(list):
+            def __iter__(self):
+                walks.append(self)
+                return list.__iter__(self)
+        for node in sut.get_node().iter():
+            node.fields = Fields(node.fields)
+        out = list(sut.render())
+        self.assertEqual([out[0][1], out[1][1]], ref)
+        # the .proto and the .cpp are rendered in a single walk of each compound
+        node = sut.get_node()
+        compounds = [node, node.fields[0], node.fields[1].items[0], node.fields[1].items[0].fields[1]]
+        self.assertEqual(len(walks), len(compounds))
+        for fields in [n.fields for n in compounds]:
+            self.assertEqual(len([w for w in walks if w is fields]), 1)
+
+    def test_render_artifacts(self):
+        self.XML = """
+        <ld:data-definition xmlns:ld="ns">
+        <ld:global-type ld:meta="struct-type" ld:level="0" type-name="type_a" export="true">
+          <ld:field name="a" ld:level="1" ld:meta="number" ld:subtype="int32_t" export="true"/>
+        </ld:global-type>
+        <ld:global-type ld:meta="struct-type" ld:level="0" type-name="type_b"/>
+        <ld:global-type ld:meta="enum-type" ld:level="0" type-name="type_c" export="true"/>
+        <ld:global-type ld:meta="struct-type" ld:level="0" type-name="world_unk_c0" export="true"/>
+        </ld:data-definition>
+        """
+        xml = etree.ElementTree(etree.fromstring(self.XML))
+        with mock.patch.object(RuleSet, 'matches', autospec=True, side_effect=RuleSet.matches) as matches:
+            out = render_artifacts(xml, exceptions=self.delete_me[0])
+            tname, kind, content = next(out)
+            self.assertEqual((tname, kind), ('type_a', 'proto'))
+            self.assertIn('message type_a {', content)
+            self.assertEqual([r[:2] for r in out], [
+                ('type_a', 'cpp'), ('type_a', 'h'), ('type_c', 'proto'), ('type_c', 'cpp'), ('type_c', 'h')
+            ])
+        # the rules are evaluated once for all the types of the document
+        self.assertEqual(matches.call_count, 1)
+        # also by the renderers given no cache
+        with mock.patch.object(RuleSet, 'matches', autospec=True, side_effect=RuleSet.matches) as matches:
+            for item in xml.getroot():
+                GlobalTypeRenderer(item, 'ns').set_exceptions_file(self.delete_me[0]).render_proto()
+        self.assertEqual(matches.call_count, 1)
+        out = render_artifacts(xml.getroot(), types=['type_c'], version=3)
+        self.assertIn('syntax = "proto3";', next(out)[2])
+
+    def test_share_anon(self):
+        self.XML = """
+        <ld:data-definition xmlns:ld="ns">
+        <ld:global-type ld:meta="struct-type" ld:level="0" type-name="type_a">
+          <ld:field ld:meta="compound" name="a" ld:level="1">
+            <ld:field ld:meta="number" ld:subtype="int32_t" name="x" ld:level="2"/>
+          </ld:field>
+          <ld:field ld:meta="container" ld:subtype="stl-vector" name="b" ld:level="1">
+            <ld:item ld:meta="compound" ld:level="2">
+              <ld:field ld:meta="number" ld:subtype="int32_t" name="x" ld:level="3"/>
+            </ld:item>
+          </ld:field>
+          <ld:field ld:meta="compound" name="c" ld:level="1">
+            <ld:field name="y" type-name="type_b" ld:level="2" ld:meta="global"/>
+          </ld:field>
+        </ld:global-type>
+        </ld:data-definition>
+        """
+        root = etree.fromstring(self.XML)
+        sut = GlobalTypeRenderer(root[0], 'ns').set_ignore_no_export(False).set_share_anon(True)
+        out = sut.render_proto()
+        self.assertIn('import "anon_types.proto";', out)
+        defs = sut.render_shared()
+        self.assertEqual(len(defs), 1)
+        tname = next(iter(defs))
+        self.assertIn('required %s a = 1;' % (tname), out)
+        self.assertIn('repeated %s b = 2;' % (tname), out)
+        # types referring to other types are kept local
+        self.assertIn('message T_c {', out)
+        self.assertNotIn('message %s' % (tname), out)
+        out = sut.render_cpp()
+        self.assertIn('#include "anon_types.h"', out)
+        self.assertIn('describe_%s(proto->mutable_a(), &dfhack->a);' % (tname), out)
+        self.assertIn('describe_%s(proto->add_b(), &dfhack->b[i]);' % (tname), out)
+        (pname, proto), (hname, h) = render_shared_types(sut.render_shared())
+        self.assertEqual((pname, hname), ('anon_types.proto', 'anon_types.h'))
+        self.assertStructEqual(proto.split('package dfproto;')[1], 'message %s { required int32 x = 1; }' % (tname))
+        self.assertIn('template <typename T> void describe_%s(dfproto::%s* proto, T* dfhack) {\n  proto->set_x(dfhack->x);\n}' % (tname, tname), h)
+        # not shared by default
+        sut = GlobalTypeRenderer(root[0], 'ns').set_ignore_no_export(False)
+        self.assertNotIn('anon_types', sut.render_proto())
+        self.assertEqual(sut.render_shared(), {})
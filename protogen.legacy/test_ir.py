@@ -0,0 +1,101 @@
+#!/bin/python3
+
+import unittest
+import pickle
+from lxml import etree
+
+import ir
+from rules import RuleSet
+from proto_renderer import ProtoRenderer
+from cpp_renderer import CppRenderer
+
+
+class TestIr(unittest.TestCase):
+
+    def setUp(self):
+        self.XML = """
+        <ld:data-definition xmlns:ld="ns">
+          <ld:global-type ld:meta="struct-type" ld:level="0" type-name="type_a" instance-vector="$global.world.a">
+            <ld:field ld:meta="number" ld:subtype="int32_t" name="a" ld:level="1" export="true"/>
+            <ld:field ld:meta="compound" name="b" ld:level="1" ld:typedef-name="T_b" is-union="true" export="true">
+              <ld:field ld:meta="number" ld:subtype="int16_t" name="c" ld:level="2"/>
+            </ld:field>
+            <ld:field ld:meta="number" ld:subtype="int32_t" name="unused" ld:level="1" export="true"/>
+          </ld:global-type>
+        </ld:data-definition>
+        """
+        self.rules = RuleSet([
+            ('rename', 'ld:global-type[@type-name="type_a"]/ld:field[@name="a"]', 'a2'),
+            ('ignore', 'ld:global-type[@type-name="type_a"]/ld:field[@name="unused"]'),
+        ])
+
+    def test_lower(self):
+        node = ir.lower(etree.fromstring(self.XML)[0], 'ns', self.rules)
+        self.assertIsInstance(node, ir.Type)
+        self.assertEqual((node.tag, node.meta, node.type_name, node.level), ('global-type', 'struct-type', 'type_a', 0))
+        self.assertEqual(node.instance_vector, '$global.world.a')
+        self.assertEqual([f.name for f in node.fields], ['a', 'b', 'unused'])
+        a, b, unused = node.fields
+        self.assertEqual((a.pbname, a.ignored, a.subtype), ('a2', False, 'int32_t'))
+        self.assertTrue(unused.ignored)
+        self.assertEqual((b.is_union, b.anon_compound, b.typedef_name), (True, False, 'T_b'))
+        self.assertEqual(b.items[0].level, 2)
+        self.assertEqual([n.name for n in node.iter()], [None, 'a', 'b', 'c', 'unused'])
+
+    def test_pickle(self):
+        node = ir.lower(etree.fromstring(self.XML)[0], 'ns', self.rules)
+        copy = pickle.loads(pickle.dumps(node))
+        self.assertIsInstance(copy, ir.Type)
+        self.assertEqual(copy.instance_vector, node.instance_vector)
+        self.assertEqual(ProtoRenderer('ns').render_type(copy), ProtoRenderer('ns').render_type(node))
+        self.assertEqual(CppRenderer('ns', 'dfproto', 'DFProto').render_type(copy),
+                         CppRenderer('ns', 'dfproto', 'DFProto').render_type(node))
+        self.assertIn('a2', ProtoRenderer('ns').render_type(copy))
+        self.assertNotIn('unused', ProtoRenderer('ns').render_type(copy))
+
+    def test_exports(self):
+        XML = """
+        <ld:data-definition xmlns:ld="ns">
+          <ld:global-type ld:meta="struct-type" ld:level="0" type-name="type_a" export="true">
+            <ld:field ld:meta="compound" name="a" ld:level="1" export="true">
+              <ld:field ld:meta="number" ld:subtype="int32_t" name="b" ld:level="2"/>
+              <ld:field ld:meta="number" ld:subtype="int32_t" name="unk_c" ld:level="2"/>
+            </ld:field>
+            <ld:field ld:meta="compound" name="d" ld:level="1">
+              <ld:field ld:meta="number" ld:subtype="int32_t" name="e" ld:level="2" export="true"/>
+            </ld:field>
+          </ld:global-type>
+        </ld:data-definition>
+        """
+        xml = etree.fromstring(XML)[0]
+        node = ir.lower(xml, 'ns')
+        self.assertEqual([(n.name, n.export, n.skipped) for n in node.iter()], [
+            (None, 'true', False),
+            ('a', 'true', False), ('b', 'true', False), ('unk_c', 'true', True),
+            ('d', None, True), ('e', 'true', False),
+        ])
+        # the xml tree is left as is
+        self.assertIsNone(xml[0][0].get('export'))
+        node = ir.lower(xml, 'ns', ignore_no_export=False)
+        self.assertEqual([n.skipped for n in node.fields], [False, False])
+        self.assertEqual(node.fields[1].items[0].export, 'true')
+
+    def test_shared_names(self):
+        XML = """
+        <ld:data-definition xmlns:ld="ns">
+          <ld:global-type ld:meta="struct-type" ld:level="0" type-name="type_a">
+            <ld:field ld:meta="number" ld:subtype="int32_t" ld:level="1" export="true"/>
+            <ld:field ld:meta="number" ld:subtype="int32_t" name="b" ld:level="1"/>
+            <ld:field ld:meta="number" ld:subtype="int32_t" ld:level="1" export="true"/>
+          </ld:global-type>
+        </ld:data-definition>
+        """
+        node = ir.lower(etree.fromstring(XML)[0], 'ns')
+        self.assertEqual([f.skipped for f in node.fields], [False, True, False])
+        self.assertIn('anon_2 = 3;', ProtoRenderer('ns').render_type(node))
+        self.assertEqual([f.dfname for f in node.fields], ['anon_1', None, 'anon_2'])
+        # the cpp renderer reuses the names of the node
+        node.fields[2].dfname = 'anon_x'
+        out = CppRenderer('ns', 'dfproto', 'DFProto').render_type(node)
+        self.assertIn('proto->set_anon_1(dfhack->anon_1);', out)
+        self.assertIn('proto->set_anon_x(dfhack->anon_x);', out)
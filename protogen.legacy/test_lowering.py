@@ -0,0 +1,153 @@
+#!/bin/python3
+
+import unittest
+import os
+import glob
+import shutil
+from lxml import etree
+
+import lowering
+from lowering import lower_structure, lowering_key, stream_structure, keep_documents, cross_definition_lookups
+
+# xml directory of dfhack, with the structure files and the stylesheets
+DFHACK_XML = os.environ.get('DFHACK_XML')
+
+
+class TestLowering(unittest.TestCase):
+
+    def setUp(self):
+        self.XML = """<ld:data-definition xmlns:ld="ns">
+        <ld:global-type ld:meta="struct-type" type-name="type_a"/>
+        <ld:global-type ld:meta="struct-type" type-name="type_c">
+          <ld:field name="c" ld:meta="number" ld:subtype="int32_t"/>
+        </ld:global-type>
+        </ld:data-definition>
+        """
+        self.XSLT = """<xsl:stylesheet version="1.0" xmlns:xsl="http://www.w3.org/1999/XSL/Transform">
+        <xsl:template match="@*|node()">
+          <xsl:copy><xsl:apply-templates select="@*|node()"/></xsl:copy>
+        </xsl:template>
+        <xsl:template match="@type-name">
+          <xsl:attribute name="type-name">lowered_<xsl:value-of select="."/></xsl:attribute>
+        </xsl:template>
+        </xsl:stylesheet>
+        """
+        self.cache_dir = 'cache.tmp'
+        self.delete_me = ['df.test.xml', 'lower.xslt']
+        self.write(0, self.XML)
+        self.write(1, self.XSLT)
+
+    def tearDown(self):
+        for f in self.delete_me:
+            os.remove(f)
+        shutil.rmtree(self.cache_dir, ignore_errors=True)
+
+    def write(self, i, content):
+        with open(self.delete_me[i], 'w') as fil:
+            fil.write(content)
+
+    def test_lower_structure(self):
+        xml = lower_structure(self.delete_me[0], [self.delete_me[1]])
+        self.assertEqual(xml.getroot()[0].get('type-name'), 'lowered_type_a')
+
+    def test_cache(self):
+        ref = etree.tostring(lower_structure(self.delete_me[0], [self.delete_me[1]]))
+        xml = lower_structure(self.delete_me[0], [self.delete_me[1]], self.cache_dir)
+        self.assertEqual(etree.tostring(xml), ref)
+        self.assertEqual(len(os.listdir(self.cache_dir)), 1)
+        # cache hit
+        xml = lower_structure(self.delete_me[0], [self.delete_me[1]], self.cache_dir)
+        self.assertEqual(etree.tostring(xml), ref)
+        # modified structure replaces the cached result
+        self.write(0, self.XML.replace('type_a', 'type_b'))
+        xml = lower_structure(self.delete_me[0], [self.delete_me[1]], self.cache_dir)
+        self.assertEqual(xml.getroot()[0].get('type-name'), 'lowered_type_b')
+        self.assertEqual(len(os.listdir(self.cache_dir)), 1)
+
+    def test_keep_documents(self):
+        keep_documents()
+        try:
+            xml = lower_structure(self.delete_me[0], [self.delete_me[1]])
+            # the kept document itself
+            self.assertIs(lower_structure(self.delete_me[0], [self.delete_me[1]]), xml)
+            # modified structure replaces the kept document
+            self.write(0, self.XML.replace('type_a', 'type_b'))
+            xml = lower_structure(self.delete_me[0], [self.delete_me[1]])
+            self.assertEqual(xml.getroot()[0].get('type-name'), 'lowered_type_b')
+            self.assertEqual(list(lowering._documents), [os.path.abspath(self.delete_me[0])])
+        finally:
+            keep_documents(False)
+
+    def test_keep_documents_limit(self):
+        self.delete_me += ['df.test2.xml', 'df.test3.xml']
+        self.write(2, self.XML)
+        self.write(3, self.XML)
+        keep_documents(limit=2)
+        try:
+            for i in [0, 2, 0, 3]:
+                lower_structure(self.delete_me[i], [self.delete_me[1]])
+            # least recently used documents are dropped
+            self.assertEqual(list(lowering._documents), [os.path.abspath(self.delete_me[i]) for i in [0, 3]])
+        finally:
+            keep_documents(False)
+
+    def test_key(self):
+        key = lowering_key(self.delete_me[0], [self.delete_me[1]])
+        self.assertEqual(lowering_key(self.delete_me[0], [self.delete_me[1]]), key)
+        self.assertNotEqual(lowering_key(self.delete_me[0], []), key)
+        self.write(1, self.XSLT.replace('lowered_', 'lower_'))
+        self.assertNotEqual(lowering_key(self.delete_me[0], [self.delete_me[1]]), key)
+
+    def test_stream_structure(self):
+        ref = lower_structure(self.delete_me[0], [self.delete_me[1]]).getroot()
+        items = list(stream_structure(self.delete_me[0], [self.delete_me[1]]))
+        self.assertEqual(len(items), 2)
+        for item, ref_item in zip(items, ref):
+            self.assertEqual(etree.tostring(item), etree.tostring(ref_item))
+            # each type has its own document, under the original root element
+            self.assertEqual(item.getroottree().getroot().tag, ref.tag)
+            self.assertEqual(len(item.getroottree().getroot()), 1)
+        # read cached result
+        lower_structure(self.delete_me[0], [self.delete_me[1]], self.cache_dir)
+        items = list(stream_structure(self.delete_me[0], [self.delete_me[1]], self.cache_dir))
+        self.assertEqual([etree.tostring(item) for item in items],
+                         [etree.tostring(item) for item in ref])
+
+    def test_cross_definition_lookups(self):
+        self.assertEqual(cross_definition_lookups([self.delete_me[1]]), [])
+        self.delete_me.append('lookup.xslt')
+        self.write(2, """<xsl:stylesheet version="1.0" xmlns:xsl="http://www.w3.org/1999/XSL/Transform">
+        <xsl:import href="lower.xslt"/>
+        <xsl:key name="types" match="/*/*" use="@type-name"/>
+        <xsl:template match="/data-definition/*[@base-type]">
+          <xsl:copy>
+            <xsl:attribute name="level"><xsl:value-of select="count(ancestor::*)"/></xsl:attribute>
+            <xsl:value-of select="../@name"/>
+            <xsl:if test="*/@name and key('types', @base-type)">
+              <xsl:value-of select="count(preceding-sibling::*)"/>
+            </xsl:if>
+            <base name="{//*[@type-name=current()/@base-type]/@name}" count="{count(*)}"/>
+          </xsl:copy>
+        </xsl:template>
+        </xsl:stylesheet>
+        """)
+        self.assertEqual(cross_definition_lookups([self.delete_me[2]]), [
+            "lookup.xslt:8: */@name and key('types', @base-type)",
+            'lookup.xslt:9: count(preceding-sibling::*)',
+            'lookup.xslt:11: //*[@type-name=current()/@base-type]/@name',
+        ])
+        # imported stylesheets are checked too
+        self.write(1, '<xsl:stylesheet version="1.0" xmlns:xsl="http://www.w3.org/1999/XSL/Transform">'
+                   '<xsl:import href="lookup.xslt"/></xsl:stylesheet>')
+        self.assertEqual(len(cross_definition_lookups([self.delete_me[1]])), 3)
+
+    @unittest.skipUnless(DFHACK_XML, 'needs $DFHACK_XML, the xml directory of dfhack')
+    def test_stream_lower_1(self):
+        xslt = os.path.join(DFHACK_XML, 'lower-1.xslt')
+        lookups = cross_definition_lookups([xslt])
+        if lookups:
+            self.skipTest('--stream is refused with lower-1.xslt: ' + ', '.join(lookups))
+        for fname in sorted(glob.glob(os.path.join(DFHACK_XML, 'df.*.xml'))):
+            ref = lower_structure(fname, [xslt]).getroot()
+            self.assertEqual([etree.tostring(item) for item in stream_structure(fname, [xslt])],
+                             [etree.tostring(item) for item in ref], fname)
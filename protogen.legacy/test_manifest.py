@@ -0,0 +1,118 @@
+#!/bin/python3
+
+import unittest
+import os
+import json
+from lxml import etree
+
+from manifest import Manifest, TypeHasher, write_build_manifest, write_cmake
+
+
+class TestManifest(unittest.TestCase):
+
+    def setUp(self):
+        self.XML = """
+        <ld:data-definition xmlns:ld="ns">
+        <ld:global-type ld:meta="struct-type" ld:level="0" type-name="type_a">
+          <ld:field name="a" ld:level="1" ld:meta="number" ld:subtype="int32_t"/>
+        </ld:global-type>
+        <ld:global-type ld:meta="struct-type" ld:level="0" type-name="type_b">
+          <ld:field name="b" ld:level="1" ld:meta="number" ld:subtype="int32_t"/>
+        </ld:global-type>
+        </ld:data-definition>
+        """
+        self.delete_me = ['exceptions.tmp', 'manifest.tmp', 'type_a.proto']
+        self.write_exceptions('')
+
+    def tearDown(self):
+        for f in self.delete_me:
+            if os.path.exists(f):
+                os.remove(f)
+
+    def write_exceptions(self, content):
+        with open(self.delete_me[0], 'w') as fil:
+            fil.write(content)
+
+    def digests(self, root):
+        hasher = TypeHasher(self.delete_me[0])
+        return [hasher.digest(item) for item in root]
+
+    def test_digest_xml(self):
+        root = etree.fromstring(self.XML)
+        ref = self.digests(root)
+        self.assertNotEqual(ref[0], ref[1])
+        self.assertEqual(self.digests(root), ref)
+        root[1][0].set('name', 'c')
+        digests = self.digests(root)
+        self.assertEqual(digests[0], ref[0])
+        self.assertNotEqual(digests[1], ref[1])
+
+    def test_digest_exceptions(self):
+        root = etree.fromstring(self.XML)
+        ref = self.digests(root)
+        self.write_exceptions("""
+        # only type_b is affected
+        ignore ld:global-type[@type-name="type_b"]/ld:field[@name="b"]
+        rename ld:global-type[@type-name="type_c"]/ld:field[@name="c"] d
+        depends type_b type_c
+        """)
+        digests = self.digests(root)
+        self.assertEqual(digests[0], ref[0])
+        self.assertNotEqual(digests[1], ref[1])
+        # index rules may apply to any type
+        self.write_exceptions('index type_c id\n')
+        digests = self.digests(root)
+        self.assertNotEqual(digests[0], ref[0])
+        self.assertNotEqual(digests[1], ref[1])
+        # and so may the rules of no given type, even matching nothing yet
+        for rule in ['ignore //ld:field[@name="z"]', 'rename ld:global-type/ld:field[@name="z"] y']:
+            self.write_exceptions(rule + '\n')
+            digests = self.digests(root)
+            self.assertNotEqual(digests[0], ref[0])
+            self.assertNotEqual(digests[1], ref[1])
+
+    def test_lookup(self):
+        sut = Manifest(self.delete_me[1])
+        self.assertIsNone(sut.lookup('type_a', '1234'))
+        sut.update('type_a', '1234', [self.delete_me[2]], '$global.world.a')
+        sut.update('type_b', '5678', None, None)
+        self.assertTrue(sut.save())
+        self.assertFalse(sut.save())
+        sut = Manifest(self.delete_me[1])
+        # generated file is missing
+        self.assertIsNone(sut.lookup('type_a', '1234'))
+        with open(self.delete_me[2], 'w') as fil:
+            fil.write('')
+        self.assertEqual(sut.lookup('type_a', '1234')['instance-vector'], '$global.world.a')
+        self.assertIsNone(sut.lookup('type_a', '4321'))
+        # ignored type
+        self.assertIsNotNone(sut.lookup('type_b', '5678'))
+
+    def records(self):
+        return [{
+            'type': 'type_b', 'structure': 'df.test.xml', 'files': ['/out/type_b.proto', '/out/type_b.cpp'],
+            'instance-vector': None, 'depends': [],
+        }, {
+            'type': 'type_a', 'structure': 'df.test.xml', 'files': ['/out/type_a.proto', '/out/type_a.h'],
+            'instance-vector': '$global.world.a', 'depends': ['type_b'],
+        }]
+
+    def test_build_manifest(self):
+        self.assertTrue(write_build_manifest(self.delete_me[1], ['/xml/df.test.xml'], self.records(), ['/out/methods.inc']))
+        self.assertFalse(write_build_manifest(self.delete_me[1], ['/xml/df.test.xml'], self.records(), ['/out/methods.inc']))
+        with open(self.delete_me[1]) as fil:
+            content = json.load(fil)
+        self.assertEqual(content['structures'], ['/xml/df.test.xml'])
+        self.assertEqual(content['files'], ['/out/methods.inc'])
+        self.assertEqual(content['types']['type_a']['depends'], ['type_b'])
+        self.assertEqual(content['types']['type_a']['instance-vector'], '$global.world.a')
+        self.assertEqual(content['types']['type_b']['files'], ['/out/type_b.proto', '/out/type_b.cpp'])
+
+    def test_cmake(self):
+        self.assertTrue(write_cmake(self.delete_me[1], ['/xml/df.test.xml'], self.records(), []))
+        with open(self.delete_me[1]) as fil:
+            content = fil.read()
+        self.assertIn('set(PROTOGEN_TYPES\n  "type_a"\n  "type_b"\n)', content)
+        self.assertIn('set(PROTOGEN_PROTO_FILES\n  "/out/type_a.proto"\n  "/out/type_b.proto"\n)', content)
+        self.assertIn('set(PROTOGEN_SOURCE_FILES\n  "/out/type_b.cpp"\n)', content)
+        self.assertIn('set(PROTOGEN_OUTPUTS\n)', content)
@@ -0,0 +1,69 @@
+#!/bin/python3
+
+import unittest
+import io
+
+import profiling
+from profiling import Profile
+
+
+class TestProfiling(unittest.TestCase):
+
+    def tearDown(self):
+        profiling.disable()
+
+    def test_disabled(self):
+        with profiling.phase('parse'):
+            pass
+        with profiling.step('type_a', 'proto'):
+            pass
+        self.assertIsNone(profiling.disable())
+
+    def test_phases(self):
+        profiling.enable()
+        for i in range(2):
+            with profiling.phase('parse'):
+                pass
+        with profiling.step('type_a', 'proto'):
+            pass
+        with profiling.step('type_a', 'write'):
+            pass
+        profile = profiling.disable()
+        self.assertEqual(sorted(profile.phases.keys()), ['parse', 'render proto', 'render write'])
+        self.assertEqual(profile.phases['parse'][0], 2)
+        self.assertEqual(sorted(profile.types['type_a'].keys()), ['proto', 'write'])
+
+    def test_merge(self):
+        profile = Profile()
+        profile.add_step('type_a', 'walk', 1.0)
+        other = Profile()
+        other.add_step('type_a', 'walk', 2.0)
+        other.add_step('type_b', 'h', 4.0)
+        profile.merge(other)
+        self.assertEqual(profile.phases['render walk'], [2, 3.0])
+        self.assertEqual(profile.types['type_a'], {'walk': 3.0})
+        out = io.StringIO()
+        profile.report(out, top=1)
+        lines = out.getvalue().splitlines()
+        self.assertEqual(lines[1].split(), ['render', 'h', '1', '4.000'])
+        self.assertEqual(lines[-1].split(), ['type_b', '0.000', '4.000', '0.000', '4.000'])
+
+    def test_memory(self):
+        profiling.enable(memory=True)
+        with profiling.structure('/tmp/df.a.xml'):
+            with profiling.phase('parse', sites=True):
+                data = [bytearray(1024) for i in range(1024)]
+            with profiling.step('type_a', 'proto'):
+                bytearray(4 * 1024 * 1024)
+        profile = profiling.disable()
+        self.assertGreater(profile.memory['parse'][0], 1024 * 1024)
+        self.assertGreater(profile.type_memory['type_a'][0], 4 * 1024 * 1024)
+        self.assertGreater(profile.memory['render proto'][0], 4 * 1024 * 1024)
+        # the peak of the file includes the peak of the type after the parse
+        self.assertGreater(profile.files['df.a.xml'][0], 5 * 1024 * 1024)
+        self.assertTrue(any(['test_profiling.py' in site for site in profile.sites['parse']]))
+        self.assertGreater(profile.rss, 0)
+        out = io.StringIO()
+        profile.report(out)
+        self.assertIn('largest types', out.getvalue())
+        del data
@@ -0,0 +1,186 @@
+#!/bin/python3
+
+import unittest
+import os
+import io
+import shutil
+import tempfile
+import argparse
+import contextlib
+import gzip
+from lxml import etree
+
+import protogen
+import profiling
+
+
+class TestProtogen(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.XML = """<ld:data-definition xmlns:ld="ns">
+        <ld:global-type ld:meta="struct-type" ld:level="0" type-name="type_%(s)s_a" instance-vector="$global.world.%(s)s" export="true">
+          <ld:field ld:meta="number" ld:subtype="int32_t" name="a" ld:level="1" export="true"/>
+          <ld:field ld:meta="global" type-name="type_%(s)s_b" name="b" ld:level="1" export="true"/>
+        </ld:global-type>
+        <ld:global-type ld:meta="enum-type" ld:level="0" type-name="type_%(s)s_b" export="true">
+          <enum-item name="x"/>
+          <enum-item name="y"/>
+        </ld:global-type>
+        <ld:global-type ld:meta="struct-type" ld:level="0" type-name="type_%(s)s_c"/>
+        </ld:data-definition>
+        """
+        self.fnames = [self.write('df.%s.xml' % (s), self.XML % {'s': s}) for s in ['a', 'b', 'c']]
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def write(self, fname, content):
+        fname = os.path.join(self.tmp, fname)
+        with open(fname, 'w') as fil:
+            fil.write(content)
+        return fname
+
+    def parse_args(self, outdir, *argv):
+        parser = argparse.ArgumentParser()
+        protogen.add_render_arguments(parser)
+        outdir = os.path.join(self.tmp, outdir)
+        return parser.parse_args([
+            '--proto_out', outdir, '--cpp_out', outdir, '--h_out', outdir,
+            '--methods', outdir + '/methods.inc', '--grpc', outdir + '/grpc.proto',
+        ] + list(argv))
+
+    def generate(self, outdir, *argv, lowered=None):
+        args = self.parse_args(outdir, *argv)
+        out = io.StringIO()
+        err = io.StringIO()
+        with contextlib.redirect_stdout(out), contextlib.redirect_stderr(err):
+            rc, types = protogen.generate(self.fnames, args, lowered)
+        outdir = os.path.join(self.tmp, outdir)
+        return rc, out.getvalue().replace(outdir, 'OUT'), err.getvalue().replace(outdir, 'OUT')
+
+    def read_dir(self, outdir):
+        content = {}
+        for fname in sorted(os.listdir(os.path.join(self.tmp, outdir))):
+            with open(os.path.join(self.tmp, outdir, fname), 'rb') as fil:
+                content[fname] = fil.read()
+        return content
+
+    def test_jobs(self):
+        ref = self.generate('serial', '-j', '1')
+        self.assertEqual(ref[0], 0)
+        self.assertIn('created type_a_a.proto, type_a_a.cpp, type_a_a.h\n', ref[1])
+        # files rendered by a pool of processes
+        for jobs in ['2', '0']:
+            self.assertEqual(self.generate('pool' + jobs, '-j', jobs), ref)
+            self.assertEqual(self.read_dir('pool' + jobs), self.read_dir('serial'))
+        # types of a single file rendered by a pool of processes
+        self.fnames = self.fnames[:1]
+        ref = self.generate('serial1', '-j', '1')
+        self.assertEqual(self.generate('types', '-j', '2'), ref)
+        self.assertEqual(self.read_dir('types'), self.read_dir('serial1'))
+
+    def test_jobs_pending(self):
+        # types are read ahead of the results by a bounded number
+        xml = etree.parse(self.fnames[0]).getroot()
+        for i in range(20):
+            xml.append(etree.fromstring(('<ld:global-type xmlns:ld="ns" ld:meta="enum-type" ld:level="0" '
+                                         'type-name="type_%d" export="true"/>') % (i)))
+        read = []
+        def items():
+            for item in xml:
+                read.append(item)
+                yield item
+        args = self.parse_args('out', '-j', '2', '--quiet')
+        args.selection = None
+        os.makedirs(os.path.join(self.tmp, 'out'))
+        limit = protogen.PENDING_TYPES_PER_JOB * 2
+        done = 0
+        for job in protogen.render_global_types(items(), args):
+            done += 1
+            self.assertIsNone(job.error)
+            self.assertLessEqual(len(read) - done, limit)
+        self.assertEqual((done, len(read)), (len(xml), len(xml)))
+
+    def test_jobs_roots(self):
+        ref = self.generate('serial', '--roots', 'type_b_a')
+        self.assertEqual(ref[0], 0)
+        self.assertEqual(self.generate('pool', '-j', '2', '--roots', 'type_b_a'), ref)
+        self.assertEqual(self.read_dir('pool'), self.read_dir('serial'))
+        self.assertEqual(sorted(self.read_dir('pool')), [
+            'grpc.proto', 'methods.inc',
+            'type_b_a.cpp', 'type_b_a.h', 'type_b_a.proto', 'type_b_b.cpp', 'type_b_b.h', 'type_b_b.proto',
+        ])
+
+    def test_jobs_lowered(self):
+        # files transformed before rendering are not transformed again by the workers
+        args = self.parse_args('pool', '-j', '2', '--roots', 'type_lowered')
+        lowered = {f: protogen.lower_structure(f, []) for f in self.fnames[:1]}
+        lowered[self.fnames[0]].getroot()[0].set('type-name', 'type_lowered')
+        selection, lowered = protogen.select_types(self.fnames, args, lowered)
+        self.assertEqual(sorted(selection), ['type_a_b', 'type_lowered'])
+        self.assertEqual(sorted(lowered), self.fnames)
+        rc, out, err = self.generate('pool', '-j', '2', '--types', 'type_lowered', 'type_b_a', lowered=lowered)
+        self.assertEqual(rc, 0)
+        self.assertEqual(sorted(self.read_dir('pool')), [
+            'grpc.proto', 'methods.inc',
+            'type_b_a.cpp', 'type_b_a.h', 'type_b_a.proto', 'type_lowered.cpp', 'type_lowered.h', 'type_lowered.proto',
+        ])
+
+    def test_jobs_profile(self):
+        # parsing done by the workers selecting the types is profiled once
+        for jobs in ['1', '2']:
+            args = self.parse_args('out', '-j', jobs, '--roots', 'type_a_a', '--profile-memory')
+            protogen.start_profile(args)
+            try:
+                protogen.select_types(self.fnames, args)
+            finally:
+                profile = profiling.disable()
+            self.assertEqual(profile.phases['parse'][0], 3)
+            self.assertEqual(sorted(profile.files), ['df.a.xml', 'df.b.xml', 'df.c.xml'])
+
+    def test_jobs_error(self):
+        self.write('df.b.xml', (self.XML % {'s': 'b'}).replace('ld:meta="global"', 'ld:meta="bogus"'))
+        for jobs in [['-j', '1'], ['-j', '2'], ['-j', '2', '--stream']]:
+            rc, out, err = self.generate('out', *jobs)
+            self.assertEqual(rc, 1)
+            self.assertIn('error rendering type type_b_a at line 2: not supported: field: meta=bogus\n', err)
+            self.assertNotIn('type_c_a', out)
+        # types of a single file rendered by a pool of processes
+        self.fnames = self.fnames[1:2]
+        rc, out, err = self.generate('out', '-j', '2')
+        self.assertEqual(rc, 1)
+        self.assertIn('error rendering type type_b_a at line 2: not supported: field: meta=bogus\n', err)
+
+    def test_dump(self):
+        self.fnames = self.fnames[:1]
+        ref = etree.tostring(protogen.lower_structure(self.fnames[0], []))
+        for opt, fname, opener in [('--dump-xml', 'df.a.out.xml', open), ('--dump-gzip', 'df.a.out.xml.gz', gzip.open)]:
+            rc, out, err = self.generate(opt, opt)
+            self.assertEqual(rc, 0)
+            self.assertIn('created OUT/%s\n' % (fname), out)
+            with opener(os.path.join(self.tmp, opt, fname), 'rb') as fil:
+                self.assertEqual(fil.read(), ref)
+        # an error of the writer thread fails the run
+        args = self.parse_args('missing', '--dump-xml', '--quiet')
+        args.selection = None
+        err = io.StringIO()
+        rc = protogen.process_file(self.fnames[0], args, err=err)[0]
+        self.assertEqual(rc, 1)
+        self.assertIn('error writing %s: ' % (os.path.join(self.tmp, 'missing', 'df.a.out.xml')), err.getvalue())
+
+    def test_stream_lookups(self):
+        xslt = self.write('lookup.xslt', """<xsl:stylesheet version="1.0" xmlns:xsl="http://www.w3.org/1999/XSL/Transform">
+        <xsl:template match="@*|node()">
+          <xsl:copy><xsl:apply-templates select="@*|node()"/></xsl:copy>
+        </xsl:template>
+        <xsl:template match="@base-type">
+          <xsl:copy-of select="//*[@type-name=current()]/@base-type"/>
+        </xsl:template>
+        </xsl:stylesheet>
+        """)
+        err = io.StringIO()
+        with contextlib.redirect_stderr(err), self.assertRaises(SystemExit) as cm:
+            protogen.main([self.tmp, '--stream', '--transform', xslt])
+        self.assertEqual(cm.exception.code, 2)
+        self.assertIn('lookup.xslt:6: //*[@type-name=current()]/@base-type', err.getvalue())
@@ -0,0 +1,101 @@
+#!/bin/python3
+
+import unittest
+import os
+from lxml import etree
+
+import rules as rules_module
+from rules import RuleSet, RuleCache, xpath_type, load_rules
+
+
+class TestRules(unittest.TestCase):
+
+    def setUp(self):
+        self.delete_me = ['exceptions.tmp']
+        with open(self.delete_me[0], 'w') as fil:
+            fil.write("""# comment
+rename ld:global-type[@type-name="type_a"]/ld:field[@name="a"] a1
+ignore ld:global-type/ld:field[@name="civ"]
+rename ld:global-type[@type-name="type_a"]/ld:field[@name="a"] a2
+ignore ld:global-type[@type-name="type_b"]
+index type_c id
+index type_c id2
+enum type_d
+depends type_a type_b
+depends type_a type_c
+""")
+
+    def tearDown(self):
+        for f in self.delete_me:
+            os.remove(f)
+
+    def test_xpath_type(self):
+        self.assertEqual(xpath_type('ld:global-type[@type-name="type_a"]/ld:field[@name="a"]'), 'type_a')
+        self.assertEqual(xpath_type('ld:global-type[@type-name="type_a"]'), 'type_a')
+        self.assertIsNone(xpath_type('ld:global-type/ld:field[@name="civ"]'))
+        self.assertIsNone(xpath_type('ld:global-type[@type-name="type_a"]/..'))
+        self.assertIsNone(xpath_type('ld:global-type[@type-name="type_a"] | ld:global-type'))
+        self.assertIsNone(xpath_type('ld:global-type[@type-name="type_ab"]x'))
+
+    def test_rule_set(self):
+        rules = load_rules(self.delete_me[0])
+        self.assertIs(load_rules(self.delete_me[0]), rules)
+        self.assertEqual(rules.renames('type_a'), (
+            ('ld:global-type[@type-name="type_a"]/ld:field[@name="a"]', 'a1'),
+            ('ld:global-type[@type-name="type_a"]/ld:field[@name="a"]', 'a2'),
+        ))
+        self.assertEqual(rules.renames('type_b'), ())
+        self.assertEqual(rules.ignores('type_a'), ('ld:global-type/ld:field[@name="civ"]',))
+        self.assertEqual(rules.ignores('type_b'), (
+            'ld:global-type/ld:field[@name="civ"]', 'ld:global-type[@type-name="type_b"]',
+        ))
+        self.assertEqual(len(rules.ignores()), 2)
+        self.assertEqual(rules.index, {'type_c': 'id'})
+        self.assertEqual(rules.enum, frozenset(['type_d']))
+        self.assertEqual(rules.depends, {'type_a': ('type_b', 'type_c')})
+
+    def test_load_rules_changed(self):
+        rules = load_rules(self.delete_me[0])
+        with open(self.delete_me[0], 'a') as fil:
+            fil.write('enum type_e\n')
+        other = load_rules(self.delete_me[0])
+        self.assertIsNot(other, rules)
+        self.assertEqual(other.enum, frozenset(['type_d', 'type_e']))
+        # the rules read before the change are released
+        self.assertIs(rules_module._rule_sets[os.path.abspath(self.delete_me[0])][1], other)
+        self.assertNotIn(rules, [r[1] for r in rules_module._rule_sets.values()])
+
+    def test_with_rule(self):
+        rules = RuleSet()
+        other = rules.with_rule('ignore', 'ld:global-type[@type-name="type_a"]')
+        self.assertEqual(rules.ignores('type_a'), ())
+        self.assertEqual(other.ignores('type_a'), ('ld:global-type[@type-name="type_a"]',))
+
+    def test_matches(self):
+        root = etree.fromstring("""<ld:data-definition xmlns:ld="ns">
+        <ld:global-type type-name="type_a">
+          <ld:field name="a"/>
+          <ld:field name="a"/>
+          <ld:field name="civ"/>
+        </ld:global-type>
+        <ld:global-type type-name="type_b">
+          <ld:field name="civ"/>
+        </ld:global-type>
+        </ld:data-definition>
+        """)
+        rules = load_rules(self.delete_me[0])
+        cache = RuleCache()
+        matches = cache.matches(rules, root[0][0], 'ns')
+        self.assertIs(cache.matches(rules, root[1], 'ns'), matches)
+        self.assertIsNot(cache.matches(RuleSet(), root[1], 'ns'), matches)
+        # the rule set keeps no reference to the document
+        self.assertIsNot(rules.matches(root[1], 'ns'), rules.matches(root[1], 'ns'))
+        self.assertFalse([v for v in vars(rules).values() if v is root])
+        # the first element selected is renamed, by the last rule
+        self.assertEqual(matches.renamed, {root[0][0]: 'a2'})
+        self.assertEqual(matches.ignored, set([root[0][2], root[1], root[1][0]]))
+        # documents of a single type only evaluate the rules of the type
+        other = etree.fromstring('<ld:data-definition xmlns:ld="ns"/>')
+        other.append(root[0])
+        self.assertIsNot(cache.matches(rules, other, 'ns'), matches)
+        self.assertEqual(cache.matches(rules, other, 'ns').ignored, set([other[0][2]]))
@@ -0,0 +1,63 @@
+#!/bin/python3
+
+import unittest
+import os
+import json
+import tempfile
+
+import tracing
+
+
+class TestTracing(unittest.TestCase):
+
+    def setUp(self):
+        fd, self.fname = tempfile.mkstemp(suffix='.json')
+        os.close(fd)
+        os.remove(self.fname)
+
+    def tearDown(self):
+        tracing._fname = None
+        tracing._events.clear()
+        if os.path.exists(self.fname):
+            os.remove(self.fname)
+
+    def read_events(self):
+        with open(self.fname) as fil:
+            content = fil.read()
+        self.assertTrue(content.startswith('[\n'))
+        return json.loads(content.rstrip().rstrip(',') + ']')
+
+    def test_disabled(self):
+        with tracing.span('a', 'test'):
+            pass
+        self.assertEqual(tracing._events, [])
+
+    def test_span(self):
+        tracing.enable(self.fname)
+        with tracing.span('a', 'test', file='f'):
+            with tracing.span('b', 'test'):
+                pass
+        tracing.flush()
+        with tracing.span('c', 'test'):
+            pass
+        tracing.flush()
+        events = self.read_events()
+        spans = [e for e in events if e['ph'] == 'X']
+        self.assertEqual([e['name'] for e in spans], ['b', 'a', 'c'])
+        self.assertEqual(spans[1]['args'], {'file': 'f'})
+        self.assertTrue(spans[1]['ts'] <= spans[0]['ts'])
+        self.assertTrue(spans[0]['ts'] + spans[0]['dur'] <= spans[1]['ts'] + spans[1]['dur'])
+        self.assertEqual(len([e for e in events if e['ph'] == 'M']), 1)
+
+    def test_disable(self):
+        tracing.enable(self.fname)
+        with tracing.span('a', 'test'):
+            pass
+        tracing.disable()
+        self.assertFalse(tracing.enabled())
+        self.assertEqual([e['name'] for e in self.read_events() if e['ph'] == 'X'], ['a'])
+        with tracing.span('b', 'test'):
+            pass
+        tracing.flush()
+        self.assertEqual(tracing._events, [])
+        self.assertEqual([e['name'] for e in self.read_events() if e['ph'] == 'X'], ['a'])
@@ -0,0 +1,47 @@
+#!/bin/python3
+
+import unittest
+from lxml import etree
+
+from type_graph import type_dependencies, type_graph, closure
+
+
+class TestTypeGraph(unittest.TestCase):
+
+    def setUp(self):
+        self.XML = """
+        <ld:data-definition xmlns:ld="ns">
+        <ld:global-type ld:meta="struct-type" ld:level="0" type-name="type_a" export="true">
+          <ld:field name="b" ld:level="1" ld:meta="global" type-name="type_b" export="true"/>
+          <ld:field name="c" ld:level="1" ld:meta="pointer" type-name="type_c"/>
+          <ld:field ld:subtype="stl-vector" name="d" ld:level="1" ld:meta="container" pointer-type="type_d" export="true">
+            <ld:item ld:meta="pointer" type-name="type_d" ld:is-container="true" ld:level="2" export="true"/>
+          </ld:field>
+          <ld:field name="e" ld:level="1" ld:meta="global" type-name="type_e" export="true" export-as="int32"/>
+        </ld:global-type>
+        <ld:global-type ld:meta="struct-type" ld:level="0" type-name="type_b" inherits-from="type_f" export="true"/>
+        <ld:global-type ld:meta="struct-type" ld:level="0" type-name="type_c" export="true"/>
+        <ld:global-type ld:meta="struct-type" ld:level="0" type-name="type_d" export="true">
+          <ld:field name="a" ld:level="1" ld:meta="pointer" type-name="type_a" export="true"/>
+        </ld:global-type>
+        <ld:global-type ld:meta="struct-type" ld:level="0" type-name="type_g" export="true"/>
+        <ld:global-type ld:meta="struct-type" ld:level="0" type-name="type_h"/>
+        </ld:data-definition>
+        """
+
+    def test_type_dependencies(self):
+        root = etree.fromstring(self.XML)
+        self.assertEqual(type_dependencies(root[0]), {'type_b', 'type_d'})
+        self.assertEqual(type_dependencies(root[1]), {'type_f'})
+        self.assertEqual(type_dependencies(root[3]), {'type_a'})
+
+    def test_type_graph(self):
+        graph = type_graph(etree.fromstring(self.XML))
+        self.assertEqual(sorted(graph.keys()), ['type_a', 'type_b', 'type_c', 'type_d', 'type_g'])
+        self.assertEqual(graph['type_c'], set())
+
+    def test_closure(self):
+        graph = type_graph(etree.fromstring(self.XML))
+        self.assertEqual(closure(graph, ['type_a']), {'type_a', 'type_b', 'type_d', 'type_f'})
+        self.assertEqual(closure(graph, ['type_d']), {'type_a', 'type_b', 'type_d', 'type_f'})
+        self.assertEqual(closure(graph, ['type_g', 'type_x']), {'type_g', 'type_x'})
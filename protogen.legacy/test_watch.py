@@ -0,0 +1,121 @@
+#!/bin/python3
+
+import unittest
+import os
+import io
+import shutil
+import tempfile
+import contextlib
+
+import watch
+import protogen
+import build
+from watch import snapshot, changes, Watcher
+
+
+class SavingWatcher:
+    """Watcher saving a new content of a file on each wait, then interrupted."""
+
+    def __init__(self, fname, contents):
+        self.fname = fname
+        self.contents = list(contents)
+
+    def __call__(self, patterns):
+        self.patterns = patterns
+        return self
+
+    def wait(self):
+        if not self.contents:
+            raise KeyboardInterrupt()
+        with open(self.fname, 'w') as fil:
+            fil.write(self.contents.pop(0))
+        return set([self.fname])
+
+    def close(self):
+        pass
+
+
+class TestWatch(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.write('df.a.xml', '<a/>')
+        self.write('a.export', '')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def write(self, fname, content):
+        fname = os.path.join(self.tmp, fname)
+        with open(fname, 'w') as fil:
+            fil.write(content)
+        # make the change visible to coarse modification times
+        st = os.stat(fname)
+        os.utime(fname, ns=(st.st_atime_ns, st.st_mtime_ns + 10**9))
+        return fname
+
+    def test_changes(self):
+        patterns = [os.path.join(self.tmp, 'df.*.xml')]
+        old = snapshot(patterns)
+        self.assertEqual(list(old.keys()), [os.path.join(self.tmp, 'df.a.xml')])
+        self.write('a.export', 'type_a')
+        self.assertEqual(changes(old, snapshot(patterns)), set())
+        a = self.write('df.a.xml', '<b/>')
+        b = self.write('df.b.xml', '<b/>')
+        self.assertEqual(changes(old, snapshot(patterns)), set([a, b]))
+        new = snapshot(patterns)
+        os.remove(a)
+        self.assertEqual(changes(new, snapshot(patterns)), set([a]))
+
+    def test_watcher(self):
+        inotify_simple = watch.inotify_simple
+        watch.inotify_simple = None
+        try:
+            watcher = Watcher([os.path.join(self.tmp, '*.export')], interval=0.01)
+            fname = self.write('a.export', 'type_a')
+            self.assertEqual(watcher.wait(), set([fname]))
+            watcher.close()
+        finally:
+            watch.inotify_simple = inotify_simple
+
+    def run_watch(self, main, argv, fname, contents):
+        out = io.StringIO()
+        err = io.StringIO()
+        saved = protogen.Watcher
+        protogen.Watcher = SavingWatcher(os.path.join(self.tmp, fname), contents)
+        try:
+            with contextlib.redirect_stdout(out), contextlib.redirect_stderr(err), self.assertRaises(SystemExit):
+                main(argv + ['--watch', '--quiet',
+                             '--proto_out', self.out, '--cpp_out', self.out, '--h_out', self.out,
+                             '--methods', self.out + '/methods.inc', '--grpc', self.out + '/grpc.proto'])
+        finally:
+            protogen.Watcher = saved
+        return err.getvalue()
+
+    def test_watch_errors(self):
+        self.out = os.path.join(self.tmp, 'out')
+        xml = """<ld:data-definition xmlns:ld="ns">
+        <ld:global-type ld:meta="struct-type" ld:level="0" type-name="type_%s" export="true"/>
+        </ld:data-definition>"""
+        self.write('df.a.xml', xml % ('a'))
+        # half-saved file, then fixed file
+        err = self.run_watch(protogen.main, [self.tmp + '/'], 'df.a.xml', [(xml % ('b'))[:60], xml % ('c')])
+        self.assertIn('error regenerating %s: ' % (os.path.join(self.tmp, 'df.a.xml')), err)
+        self.assertEqual(sorted([f for f in os.listdir(self.out) if f.startswith('type_')]), [
+            'type_a.cpp', 'type_a.h', 'type_a.proto', 'type_c.cpp', 'type_c.h', 'type_c.proto',
+        ])
+
+    def test_build_watch_errors(self):
+        self.out = os.path.join(self.tmp, 'out')
+        self.write('df.a.xml', """<ld:data-definition xmlns:ld="ns">
+        <ld:global-type ld:meta="struct-type" ld:level="0" type-name="type_a">
+          <ld:field ld:meta="number" ld:subtype="int32_t" name="a" ld:level="1"/>
+        </ld:global-type>
+        </ld:data-definition>""")
+        self.write('a.export', 'type_a\n')
+        # bad export line, then fixed export file
+        err = self.run_watch(build.main, [self.tmp, self.tmp, '--xml_out', os.path.join(self.tmp, 'xml')],
+                             'a.export', ['type_a\n\ta b\n', 'type_a\n\ta\n'])
+        self.assertIn('error regenerating %s: ' % (os.path.join(self.tmp, 'a.export')), err)
+        with open(os.path.join(self.out, 'type_a.proto')) as fil:
+            self.assertIn('a = 1;', fil.read())
@@ -0,0 +1,103 @@
+import os
+import sys
+import json
+import time
+import atexit
+import threading
+import contextlib
+
+try:
+    import fcntl
+except ImportError:
+    # no locking: processes should not write the same trace at once
+    fcntl = None
+
+# trace file of this process, when tracing is enabled
+_fname = None
+# events not written yet
+_events = []
+# (trace file, pid) of the processes whose name was written to the trace
+_named = set()
+
+
+def now():
+    # microseconds, comparable between processes
+    return time.time_ns() // 1000
+
+
+def _forget_events():
+    # forked workers write their own events only
+    _events.clear()
+
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_forget_events)
+
+
+def enable(fname):
+    """Append the spans of this process to the trace-event file fname."""
+    global _fname
+    fname = os.path.abspath(fname)
+    if _fname and _fname != fname:
+        flush()
+    _fname = fname
+
+
+def disable():
+    """Write the recorded events and stop tracing."""
+    global _fname
+    flush()
+    _fname = None
+
+
+def enabled():
+    return _fname is not None
+
+
+@contextlib.contextmanager
+def span(name, cat, **args):
+    """Record the time spent in the body as a complete event, if tracing is enabled."""
+    if not _fname:
+        yield
+        return
+    start = now()
+    try:
+        yield
+    finally:
+        _events.append({
+            'name': name, 'cat': cat, 'ph': 'X', 'ts': start, 'dur': now() - start,
+            'pid': os.getpid(), 'tid': threading.get_native_id(), 'args': args,
+        })
+
+
+def flush():
+    """Append the recorded events to the trace file.
+
+    The file uses the json array format of trace events, whose closing
+    bracket is optional, so that processes can append to it in any order."""
+    if not _fname or not _events:
+        return
+    events = _events[:]
+    _events.clear()
+    pid = os.getpid()
+    if (_fname, pid) not in _named:
+        _named.add((_fname, pid))
+        events.insert(0, {
+            'name': 'process_name', 'ph': 'M', 'pid': pid,
+            'args': {'name': ' '.join([os.path.basename(sys.argv[0])] + sys.argv[1:2])},
+        })
+    content = ''.join([json.dumps(e) + ',\n' for e in events])
+    with open(_fname, 'a') as fil:
+        if fcntl:
+            fcntl.flock(fil, fcntl.LOCK_EX)
+        try:
+            if fil.seek(0, os.SEEK_END) == 0:
+                content = '[\n' + content
+            fil.write(content)
+            fil.flush()
+        finally:
+            if fcntl:
+                fcntl.flock(fil, fcntl.LOCK_UN)
+
+
+atexit.register(flush)
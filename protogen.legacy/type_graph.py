@@ -0,0 +1,52 @@
+# attributes referring to other types
+TYPE_ATTRIBUTES = ['type-name', 'pointer-type', 'inherits-from', 'index-enum']
+
+
+def type_name(item):
+    return item.get('type-name') or item.get('name')
+
+
+def type_dependencies(item):
+    """Return the names of the types an exported type refers to.
+
+    Only the fields with attribute export='true' are followed, as the other
+    ones are not rendered. Fields converted with 'export-as' are skipped.
+    Works on both lowered and raw structures."""
+    deps = set()
+    if item.get('inherits-from'):
+        deps.add(item.get('inherits-from'))
+    for field in item:
+        if field.get('export') != 'true' or field.get('export-as'):
+            continue
+        for sub in field.iter():
+            for attr in TYPE_ATTRIBUTES:
+                tname = sub.get(attr)
+                if tname:
+                    deps.add(tname)
+    deps.discard(type_name(item))
+    return deps
+
+
+def type_graph(items):
+    """Return the dependencies of each exported type of items, by type name."""
+    graph = {}
+    for item in items:
+        if item.get('export') != 'true' or not isinstance(item.tag, str):
+            continue
+        tname = type_name(item)
+        if tname:
+            graph.setdefault(tname, set()).update(type_dependencies(item))
+    return graph
+
+
+def closure(graph, roots):
+    """Return the roots and all the types they depend on, directly or not."""
+    result = set()
+    todo = list(roots)
+    while todo:
+        tname = todo.pop()
+        if tname in result:
+            continue
+        result.add(tname)
+        todo.extend(graph.get(tname, []))
+    return result
@@ -0,0 +1,65 @@
+import os
+import glob
+import time
+
+try:
+    # optional: wait for inotify events instead of polling
+    import inotify_simple
+except ImportError:
+    inotify_simple = None
+
+
+def snapshot(patterns):
+    """Return the modification time of the files matching the glob patterns, by path."""
+    times = {}
+    for pattern in patterns:
+        for f in glob.glob(pattern):
+            try:
+                times[f] = os.stat(f).st_mtime_ns
+            except FileNotFoundError:
+                pass
+    return times
+
+
+def changes(old, new):
+    """Return the files added, modified or removed between two snapshots."""
+    return set([f for f in set(old) | set(new) if old.get(f) != new.get(f)])
+
+
+class Watcher:
+    """Wait for changes to the files matching glob patterns.
+
+    With the inotify_simple module, waits for events of the directories of
+    the patterns; otherwise, polls the files every interval seconds."""
+
+    def __init__(self, patterns, interval=1.0, delay=0.2):
+        self.patterns = patterns
+        self.interval = interval
+        # time for editors to finish writing, and to group related changes
+        self.delay = delay
+        self.times = snapshot(patterns)
+        self.inotify = None
+        if inotify_simple:
+            flags = inotify_simple.flags
+            self.inotify = inotify_simple.INotify()
+            for d in sorted(set([os.path.dirname(p) or '.' for p in patterns])):
+                self.inotify.add_watch(d, flags.CLOSE_WRITE | flags.MOVED_TO | flags.CREATE | flags.DELETE)
+
+    def wait(self):
+        """Return the files that changed since the previous call, once some did."""
+        while True:
+            if self.inotify:
+                self.inotify.read()
+                time.sleep(self.delay)
+                self.inotify.read(timeout=0)
+            else:
+                time.sleep(self.interval)
+            times = snapshot(self.patterns)
+            changed = changes(self.times, times)
+            self.times = times
+            if changed:
+                return changed
+
+    def close(self):
+        if self.inotify:
+            self.inotify.close()
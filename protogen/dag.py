@@ -4,14 +4,33 @@
 # $ pip install networkx
 
 import sys
+import os
 import re
 import argparse
 import traceback
 import networkx as nx
 
-def main():
+from legacy import tracing
 
-    # parse args
+# graphs read by a long running process, by path: (modification time, edges)
+_edges = {}
+
+def read_edges(f):
+    """Return the edges of a DAG file, read once per modification of the file."""
+    path = os.path.abspath(f)
+    mtime = os.stat(path).st_mtime_ns
+    if _edges.get(path, (None,))[0] != mtime:
+        edges = []
+        with open(f) as fp:
+            for line in fp:
+                tokens = line.split()
+                node = tokens[0] if tokens else None
+                for dep in tokens[1:]:
+                    edges.append((dep, node))
+        _edges[path] = (mtime, edges)
+    return _edges[path][1]
+
+def make_parser():
     parser = argparse.ArgumentParser(description='Explore a directed acyclic graph.')
     parser.add_argument('inputs', metavar='INFILE', type=str, nargs='+',
                         help='DAG file')
@@ -34,30 +53,28 @@ def main():
                         help='list all sinks of the graph')
     group.add_argument('--path', metavar='SOURCE TARGET', type=str, nargs=2, default=[],
                         help='list all paths from SOURCE to TARGET')
-    args = parser.parse_args()
+    parser.add_argument('--trace', metavar='FILE', type=str,
+                        default=os.environ.get('PROTOGEN_TRACE'),
+                        help='append spans to a trace-event file (default=$PROTOGEN_TRACE)')
+    return parser
+
+def main():
+
+    # parse args
+    args = make_parser().parse_args()
+    if args.trace:
+        tracing.enable(args.trace)
 
     # read graph
     G = nx.DiGraph()
     for f in args.inputs:
         try:
-            fp = None
-            with open(f) as fp:
-                line = fp.readline()
-                while line:
-                    tokens = line.split()
-                    if not tokens:
-                        continue
-                    node = tokens[0]
-                    for dep in tokens[1:]:
-                        G.add_edge(dep, node)
-                    line = fp.readline()
+            with tracing.span('read', 'file', file=f):
+                G.add_edges_from(read_edges(f))
         except Exception as e:
             sys.stderr.write('error parsing %s' % (f))
             traceback.print_exc(file=sys.stderr)
             exit(1)
-        finally:
-            if fp:
-                fp.close()
 
     if not args.plain:
         print('read %d file(s), %d nodes and %d edges' % (len(args.inputs), G.number_of_nodes(), G.number_of_edges()))
@@ -70,14 +87,14 @@ def main():
             for t in args.ancestors:
                 deps.update([t])
                 deps.update(nx.ancestors(G, t))
-            result = list(deps)
+            result = sorted(deps)
 
         # list all direct successors of the given nodes
         elif args.successors:
             deps = set()
             for t in args.successors:
                 deps.update(G.successors(t))
-            result = list(deps)
+            result = sorted(deps)
 
         # list all sinks
         elif args.sinks:
@@ -86,7 +103,7 @@ def main():
             for node, degree in list(view):
                 if degree == 0:
                     sinks.update([node])
-            result = list(sinks)
+            result = sorted(sinks)
 
         # list all sources of the given nodes
         elif args.sources is not None:
@@ -101,7 +118,7 @@ def main():
             for node, degree in list(view):
                 if degree == 0:
                     sources.update([node])
-            result = list(sources)
+            result = sorted(sources)
 
         # list all paths from 'source' to 'target'
         elif args.path:
@@ -4,6 +4,7 @@
 # $ pip install antlr4-python3-runtime
 
 import sys
+import os
 import argparse
 import traceback
 import networkx as nx
@@ -13,6 +14,8 @@ from parser.DfParser import DfParser
 from antlr4.error.ErrorListener import ErrorListener
 from parser.DfParserVisitor import DfParserVisitor
 
+from legacy import tracing
+
 
 class ThrowingErrorListener(ErrorListener):
     def syntaxError(self, recognizer, offendingSymbol, line, charPositionInLine, msg, e):
@@ -118,19 +121,26 @@ def main():
                         help='raw output (default=false)')
     parser.add_argument('--separator', '-s', metavar='STR', type=str,
                         default=' ', help='separator between elements of lists (default=" ")')
+    parser.add_argument('--trace', metavar='FILE', type=str,
+                        default=os.environ.get('PROTOGEN_TRACE'),
+                        help='append spans to a trace-event file (default=$PROTOGEN_TRACE)')
     args = parser.parse_args()
+    if args.trace:
+        tracing.enable(args.trace)
 
     all_deps = []
     for f in args.inputs:
         try:
-            input_stream = FileStream(f)
-            lexer = DfLexer(input_stream)
-            stream = CommonTokenStream(lexer)
-            parser = DfParser(stream)
-            parser.addErrorListener(ThrowingErrorListener())
-            tree = parser.datadef()
-            visitor = DependenciesVisitor()
-            deps = visitor.visitDatadef(tree)
+            with tracing.span('parse', 'file', file=f):
+                input_stream = FileStream(f)
+                lexer = DfLexer(input_stream)
+                stream = CommonTokenStream(lexer)
+                parser = DfParser(stream)
+                parser.addErrorListener(ThrowingErrorListener())
+                tree = parser.datadef()
+            with tracing.span('dependencies', 'file', file=f):
+                visitor = DependenciesVisitor()
+                deps = visitor.visitDatadef(tree)
             # add filename as a dependency fo each type
             for d in deps:
                 d.extend([f])
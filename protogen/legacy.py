@@ -0,0 +1,9 @@
+# modules of protogen.legacy shared with these scripts
+import os
+import sys
+
+LEGACY_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'protogen.legacy')
+if LEGACY_DIR not in sys.path:
+    sys.path.append(LEGACY_DIR)
+
+import tracing
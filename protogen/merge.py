@@ -1,69 +1,119 @@
 #!/usr/bin/python3
 
 import sys
+import os
+import shutil
 import argparse
+import tempfile
 from lxml import etree
 
-def parse_type(xml, fd):
+from legacy import tracing
+
+def read_exports(fd):
+    """Read the description of exported elements.
+
+    Return a dict of the field lines of each type, in the order of the file."""
+    exports = {}
+    fields = None
+    for line in fd:
+        tokens = line.split()
+        if line[0] != '\t':
+            # type name, or end of the fields of the previous type
+            fields = None
+            if tokens and tokens[0][0] != '#':
+                fields = exports.setdefault(tokens[0], [])
+        elif fields is not None and tokens and tokens[0][0] != '#':
+            fields.append(line)
+    return exports
+
+def parse_type(xml, lines):
     tname = xml.get('type-name')
     xml.set('export', 'true')
-    pos = fd.tell()
-    line = fd.readline()
     count = 0
     warnings = 0
-    while line:
-        if line[0] != '\t':
-            fd.seek(pos)
-            break
+    for line in lines:
         tokens = line.split()
-        if tokens and tokens[0][0] != '#':
-            # look for field with same name
-            fname = tokens[0]
-            fields = xml.findall('./*[@name="%s"]' % (fname))
-            if not fields:
-                # look for method
-                method = 'get'+fname[0].upper()+fname[1:]
-                fields = xml.findall('./virtual-methods/vmethod[@name="%s"]' % (method))
-            if len(fields) > 1:
-                sys.stderr.write('warning: %d elements found for field name <%s>\n' % (len(fields), fname))
-                warnings += 1
-            if fields:
-                elt = fields[0]
-                if len(tokens) == 1:
-                    for sub in elt.iter():
-                        sub.set('export', 'true')                        
-                elif len(tokens)==3 and tokens[1]=='as':
-                    elt.set('export-as', tokens[2])
-                else:
-                    sys.stderr.write('error parsing line \'%s\'\n' % line)
-                    raise Error(line)
-                count += 1
+        # look for field with same name
+        fname = tokens[0]
+        fields = xml.findall('./*[@name="%s"]' % (fname))
+        if not fields:
+            # look for method
+            method = 'get'+fname[0].upper()+fname[1:]
+            fields = xml.findall('./virtual-methods/vmethod[@name="%s"]' % (method))
+        if len(fields) > 1:
+            sys.stderr.write('warning: %d elements found for field name <%s>\n' % (len(fields), fname))
+            warnings += 1
+        if fields:
+            elt = fields[0]
+            if len(tokens) == 1:
+                for sub in elt.iter():
+                    sub.set('export', 'true')
+            elif len(tokens)==3 and tokens[1]=='as':
+                elt.set('export-as', tokens[2])
             else:
-                sys.stderr.write('type %s: field <%s> not found\n' % (tname, fname))
-                warnings += 1
-        pos = fd.tell()
-        line = fd.readline()
+                sys.stderr.write('error parsing line \'%s\'\n' % line)
+                raise Exception(line)
+            count += 1
+        else:
+            sys.stderr.write('type %s: field <%s> not found\n' % (tname, fname))
+            warnings += 1
     sys.stderr.write('type %s: %d field(s) exported\n' % (tname, count))
     return warnings
-    
-def parse_structure(fd, xml):
-    line = fd.readline()
+
+def parse_structure(exports, xml):
     warnings = 0
-    while line:
-        tokens = line.split()
-        if tokens and tokens[0][0] != '#' and line[0] != '\t':
-            # look for type with same name
-            tname = tokens[0]
-            types = xml.findall('./*[@type-name="%s"]' % (tname))
-            if len(types) > 1:
-                sys.stderr.write('warning: %d elements found for type name <%s>\n' % (len(types), tname))
-                warnings += 1
-            if types:
-                warnings += parse_type(types[0], fd)
-            else:
-                sys.stderr.write('type <%s> not found\n' % (tname))
-                warnings += 1
-        line = fd.readline()
+    for tname, lines in exports.items():
+        # look for type with same name
+        types = xml.findall('./*[@type-name="%s"]' % (tname))
+        if len(types) > 1:
+            sys.stderr.write('warning: %d elements found for type name <%s>\n' % (len(types), tname))
+            warnings += 1
+        if types:
+            with tracing.span(tname, 'type'):
+                warnings += parse_type(types[0], lines)
+        else:
+            sys.stderr.write('type <%s> not found\n' % (tname))
+            warnings += 1
+    return warnings
+
+def stream_structure(exports, infile, outfile):
+    """Same as parse_structure, reading and writing one top-level element at a time."""
+    warnings = 0
+    found = {}
+    context = etree.iterparse(infile, events=('start', 'end', 'comment'))
+    for event, root in context:
+        if event == 'start':
+            break
+    depth = 1
+    with etree.xmlfile(outfile) as xf:
+        with xf.element(root.tag, attrib=dict(root.attrib), nsmap=root.nsmap):
+            xf.write('\n')
+            for event, elt in context:
+                if event == 'comment':
+                    if depth == 1:
+                        xf.write(elt, pretty_print=True)
+                    continue
+                depth += 1 if event == 'start' else -1
+                if event == 'start' or depth != 1:
+                    continue
+                tname = elt.get('type-name')
+                if tname in exports:
+                    found[tname] = found.get(tname, 0) + 1
+                    if found[tname] == 1:
+                        with tracing.span(tname, 'type'):
+                            warnings += parse_type(elt, exports[tname])
+                xf.write(elt, pretty_print=True)
+                # free this element and the ones before
+                elt.clear()
+                while elt.getprevious() is not None:
+                    del root[0]
+    for tname in exports:
+        if found.get(tname, 0) > 1:
+            sys.stderr.write('warning: %d elements found for type name <%s>\n' % (found[tname], tname))
+            warnings += 1
+        elif tname not in found:
+            sys.stderr.write('type <%s> not found\n' % (tname))
+            warnings += 1
     return warnings
 
 def main():
@@ -73,12 +123,33 @@ def main():
                         help='DF structure xml file')
     parser.add_argument('input2', metavar='FILE2', type=str,
                         help='description of exported elements')
+    parser.add_argument('--stream', action='store_true', default=False,
+                        help='process one type at a time to bound memory use (default=false)')
+    parser.add_argument('--trace', metavar='FILE', type=str,
+                        default=os.environ.get('PROTOGEN_TRACE'),
+                        help='append spans to a trace-event file (default=$PROTOGEN_TRACE)')
     args = parser.parse_args()
-    
-    # parse xml and add export attributes
-    xml = etree.parse(args.input1).getroot()
+    if args.trace:
+        tracing.enable(args.trace)
+
     with open(args.input2, 'r') as fd:
-        warnings = parse_structure(fd, xml)
+        exports = read_exports(fd)
+
+    if args.stream:
+        # output is kept aside, and only written if there are no warnings
+        with tempfile.TemporaryFile() as tmp:
+            with tracing.span('merge', 'file', file=args.input1):
+                warnings = stream_structure(exports, args.input1, tmp)
+            if warnings > 0:
+                sys.exit(1)
+            tmp.seek(0)
+            shutil.copyfileobj(tmp, sys.stdout.buffer)
+        sys.exit(0)
+
+    # parse xml and add export attributes
+    with tracing.span('merge', 'file', file=args.input1):
+        xml = etree.parse(args.input1).getroot()
+        warnings = parse_structure(exports, xml)
 
     if warnings > 0:
         sys.exit(1)